@@ -0,0 +1,37 @@
+# benchmarks/bench_membership.py
+# Сравнение стоимости проверки "пользователь уже в списке" для коллекций
+# referral_activations и used_by: список (как было) против множества (как сейчас).
+#
+# Запуск: python benchmarks/bench_membership.py
+import random
+import timeit
+
+SIZES = [100, 1_000, 10_000, 50_000]
+LOOKUPS = 2_000
+
+
+def bench(size: int) -> tuple[float, float]:
+    ids = [str(random.randint(10 ** 8, 10 ** 10)) for _ in range(size)]
+    as_list = list(ids)
+    as_set = set(ids)
+    # Половина запросов попадает в коллекцию, половина - нет (худший случай для списка)
+    queries = random.sample(ids, min(LOOKUPS // 2, size)) + [str(i) for i in range(LOOKUPS // 2)]
+
+    list_time = timeit.timeit(lambda: [q in as_list for q in queries], number=1)
+    set_time = timeit.timeit(lambda: [q in as_set for q in queries], number=1)
+    return list_time / len(queries), set_time / len(queries)
+
+
+def main() -> None:
+    print(f"{'Размер':>10} | {'list, мкс/запрос':>18} | {'set, мкс/запрос':>17} | {'ускорение':>10}")
+    print("-" * 66)
+    for size in SIZES:
+        list_cost, set_cost = bench(size)
+        print(
+            f"{size:>10} | {list_cost * 1e6:>18.3f} | {set_cost * 1e6:>17.3f} | "
+            f"{list_cost / set_cost:>9.0f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,4 +5,31 @@ from config import BOT_TOKEN
 
 # Включаем HTML-парсинг по умолчанию
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-router = Router()
\ No newline at end of file
+router = Router()
+
+# Данные бота (id, username) запрашиваются один раз при запуске (load_bot_identity),
+# чтобы не обращаться к get_me() в обработчиках
+_identity = {}
+
+
+async def load_bot_identity() -> None:
+    me = await bot.get_me()
+    _identity["id"] = me.id
+    _identity["username"] = me.username
+    _identity["link_prefix"] = f"https://t.me/{me.username}?start="
+
+
+def get_bot_id() -> int:
+    return _identity["id"]
+
+
+def get_bot_username() -> str:
+    return _identity["username"]
+
+
+def get_referral_link(user_id) -> str:
+    """
+    Реферальная ссылка пользователя (без обращений к API)
+    """
+    return f"{_identity['link_prefix']}{user_id}"
+
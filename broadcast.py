@@ -0,0 +1,432 @@
+# broadcast.py
+# Рассылка сообщения пользователям.
+#
+# Сообщение администратора копируется получателям через copy_message, поэтому
+# любой тип (текст, фото, видео, документ, голосовое...) отправляется одним
+# способом, с сохранением форматирования и подписи.
+#
+# Отправку выполняют BROADCAST_WORKERS параллельных задач. Общий для всего бота
+# TokenBucket ограничивает скорость BROADCAST_RATE сообщениями в секунду; при
+# TelegramRetryAfter ведро останавливается на указанное Telegram время,
+# а получатель возвращается в очередь.
+#
+# Рассылки из админ-панели оформляются заданиями (broadcast_jobs) и выполняются
+# по очереди фоновой задачей run_broadcast_jobs. Задание хранит ссылку на
+# сообщение, список получателей, курсор и контрольную точку (broadcast_sent):
+# перед отправкой очередной пачки получатели отмечаются и отметка записывается
+# на диск, поэтому после перезапуска рассылка продолжается с того же места и
+# никому не приходит дважды. При штатной остановке отметки с ещё не отправленных
+# сообщений пачки снимаются; при аварийной они будут пропущены - это цена
+# отсутствия повторов. После обработки пачки курсор уже указывает за неё,
+# и её отметки удаляются: на диске хранятся отметки не больше чем одной пачки.
+import time
+import asyncio
+import logging
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from bot import bot
+from config import BROADCAST_RATE, BROADCAST_BURST, BROADCAST_WORKERS, BROADCAST_CHAT_INTERVAL
+from config import BROADCAST_PROGRESS_INTERVAL, BROADCAST_CHECKPOINT_SIZE, BROADCAST_TRANSIENT_RETRIES
+from config import BROADCAST_JOBS_FILE, BROADCAST_RECIPIENTS_FILE, BROADCAST_SENT_FILE
+from data import users_data, broadcast_jobs, broadcast_recipients, broadcast_sent
+from storage import schedule_save, save_now
+from stats import set_user_status
+from utils import save_users_data
+
+
+class TokenBucket:
+    """
+    Ограничение скорости: rate токенов в секунду, не больше capacity подряд
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # Ожидающие обслуживаются по очереди, в порядке вызова
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Останавливает выдачу токенов на seconds секунд (ответ Telegram retry_after)
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        # Токены начинают копиться только после паузы, иначе сразу после неё ушла бы пачка
+        self.updated = self.paused_until
+
+
+broadcast_bucket = TokenBucket(BROADCAST_RATE, BROADCAST_BURST)
+
+# Виды ошибок доставки
+ERROR_BLOCKED = "blocked"  # Пользователь заблокировал бота
+ERROR_DEACTIVATED = "deactivated"  # Аккаунт удалён
+ERROR_CHAT_NOT_FOUND = "chat_not_found"  # Чат не существует
+ERROR_FLOOD = "flood"  # Превышен лимит Telegram (отправка повторяется)
+ERROR_TRANSIENT = "transient"  # Временная ошибка: сеть, сервер Telegram
+ERROR_OTHER = "other"  # Прочие ошибки запроса
+
+# После этих ошибок пользователь отключается (status "removed") и больше не получает рассылки
+PERMANENT_ERRORS = (ERROR_BLOCKED, ERROR_DEACTIVATED, ERROR_CHAT_NOT_FOUND)
+
+ERROR_NAMES = {
+    ERROR_BLOCKED: "заблокировали бота",
+    ERROR_DEACTIVATED: "удалили аккаунт",
+    ERROR_CHAT_NOT_FOUND: "чат не найден",
+    ERROR_FLOOD: "превышение лимита",
+    ERROR_TRANSIENT: "временные ошибки",
+    ERROR_OTHER: "прочие ошибки",
+}
+
+
+def classify_error(error: Exception) -> str:
+    if isinstance(error, TelegramRetryAfter):
+        return ERROR_FLOOD
+    text = str(error).lower()
+    if isinstance(error, TelegramForbiddenError):
+        # "bot was blocked by the user", "user is deactivated", "bot was kicked"...
+        return ERROR_DEACTIVATED if "deactivated" in text else ERROR_BLOCKED
+    if isinstance(error, TelegramBadRequest):
+        if "chat not found" in text or "user not found" in text:
+            return ERROR_CHAT_NOT_FOUND
+        return ERROR_OTHER
+    return ERROR_TRANSIENT
+
+
+async def run_broadcast(from_chat_id: int, message_id: int, recipients: list[str], progress=None,
+                        attempted: set | None = None) -> dict:
+    """
+    Копирует сообщение message_id из чата from_chat_id всем recipients.
+    progress - необязательная корутина progress(результат), вызывается после каждой отправки.
+    attempted - необязательное множество, в которое добавляются получатели перед отправкой.
+    Возвращает {"total": ..., "sent": ..., "errors": ..., "error_kinds": {вид: количество},
+    "dead": {user_id: вид}} - в dead попадают получатели с постоянными ошибками (PERMANENT_ERRORS).
+    """
+    result = {"total": len(recipients), "sent": 0, "errors": 0, "error_kinds": {}, "dead": {}}
+    retries = {}
+    queue = asyncio.Queue()
+    for user_id in recipients:
+        queue.put_nowait(user_id)
+    # Время последней отправки в чат: повторная попытка не раньше BROADCAST_CHAT_INTERVAL
+    last_sent = {}
+
+    async def worker() -> None:
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            wait = last_sent.get(user_id, 0.0) + BROADCAST_CHAT_INTERVAL - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            await broadcast_bucket.acquire()
+            last_sent[user_id] = time.monotonic()
+            if attempted is not None:
+                attempted.add(user_id)
+
+            try:
+                await bot.copy_message(chat_id=int(user_id), from_chat_id=from_chat_id, message_id=message_id)
+                result["sent"] += 1
+            except Exception as e:
+                kind = classify_error(e)
+                result["error_kinds"][kind] = result["error_kinds"].get(kind, 0) + 1
+                if kind == ERROR_FLOOD:
+                    logging.warning(f"Рассылка: превышен лимит Telegram, пауза {e.retry_after} с")
+                    broadcast_bucket.pause(e.retry_after)
+                    queue.put_nowait(user_id)
+                    continue
+                if kind == ERROR_TRANSIENT and retries.get(user_id, 0) < BROADCAST_TRANSIENT_RETRIES:
+                    retries[user_id] = retries.get(user_id, 0) + 1
+                    queue.put_nowait(user_id)
+                    continue
+                if kind in PERMANENT_ERRORS:
+                    logging.info(f"Рассылка: пользователь {user_id} недоступен ({kind})")
+                    result["dead"][user_id] = kind
+                else:
+                    logging.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
+                result["errors"] += 1
+
+            if progress:
+                await progress(result)
+
+    await asyncio.gather(*(worker() for _ in range(BROADCAST_WORKERS)))
+    return result
+
+
+# Состояния задания рассылки
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_PAUSED = "paused"
+JOB_CANCELLED = "cancelled"
+JOB_DONE = "done"
+
+JOB_STATUS_NAMES = {
+    JOB_QUEUED: "⏳ в очереди",
+    JOB_RUNNING: "▶️ выполняется",
+    JOB_PAUSED: "⏸ приостановлена",
+    JOB_CANCELLED: "❌ отменена",
+    JOB_DONE: "✅ завершена",
+}
+
+# Будит исполнителя, когда появляется или возобновляется задание
+_jobs_changed = asyncio.Event()
+
+
+def _save_job(job_id: str) -> None:
+    schedule_save(BROADCAST_JOBS_FILE, keys=(job_id,))
+
+
+def create_job(from_chat_id: int, message_id: int, recipients: list[str], chat_id: int,
+               progress_message_id: int | None = None) -> str:
+    """
+    Создаёт задание рассылки и ставит его в очередь. chat_id и progress_message_id -
+    чат администратора и сообщение, в котором показывается прогресс.
+    """
+    job_id = str(max((int(key) for key in broadcast_jobs), default=0) + 1)
+    broadcast_recipients[job_id] = {"users": list(recipients)}
+    schedule_save(BROADCAST_RECIPIENTS_FILE, keys=(job_id,))
+    broadcast_jobs[job_id] = {
+        "status": JOB_QUEUED,
+        "from_chat_id": from_chat_id,
+        "message_id": message_id,
+        "chat_id": chat_id,
+        "progress_message_id": progress_message_id,
+        "total": len(recipients),
+        "cursor": 0,
+        "sent": 0,
+        "errors": 0,
+        "error_kinds": {},
+        "removed": 0,
+        "created_at": int(time.time()),
+        "finished_at": None,
+    }
+    _save_job(job_id)
+    _jobs_changed.set()
+    return job_id
+
+
+def _cleanup_job(job_id: str) -> None:
+    """
+    Удаляет список получателей и контрольную точку завершённого задания
+    """
+    if broadcast_recipients.pop(job_id, None) is not None:
+        schedule_save(BROADCAST_RECIPIENTS_FILE, keys=(job_id,))
+    prefix = f"{job_id}:"
+    keys = [key for key in broadcast_sent if key.startswith(prefix)]
+    broadcast_sent.difference_update(keys)
+    if keys:
+        schedule_save(BROADCAST_SENT_FILE, keys=keys)
+
+
+def pause_job(job_id: str) -> bool:
+    job = broadcast_jobs.get(job_id)
+    if job is None or job["status"] not in (JOB_QUEUED, JOB_RUNNING):
+        return False
+    # Выполняющееся задание остановится после текущей пачки
+    job["status"] = JOB_PAUSED
+    _save_job(job_id)
+    return True
+
+
+def resume_job(job_id: str) -> bool:
+    job = broadcast_jobs.get(job_id)
+    if job is None or job["status"] != JOB_PAUSED:
+        return False
+    job["status"] = JOB_QUEUED
+    job.pop("error", None)
+    _save_job(job_id)
+    _jobs_changed.set()
+    return True
+
+
+def cancel_job(job_id: str) -> bool:
+    job = broadcast_jobs.get(job_id)
+    if job is None or job["status"] in (JOB_DONE, JOB_CANCELLED):
+        return False
+    job["status"] = JOB_CANCELLED
+    job["finished_at"] = int(time.time())
+    _save_job(job_id)
+    _cleanup_job(job_id)
+    return True
+
+
+def job_text(job_id: str) -> str:
+    job = broadcast_jobs[job_id]
+    processed = job["sent"] + job["errors"]
+    text = (
+        f"📨 <b>Рассылка #{job_id}</b>: {JOB_STATUS_NAMES.get(job['status'], job['status'])}\n\n"
+        f"- Обработано: {processed}/{job['total']}\n"
+        f"- Успешно отправлено: {job['sent']}\n"
+        f"- Ошибок: {job['errors']}"
+    )
+    for kind, count in job.get("error_kinds", {}).items():
+        text += f"\n  • {ERROR_NAMES.get(kind, kind)}: {count}"
+    if job.get("removed"):
+        text += f"\n- Отключено недоступных пользователей: {job['removed']}"
+    if job.get("error"):
+        text += f"\n\n⚠️ {job['error']}"
+    return text
+
+
+def job_keyboard(job_id: str) -> InlineKeyboardMarkup | None:
+    status = broadcast_jobs[job_id]["status"]
+    buttons = []
+    if status in (JOB_QUEUED, JOB_RUNNING):
+        buttons.append(InlineKeyboardButton(text="⏸ Пауза", callback_data=f"broadcast_pause:{job_id}"))
+    elif status == JOB_PAUSED:
+        buttons.append(InlineKeyboardButton(text="▶️ Продолжить", callback_data=f"broadcast_resume:{job_id}"))
+    if status in (JOB_QUEUED, JOB_RUNNING, JOB_PAUSED):
+        buttons.append(InlineKeyboardButton(text="❌ Отменить", callback_data=f"broadcast_stop:{job_id}"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+
+
+async def show_job_progress(job_id: str) -> None:
+    """
+    Обновляет сообщение с прогрессом задания у администратора
+    """
+    job = broadcast_jobs[job_id]
+    if not job.get("progress_message_id"):
+        return
+    try:
+        await bot.edit_message_text(
+            job_text(job_id),
+            chat_id=job["chat_id"],
+            message_id=job["progress_message_id"],
+            reply_markup=job_keyboard(job_id)
+        )
+    except Exception as e:
+        logging.debug(f"Не удалось обновить прогресс рассылки #{job_id}: {e}")
+
+
+async def _run_job(job_id: str) -> None:
+    job = broadcast_jobs[job_id]
+    recipients = broadcast_recipients.get(job_id, {}).get("users", [])
+    job["status"] = JOB_RUNNING
+    _save_job(job_id)
+    logging.info(f"Рассылка #{job_id}: старт с позиции {job['cursor']} из {len(recipients)}")
+    last_update = 0.0
+
+    while job["cursor"] < len(recipients) and job["status"] == JOB_RUNNING:
+        # Контрольная точка: отмечаем пачку до отправки и дожидаемся записи на диск
+        start = job["cursor"]
+        batch = [user_id for user_id in recipients[start:start + BROADCAST_CHECKPOINT_SIZE]
+                 if f"{job_id}:{user_id}" not in broadcast_sent]
+        keys = [f"{job_id}:{user_id}" for user_id in batch]
+        broadcast_sent.update(keys)
+        if keys:
+            schedule_save(BROADCAST_SENT_FILE, keys=keys)
+        job["cursor"] = min(start + BROADCAST_CHECKPOINT_SIZE, len(recipients))
+        _save_job(job_id)
+
+        attempted = set()
+        try:
+            if not await save_now(BROADCAST_SENT_FILE, BROADCAST_JOBS_FILE):
+                raise RuntimeError("не удалось сохранить контрольную точку рассылки")
+            result = await run_broadcast(job["from_chat_id"], job["message_id"], batch, attempted=attempted)
+        except (asyncio.CancelledError, Exception):
+            # Остановка бота (в том числе во время записи контрольной точки) или ошибка:
+            # снимаем отметки с тех, кому отправка ещё не начиналась, и возвращаем курсор
+            keys = [f"{job_id}:{user_id}" for user_id in batch if user_id not in attempted]
+            broadcast_sent.difference_update(keys)
+            if keys:
+                schedule_save(BROADCAST_SENT_FILE, keys=keys)
+            job["cursor"] = start
+            _save_job(job_id)
+            raise
+        job["sent"] += result["sent"]
+        job["errors"] += result["errors"]
+        error_kinds = job.setdefault("error_kinds", {})
+        for kind, count in result["error_kinds"].items():
+            error_kinds[kind] = error_kinds.get(kind, 0) + count
+        job["removed"] = job.get("removed", 0) + prune_recipients(result["dead"])
+        _save_job(job_id)
+
+        # Курсор уже за пачкой, её отметки больше не нужны. Множество отметок не
+        # превышает одной пачки, поэтому запись контрольной точки не растёт с размером
+        # рассылки (в JSON файл отметок переписывается целиком)
+        done = [key for key in (f"{job_id}:{user_id}" for user_id in recipients[start:job["cursor"]])
+                if key in broadcast_sent]
+        broadcast_sent.difference_update(done)
+        if done:
+            schedule_save(BROADCAST_SENT_FILE, keys=done)
+
+        now = time.monotonic()
+        if now - last_update >= BROADCAST_PROGRESS_INTERVAL:
+            last_update = now
+            await show_job_progress(job_id)
+
+    if job["status"] != JOB_RUNNING:
+        # Приостановлено или отменено из админ-панели, в том числе во время последней пачки
+        await show_job_progress(job_id)
+        return
+
+    job["status"] = JOB_DONE
+    job["finished_at"] = int(time.time())
+    _save_job(job_id)
+    _cleanup_job(job_id)
+    logging.info(f"Рассылка #{job_id} завершена: отправлено {job['sent']}, ошибок {job['errors']}")
+    await show_job_progress(job_id)
+
+
+def prune_recipients(dead: dict[str, str]) -> int:
+    """
+    Отключает пользователей с постоянными ошибками доставки (одной записью на пачку).
+    Возвращает количество отключённых.
+    """
+    removed = []
+    for user_id, kind in dead.items():
+        record = users_data.get(user_id)
+        if isinstance(record, dict) and record.get("status") == "active":
+            set_user_status(user_id, "removed", reason=kind)
+            removed.append(user_id)
+    if removed:
+        save_users_data(users_data, *removed)
+        logging.info(f"Рассылка: отключено недоступных пользователей: {len(removed)}")
+    return len(removed)
+
+
+def _next_job() -> str | None:
+    """
+    Самое раннее задание, ожидающее выполнения
+    """
+    return min((job_id for job_id, job in broadcast_jobs.items() if job["status"] in (JOB_QUEUED, JOB_RUNNING)),
+               key=int, default=None)
+
+
+async def run_broadcast_jobs() -> None:
+    """
+    Фоновая задача: выполняет задания рассылок по очереди.
+    Задания, прерванные остановкой бота, продолжаются при следующем запуске.
+    """
+    while True:
+        job_id = _next_job()
+        if job_id is None:
+            _jobs_changed.clear()
+            await _jobs_changed.wait()
+            continue
+        try:
+            await _run_job(job_id)
+        except Exception as e:
+            logging.exception(f"Ошибка выполнения рассылки #{job_id}: {e}")
+            job = broadcast_jobs[job_id]
+            job["status"] = JOB_PAUSED
+            job["error"] = f"Рассылка приостановлена из-за ошибки: {e}"
+            _save_job(job_id)
+            await show_job_progress(job_id)
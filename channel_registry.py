@@ -0,0 +1,113 @@
+# channel_registry.py
+# Список обязательных каналов с индексом по ID.
+#
+# Каналы хранятся в порядке добавления (так они показываются пользователям),
+# а для поиска по ID поддерживается словарь с ключом int(id): обработчик
+# chat_member получает ID чата числом и проверяет его за O(1) без перебора списка.
+#
+# Все изменения проходят через add / update / remove: они перестраивают индекс,
+# увеличивают version и сохраняют файл. Зависимые кэши (клавиатура подписки)
+# сравнивают version и пересобираются только после изменения списка.
+import logging
+from utils import load_json_data, save_json_data
+
+
+def _to_int(channel_id) -> int | None:
+    try:
+        return int(channel_id)
+    except (TypeError, ValueError):
+        return None
+
+
+class ChannelRegistry:
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.channels: list[dict] = []
+        self.version = 0
+        # int(id) -> канал
+        self._by_id: dict[int, dict] = {}
+        # Каналы с корректным ID, в порядке списка
+        self._checkable: list[dict] = []
+        self.reload()
+
+    def reload(self) -> None:
+        """
+        Загружает список каналов из файла
+        """
+        channels = load_json_data(self.filename).get("channels", [])
+        self.channels = [channel for channel in channels if isinstance(channel, dict)]
+        self._reindex(warn=True)
+
+    def _reindex(self, warn: bool = False) -> None:
+        self._by_id.clear()
+        self._checkable = []
+        for channel in self.channels:
+            channel_id = _to_int(channel.get("id"))
+            if channel_id is None:
+                if warn:
+                    logging.warning(f"Обязательный канал без корректного ID: {channel}")
+                continue
+            if channel_id in self._by_id:
+                if warn:
+                    logging.warning(f"Обязательный канал {channel_id} указан несколько раз")
+                continue
+            self._by_id[channel_id] = channel
+            self._checkable.append(channel)
+        self.version += 1
+
+    def _changed(self) -> None:
+        self._reindex()
+        save_json_data(self.filename, {"channels": self.channels})
+
+    def __iter__(self):
+        return iter(self.channels)
+
+    def __len__(self) -> int:
+        return len(self.channels)
+
+    def __contains__(self, channel_id) -> bool:
+        return _to_int(channel_id) in self._by_id
+
+    def get(self, channel_id) -> dict | None:
+        """
+        Канал по ID (строкой или числом) или None
+        """
+        return self._by_id.get(_to_int(channel_id))
+
+    def checkable(self) -> list[dict]:
+        """
+        Каналы, подписку на которые можно проверить (с корректным и уникальным ID)
+        """
+        return self._checkable
+
+    def add(self, channel: dict) -> bool:
+        """
+        Добавляет канал. Возвращает False, если канал с таким ID уже есть.
+        """
+        if channel.get("id") in self:
+            return False
+        self.channels.append(channel)
+        self._changed()
+        return True
+
+    def update(self, channel_id, **fields) -> dict | None:
+        """
+        Изменяет поля канала (в том числе id). Возвращает канал или None, если его нет.
+        """
+        channel = self.get(channel_id)
+        if channel is None:
+            return None
+        channel.update(fields)
+        self._changed()
+        return channel
+
+    def remove(self, channel_id) -> dict | None:
+        """
+        Удаляет канал. Возвращает удалённый канал или None, если его нет.
+        """
+        channel = self.get(channel_id)
+        if channel is None:
+            return None
+        self.channels.remove(channel)
+        self._changed()
+        return channel
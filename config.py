@@ -6,3 +6,59 @@ CREDITED_REFERRALS_FILE = "data/credited_referrals.json"
 STARS_PER_REFERRAL = 2  # Значение по умолчанию - 2 звезды за реферала
 REQUIRED_CHANNELS_FILE = "data/required_channels.json"  # Файл для хранения обязательных каналов
 CAPTCHA_PASSED_REFERRALS_FILE = "data/captcha_passed_referrals.json"
+
+# Отложенная запись данных на диск
+SAVE_FLUSH_INTERVAL = 2.0  # Интервал сброса изменённых данных, в секундах
+SAVE_MAX_PENDING_WRITES = 200  # Сбрасывать сразу, если накопилось столько изменений
+
+# Способ хранения данных: "json" - JSON-файлы (подходит для небольших установок),
+# "sqlite" - база SQLite с построчной записью изменений,
+# "journal" - JSON-файлы с журналом изменений (см. JOURNAL_* ниже)
+STORAGE_BACKEND = "json"
+SQLITE_DB_FILE = "data/bot.db"
+
+# Режим "journal": журнал изменений и периодическая пересборка JSON-файлов
+JOURNAL_FILE = "data/journal.log"
+JOURNAL_COMPACT_SIZE = 5 * 1024 * 1024  # Пересобирать файлы, когда журнал превысит этот размер, в байтах
+JOURNAL_FSYNC = False  # Принудительно сбрасывать журнал на диск после каждой записи (медленнее, надёжнее)
+
+# Выгрузки пользователей и рефералов (/export)
+EXPORT_PART_SIZE = 45 * 1024 * 1024  # Максимальный размер одной части архива (лимит Telegram для ботов - 50 МБ)
+EXPORT_BATCH_SIZE = 5000  # Сколько строк формируется за один шаг без передачи управления циклу событий
+
+# Настройки, изменяемые из админ-панели (см. runtime_config.py)
+RUNTIME_CONFIG_FILE = "data/config.json"
+RUNTIME_CONFIG_CHECK_INTERVAL = 5.0  # Как часто проверять, не изменён ли файл вручную, в секундах
+
+# Кэш проверок подписки на обязательные каналы
+MEMBERSHIP_CACHE_TTL = 300  # Сколько секунд доверять подтверждённой подписке
+MEMBERSHIP_CACHE_NEGATIVE_TTL = 10  # Сколько секунд помнить, что пользователь не подписан
+MEMBERSHIP_CACHE_SIZE = 100_000  # Максимальное число записей (пользователь, канал)
+MEMBERSHIP_CHECK_CONCURRENCY = 20  # Сколько запросов get_chat_member может выполняться одновременно
+MEMBERSHIP_CHECK_TIMEOUT = 3.0  # Сколько секунд ждать ответа get_chat_member (включая повторный запрос)
+MEMBERSHIP_HEDGE_ENABLED = True  # Отправлять повторный запрос, если первый отвечает дольше обычного (p95)
+MEMBERSHIP_HEDGE_MIN_DELAY = 0.5  # Не раньше скольких секунд отправлять повторный запрос
+MEMBERSHIP_LATENCY_SAMPLES = 1000  # По скольким последним запросам считать p50/p95/p99
+
+# Таблица подписок, которая ведётся по обновлениям chat_member (см. data.channel_members)
+CHANNEL_MEMBERS_FILE = "data/channel_members.json"
+CHANNEL_MEMBERS_MAX_AGE = 7 * 24 * 3600  # Через сколько секунд запись считается устаревшей и перепроверяется через API
+
+# Приостановка проверок канала, запросы к которому постоянно завершаются ошибкой
+# (бот лишился прав администратора, неверный ID канала)
+CHANNEL_FAILURE_THRESHOLD = 5  # После скольких ошибок подряд проверки канала приостанавливаются
+CHANNEL_RETRY_INTERVAL = 60  # Через сколько секунд выполнить пробный запрос к приостановленному каналу
+CHANNEL_FAILURE_POLICY = "block"  # "block" - считать пользователя неподписанным, "skip" - не требовать подписку на канал
+
+# Рассылки (см. broadcast.py)
+BROADCAST_RATE = 25  # Сообщений в секунду на всего бота (лимит Bot API - около 30)
+BROADCAST_BURST = 5  # Сколько сообщений можно отправить подряд без паузы
+BROADCAST_WORKERS = 10  # Сколько сообщений рассылки отправляется одновременно
+BROADCAST_CHAT_INTERVAL = 1.0  # Не чаще одного сообщения в чат за столько секунд (при повторах)
+BROADCAST_PROGRESS_INTERVAL = 3.0  # Как часто обновлять сообщение с прогрессом, в секундах
+BROADCAST_TRANSIENT_RETRIES = 1  # Сколько раз повторять отправку после временной ошибки (сеть, сервер Telegram)
+BROADCAST_CHECKPOINT_SIZE = 100  # Сколько получателей отмечается в контрольной точке перед отправкой
+BROADCAST_JOBS_FILE = "data/broadcast_jobs.json"
+BROADCAST_RECIPIENTS_FILE = "data/broadcast_recipients.json"
+BROADCAST_SENT_FILE = "data/broadcast_sent.json"
+SCHEDULED_BROADCASTS_FILE = "data/scheduled_broadcasts.json"  # Запланированные рассылки (см. scheduler.py)
@@ -1,58 +1,215 @@
-from utils import load_referral_data, load_users_data, load_json_data, save_json_data
-from config import CREDITED_REFERRALS_FILE, STARS_PER_REFERRAL, REQUIRED_CHANNELS_FILE
-from config import CAPTCHA_PASSED_REFERRALS_FILE
+import time
+from config import CREDITED_REFERRALS_FILE, REQUIRED_CHANNELS_FILE
+from config import CAPTCHA_PASSED_REFERRALS_FILE, REFERRALS_FILE, USERS_FILE, CHANNEL_MEMBERS_FILE
+from config import CHANNEL_MEMBERS_MAX_AGE
+from config import BROADCAST_JOBS_FILE, BROADCAST_RECIPIENTS_FILE, BROADCAST_SENT_FILE, SCHEDULED_BROADCASTS_FILE
+from storage import open_store, schedule_save, schedule_member_save
+from channel_registry import ChannelRegistry
 
-referral_data = load_referral_data()
-users_data = load_users_data()
+
+def _member_sets(field: str):
+    """
+    Возвращает функцию, которая при загрузке превращает списки в поле field
+    каждой записи в множества. На диске коллекции по-прежнему хранятся списками
+    (множества сериализуются в списки в save_json_data).
+    """
+    def decode(records: dict) -> dict:
+        for record in records.values():
+            if isinstance(record, dict):
+                record[field] = set(record.get(field) or ())
+        return records
+    return decode
+
+# Данные загружаются через слой хранения (JSON-файлы или SQLite, см. STORAGE_BACKEND)
+referral_data = open_store(
+    "referrals", REFERRALS_FILE, layout="rows", columns=("count",),
+    member_field="referral_activations", member_table="referral_activations",
+    decode=_member_sets("referral_activations")
+)
+users_data = open_store("users", USERS_FILE, layout="rows", columns=("status", "stars"))
+
+# Обратный индекс: приглашённый пользователь -> реферер.
+# Строится один раз при загрузке и поддерживается через add_referral_activation.
+referrer_index = {}
+
+
+def rebuild_referrer_index() -> None:
+    """
+    Перестраивает обратный индекс рефералов по данным referral_data
+    """
+    referrer_index.clear()
+    for referrer_id, info in referral_data.items():
+        if not isinstance(info, dict):
+            continue
+        for user_id in info.get("referral_activations", []):
+            # Если пользователь есть у нескольких рефереров, засчитывается первый
+            referrer_index.setdefault(user_id, referrer_id)
+
+
+def get_referrer(user_id: str) -> str | None:
+    """
+    Возвращает ID реферера, по ссылке которого пришёл пользователь, или None
+    """
+    return referrer_index.get(user_id)
+
+
+def add_referral_activation(referrer_id: str, user_id: str) -> bool:
+    """
+    Добавляет пользователя в список активаций реферера и обновляет обратный индекс.
+    Возвращает True, если пользователь был добавлен, и False, если он уже был в списке.
+    """
+    activations = referral_data[referrer_id].setdefault("referral_activations", set())
+    referrer_index.setdefault(user_id, referrer_id)
+    if user_id in activations:
+        return False
+    activations.add(user_id)
+    # Сохраняется только новый элемент, а не всё множество активаций
+    schedule_member_save(REFERRALS_FILE, referrer_id, user_id)
+    return True
+
+
+rebuild_referrer_index()
 
 # Загружаем список пользователей, прошедших капчу
-captcha_data = load_json_data(CAPTCHA_PASSED_REFERRALS_FILE)
-captcha_passed_referrals = set(captcha_data.get("passed", []))
+captcha_passed_referrals = open_store(
+    "captcha_passed_referrals", CAPTCHA_PASSED_REFERRALS_FILE, layout="set",
+    decode=lambda raw: set(raw.get("passed", [])),
+    encode=lambda passed: {"passed": list(passed)}
+)
 
-def save_captcha_passed_referrals():
+def save_captcha_passed_referrals(*user_ids):
     """
-    Сохраняет список пользователей, прошедших капчу
+    Сохраняет список пользователей, прошедших капчу.
+    Если переданы user_ids, сохраняются только изменения по этим пользователям.
     """
-    save_json_data(CAPTCHA_PASSED_REFERRALS_FILE, {"passed": list(captcha_passed_referrals)})
+    schedule_save(CAPTCHA_PASSED_REFERRALS_FILE, keys=user_ids)
 
 # Загружаем список пользователей, для которых уже был засчитан реферал,
 # и преобразуем его в множество для быстрого поиска.
-credited_data = load_json_data(CREDITED_REFERRALS_FILE)
-credited_referrals = set(credited_data.get("credited", []))
+credited_referrals = open_store(
+    "credited_referrals", CREDITED_REFERRALS_FILE, layout="set",
+    decode=lambda raw: set(raw.get("credited", [])),
+    encode=lambda credited: {"credited": list(credited)}
+)
 
-# Загружаем текущее количество звёзд за подписку
-stars_config = load_json_data("data/config.json")
-stars_per_referral = stars_config.get("stars_per_referral", STARS_PER_REFERRAL)
+# Подписки на обязательные каналы, известные из обновлений chat_member.
+# Ключ - "channel_id:user_id", значение - {"member": bool, "source": "event"/"api", "updated_at": время}.
+# Хранятся только пользователи бота: остальная аудитория канала проверки подписки не проходит.
+channel_members = open_store("channel_members", CHANNEL_MEMBERS_FILE, layout="rows", columns=("member",))
+
+# Индекс подписчиков: channel_id -> множество ID пользователей, подписанных на канал (по таблице channel_members)
+channel_member_index: dict[str, set[str]] = {}
+
+
+def _membership_key(channel_id, user_id) -> str:
+    return f"{channel_id}:{user_id}"
 
-# Загружаем список активных промокодов
-promocodes_data = load_json_data("data/promocodes.json")
-promocodes = promocodes_data.get("promocodes", {})
 
-# Загружаем список обязательных каналов для подписки
-required_channels_data = load_json_data(REQUIRED_CHANNELS_FILE)
-required_channels = required_channels_data.get("channels", [])
+def rebuild_channel_member_index() -> None:
+    channel_member_index.clear()
+    for key, record in channel_members.items():
+        if isinstance(record, dict) and record.get("member"):
+            channel_id, user_id = key.split(":", 1)
+            channel_member_index.setdefault(channel_id, set()).add(user_id)
 
-def save_credited_referrals():
-    from utils import save_json_data
-    save_json_data(CREDITED_REFERRALS_FILE, {"credited": list(credited_referrals)})
 
-def save_stars_config():
-    from utils import save_json_data
-    save_json_data("data/config.json", {"stars_per_referral": stars_per_referral})
+def prune_channel_members() -> int:
+    """
+    Удаляет записи пользователей, которых нет в users_data. Возвращает количество удалённых.
+    """
+    keys = [key for key in channel_members if key.split(":", 1)[1] not in users_data]
+    for key in keys:
+        del channel_members[key]
+    if keys:
+        schedule_save(CHANNEL_MEMBERS_FILE, keys=keys)
+        rebuild_channel_member_index()
+    return len(keys)
+
+
+def set_channel_membership(channel_id, user_id, is_member: bool, source: str = "event") -> None:
+    """
+    Записывает статус подписки пользователя бота на канал.
+    source="event" - статус из обновления chat_member, "api" - из запроса get_chat_member.
+    """
+    if str(user_id) not in users_data:
+        return
+    key = _membership_key(channel_id, user_id)
+    now = int(time.time())
+    record = channel_members.get(key)
+    # Тот же статус не перезаписываем, пока запись не устарела наполовину:
+    # обновлять время нужно лишь для того, чтобы записи продолжали доверять
+    if record and record.get("member") == is_member and record.get("source") == source \
+            and now - record.get("updated_at", 0) < CHANNEL_MEMBERS_MAX_AGE / 2:
+        return
+    channel_members[key] = {"member": is_member, "source": source, "updated_at": now}
+    schedule_save(CHANNEL_MEMBERS_FILE, keys=(key,))
+    if is_member:
+        channel_member_index.setdefault(str(channel_id), set()).add(str(user_id))
+    else:
+        channel_member_index.get(str(channel_id), set()).discard(str(user_id))
+
+
+def get_channel_membership(channel_id, user_id) -> dict | None:
+    return channel_members.get(_membership_key(channel_id, user_id))
+
+
+def get_channel_members(channel_id) -> set[str]:
+    """
+    Пользователи, подписанные на канал по данным таблицы channel_members
+    """
+    return channel_member_index.get(str(channel_id), set())
+
+
+def forget_channel_members(channel_id) -> None:
+    """
+    Удаляет все записи канала (при удалении канала или смене его ID)
+    """
+    channel_member_index.pop(str(channel_id), None)
+    prefix = f"{channel_id}:"
+    keys = [key for key in channel_members if key.startswith(prefix)]
+    for key in keys:
+        del channel_members[key]
+    if keys:
+        schedule_save(CHANNEL_MEMBERS_FILE, keys=keys)
+
+
+rebuild_channel_member_index()
+prune_channel_members()
+
+# Задания рассылок (см. broadcast.py): job_id -> {"status": ..., "cursor": ..., ...}
+broadcast_jobs = open_store("broadcast_jobs", BROADCAST_JOBS_FILE, layout="rows", columns=("status",))
+# Получатели рассылки: job_id -> {"users": [...]}, записываются один раз при создании задания
+broadcast_recipients = open_store("broadcast_recipients", BROADCAST_RECIPIENTS_FILE, layout="rows")
+# Контрольная точка рассылок: "job_id:user_id" для каждого получателя, которому сообщение уже отправлялось
+broadcast_sent = open_store(
+    "broadcast_sent", BROADCAST_SENT_FILE, layout="set",
+    decode=lambda raw: set(raw.get("sent", [])),
+    encode=lambda sent: {"sent": list(sent)}
+)
+# Запланированные рассылки (см. scheduler.py): schedule_id -> {"run_at": ..., "interval": ..., ...}
+scheduled_broadcasts = open_store("scheduled_broadcasts", SCHEDULED_BROADCASTS_FILE, layout="rows")
+
+
+# Загружаем список активных промокодов
+promocodes = open_store(
+    "promocodes", "data/promocodes.json", layout="rows",
+    member_field="used_by", member_table="promo_activations",
+    decode=lambda raw: _member_sets("used_by")(raw.get("promocodes", {})),
+    encode=lambda codes: {"promocodes": codes}
+)
+
+# Список обязательных каналов для подписки (изменяется через add / update / remove)
+required_channels = ChannelRegistry(REQUIRED_CHANNELS_FILE)
 
-def save_promocodes():
-    from utils import save_json_data
-    save_json_data("data/promocodes.json", {"promocodes": promocodes})
+def save_credited_referrals(*user_ids):
+    schedule_save(CREDITED_REFERRALS_FILE, keys=user_ids)
 
-def save_required_channels():
-    from utils import save_json_data
-    save_json_data(REQUIRED_CHANNELS_FILE, {"channels": required_channels})
+def save_promocodes(*codes):
+    schedule_save("data/promocodes.json", keys=codes)
 
-def update_stars_per_referral():
+def add_promo_activation(promo_code: str, user_id: str) -> None:
     """
-    Обновляет значение звезд за реферала из файла конфигурации
+    Добавляет пользователя в used_by промокода (сохраняется только новый элемент)
     """
-    global stars_per_referral
-    stars_config = load_json_data("data/config.json")
-    stars_per_referral = stars_config.get("stars_per_referral", STARS_PER_REFERRAL)
-    return stars_per_referral
\ No newline at end of file
+    promocodes[promo_code].setdefault("used_by", set()).add(user_id)
+    schedule_member_save("data/promocodes.json", promo_code, user_id)
@@ -0,0 +1,163 @@
+# exports.py
+# Потоковые выгрузки пользователей и рефералов в сжатые файлы CSV / JSONL.
+#
+# Строки формируются пачками по EXPORT_BATCH_SIZE в цикле событий (данные
+# изменяются только в нём), а сжатие и запись пачки выполняются в пуле потоков.
+# В памяти одновременно находится не больше одной пачки, бот не замирает.
+# Если архив превышает EXPORT_PART_SIZE, выгрузка продолжается в следующую часть.
+import io
+import os
+import csv
+import gzip
+import json
+import shutil
+import asyncio
+import tempfile
+from config import EXPORT_PART_SIZE, EXPORT_BATCH_SIZE
+from data import users_data, referral_data
+
+FORMATS = ("csv", "jsonl")
+
+# Оценка сверху для данных, ещё не дошедших до файла части: буферы TextIOWrapper
+# и GzipFile и незавершённый блок zlib занимают не больше нескольких сотен КБ
+PENDING_ESTIMATE = 1024 * 1024
+
+# Доступные колонки: имя -> функция (user_id, запись) -> значение
+USER_COLUMNS = {
+    "id": lambda user_id, info: user_id,
+    "username": lambda user_id, info: info.get("username", "Неизвестно"),
+    "status": lambda user_id, info: info.get("status", "Неизвестно"),
+    "stars": lambda user_id, info: info.get("stars", 0),
+    "removed_reason": lambda user_id, info: info.get("removed_reason", ""),
+    "link": lambda user_id, info: f"tg://user?id={user_id}",
+}
+
+REFERRAL_COLUMNS = {
+    "id": lambda user_id, info: user_id,
+    "username": lambda user_id, info: info.get("username", "Неизвестно"),
+    "count": lambda user_id, info: info.get("count", 0),
+    "stars": lambda user_id, info: users_data.get(user_id, {}).get("stars", 0),
+    "bot_link": lambda user_id, info: info.get("bot_link", ""),
+}
+
+EXPORTS = {
+    "users": (users_data, USER_COLUMNS),
+    "referrals": (referral_data, REFERRAL_COLUMNS),
+}
+
+
+class ExportError(ValueError):
+    pass
+
+
+class PartWriter:
+    """
+    Пишет строки в gzip-архивы, начиная новую часть при превышении part_size.
+    Все методы, кроме конструктора, вызываются из пула потоков.
+    """
+
+    def __init__(self, directory: str, name: str, fmt: str, columns: list[str], part_size: int):
+        self.directory = directory
+        self.name = name
+        self.fmt = fmt
+        self.columns = columns
+        self.part_size = part_size
+        self.paths: list[str] = []
+        self.raw = None
+        self.text = None
+        self.csv_writer = None
+
+    def _open_part(self) -> None:
+        path = os.path.join(self.directory, f"{self.name}_{len(self.paths) + 1}.{self.fmt}.gz")
+        self.paths.append(path)
+        self.raw = open(path, "wb")
+        self.text = io.TextIOWrapper(gzip.GzipFile(fileobj=self.raw, mode="wb"), encoding="utf-8", newline="")
+        if self.fmt == "csv":
+            self.csv_writer = csv.writer(self.text)
+            self.csv_writer.writerow(self.columns)
+
+    def _close_part(self) -> None:
+        if self.text is not None:
+            # Закрытие обёртки дописывает конец gzip-потока, сам файл закрываем отдельно
+            self.text.close()
+            self.raw.close()
+            self.text = self.raw = self.csv_writer = None
+
+    def write_rows(self, rows: list[list]) -> None:
+        if self.text is None:
+            self._open_part()
+        for row in rows:
+            if self.fmt == "csv":
+                self.csv_writer.writerow(row)
+            else:
+                self.text.write(json.dumps(dict(zip(self.columns, row)), ensure_ascii=False) + "\n")
+        # Компрессор не сбрасываем: принудительный сброс после каждой пачки ухудшает
+        # сжатие. Размер части оценивается сверху: записанное в файл плюс PENDING_ESTIMATE
+        if self.raw.tell() + PENDING_ESTIMATE >= self.part_size:
+            self._close_part()
+
+    def close(self) -> list[str]:
+        if not self.paths:
+            # Пустая выгрузка: один файл (для CSV - только заголовок)
+            self._open_part()
+        self._close_part()
+        return self.paths
+
+
+def parse_columns(kind: str, columns: str | None) -> list[str]:
+    """
+    Разбирает список колонок через запятую. Пустое значение - все колонки.
+    """
+    available = EXPORTS[kind][1]
+    if not columns:
+        return list(available)
+    selected = [column.strip() for column in columns.split(",") if column.strip()]
+    unknown = [column for column in selected if column not in available]
+    if unknown or not selected:
+        raise ExportError(
+            f"Неизвестные колонки: {', '.join(unknown) or '-'}. Доступны: {', '.join(available)}"
+        )
+    return selected
+
+
+async def run_export(kind: str, fmt: str = "csv", columns: list[str] | None = None,
+                     progress=None) -> tuple[str, list[str]]:
+    """
+    Выгружает данные kind ("users" / "referrals") во временный каталог.
+    progress - необязательная корутина progress(обработано, всего), вызывается после каждой пачки.
+    Возвращает (каталог, список файлов частей). Каталог удаляет вызывающий код.
+    """
+    if kind not in EXPORTS:
+        raise ExportError(f"Неизвестная выгрузка: {kind}. Доступны: {', '.join(EXPORTS)}")
+    if fmt not in FORMATS:
+        raise ExportError(f"Неизвестный формат: {fmt}. Доступны: {', '.join(FORMATS)}")
+
+    records, available = EXPORTS[kind]
+    columns = columns or list(available)
+    getters = [available[column] for column in columns]
+
+    directory = tempfile.mkdtemp(prefix=f"export_{kind}_")
+    writer = PartWriter(directory, kind, fmt, columns, EXPORT_PART_SIZE)
+
+    # Список ключей фиксирует набор записей: словарь может меняться между пачками
+    user_ids = list(records)
+    total = len(user_ids)
+    try:
+        for start in range(0, total, EXPORT_BATCH_SIZE):
+            rows = []
+            for user_id in user_ids[start:start + EXPORT_BATCH_SIZE]:
+                info = records.get(user_id)
+                if isinstance(info, dict):
+                    rows.append([getter(user_id, info) for getter in getters])
+            await asyncio.to_thread(writer.write_rows, rows)
+            if progress:
+                await progress(min(start + EXPORT_BATCH_SIZE, total), total)
+        paths = await asyncio.to_thread(writer.close)
+    except BaseException:
+        remove_export(directory)
+        raise
+    return directory, paths
+
+
+def remove_export(directory: str) -> None:
+    shutil.rmtree(directory, ignore_errors=True)
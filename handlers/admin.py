@@ -1,25 +1,33 @@
 # handlers/admin.py
-import os
-import tempfile
+import time
 import asyncio
 import logging
+from datetime import datetime
 from aiogram import types, F
 from aiogram.filters import Command, CommandStart
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile, ChatAdministratorRights
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from bot import bot, router
+from bot import bot, router, get_bot_id, get_referral_link
 from config import ADMIN_IDS
 from data import (
-    referral_data, users_data, stars_per_referral, save_stars_config,
-    promocodes, save_promocodes, required_channels, save_required_channels
+    referral_data, users_data,
+    promocodes, save_promocodes, required_channels, add_referral_activation
 )
 from utils import get_invite_word, save_referral_data, get_stars_word, save_users_data
+from stats import get_counters, add_user_stars
+from runtime_config import get_stars_per_referral, set_stars_per_referral
+import ranking
+from ranking import add_referrer, increment_count
+from handlers.subscription import invalidate_channel, get_membership_cache_stats, get_channel_health, \
+    reset_channel_health, get_membership_latency_stats
 
 
 class AdminStates(StatesGroup):
     waiting_for_stars_value = State()
     waiting_for_broadcast = State()
+    waiting_for_segment_value = State()
+    waiting_for_schedule_time = State()
     waiting_for_promo_code = State()
     waiting_for_promo_stars = State()
     waiting_for_promo_limit = State()
@@ -32,10 +40,11 @@ class AdminStates(StatesGroup):
 # Изменяем приоритет команды admin, чтобы она обрабатывалась в первую очередь
 @router.message(Command("admin"), F.from_user.id.in_(ADMIN_IDS))
 async def cmd_admin(message: types.Message) -> None:
-    total_users = len(users_data)
-    active_users = sum(1 for u in users_data.values() if u.get("status") == "active")
-    removed_users = sum(1 for u in users_data.values() if u.get("status") == "removed")
-    total_stars = sum(u.get("stars", 0) for u in users_data.values())
+    counters = get_counters()
+    total_users = counters["total_users"]
+    active_users = counters["active_users"]
+    removed_users = counters["removed_users"]
+    total_stars = counters["total_stars"]
     total_channels = len(required_channels)
 
     admin_text = (
@@ -44,7 +53,7 @@ async def cmd_admin(message: types.Message) -> None:
         f"Активных пользователей: <b>{active_users}</b>\n"
         f"Удалили бота: <b>{removed_users}</b>\n"
         f"Всего звезд в обороте: <b>{total_stars}</b>\n"
-        f"Звезд за подписку: <b>{stars_per_referral}</b>\n"
+        f"Звезд за подписку: <b>{get_stars_per_referral()}</b>\n"
         f"Обязательных каналов: <b>{total_channels}</b>\n\n"
         "Выберите действие:"
     )
@@ -54,178 +63,178 @@ async def cmd_admin(message: types.Message) -> None:
         [InlineKeyboardButton(text="⭐ Изменить кол-во звезд за подписку", callback_data="change_stars_value")],
         [InlineKeyboardButton(text="🎟 Создать промокод", callback_data="create_promo")],
         [InlineKeyboardButton(text="📢 Управление каналами", callback_data="manage_channels")],
-        [InlineKeyboardButton(text="💬 Создать рассылку", callback_data="create_broadcast")]
+        [InlineKeyboardButton(text="💬 Создать рассылку", callback_data="create_broadcast")],
+        [InlineKeyboardButton(text="📨 Рассылки", callback_data="broadcast_jobs")],
+        [InlineKeyboardButton(text="⏰ Запланированные рассылки", callback_data="scheduled_broadcasts")]
     ])
     await message.answer(admin_text, reply_markup=inline_kb)
 
 
+REFERRALS_PAGE_SIZE = 10
+
+
+def build_referrals_page(page: int) -> tuple[str, InlineKeyboardMarkup | None]:
+    """
+    Формирует страницу топа рефералов и клавиатуру для перехода между страницами
+    """
+    pages = max(1, (ranking.total() + REFERRALS_PAGE_SIZE - 1) // REFERRALS_PAGE_SIZE)
+    page = min(max(page, 1), pages)
+    offset = (page - 1) * REFERRALS_PAGE_SIZE
+    rows = ranking.top(REFERRALS_PAGE_SIZE, offset)
+    if not rows:
+        return "Топ рефералов отсутствует.", None
+
+    text = f"🏆 <b>Топ рефералов</b> (страница {page}/{pages}):\n\n"
+    for rank, (user_id, count) in enumerate(rows, start=offset + 1):
+        username = referral_data[user_id].get("username", "Неизвестно")
+        stars = users_data.get(user_id, {}).get("stars", 0)
+        text += f"{rank}. <a href='tg://user?id={user_id}'>{username}</a> — {count} {get_invite_word(count)}, {stars} {get_stars_word(stars)}\n"
+
+    buttons = []
+    if page > 1:
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"referrals_page:{page - 1}"))
+    if page < pages:
+        buttons.append(InlineKeyboardButton(text="Вперёд ➡️", callback_data=f"referrals_page:{page + 1}"))
+    markup = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return text, markup
+
+
 @router.message(Command("referrals"), F.from_user.id.in_(ADMIN_IDS))
 async def cmd_referrals(message: types.Message) -> None:
-    sorted_refs = sorted(referral_data.items(), key=lambda item: item[1].get("count", 0), reverse=True)
-    top10 = sorted_refs[:10]
-    if not top10:
-        text = "Топ рефералов отсутствует."
-    else:
-        text = "🏆 <b>Топ рефералов</b>:\n\n"
-        rank = 1
-        for user_id, info in top10:
-            username = info.get("username", "Неизвестно")
-            count = info.get("count", 0)
-            stars = users_data.get(user_id, {}).get("stars", 0)
-            text += f"{rank}. <a href='tg://user?id={user_id}'>{username}</a> — {count} {get_invite_word(count)}, {stars} {get_stars_word(stars)}\n"
-            rank += 1
-    await message.answer(text)
+    # /referrals [страница]
+    args = message.text.split()
+    page = int(args[1]) if len(args) > 1 and args[1].isdigit() else 1
+    text, markup = build_referrals_page(page)
+    await message.answer(text, reply_markup=markup)
 
 
-@router.callback_query(F.data == "download_referrals")
-async def callback_download_referrals(callback: types.CallbackQuery) -> None:
+@router.callback_query(F.data.startswith("referrals_page:"))
+async def callback_referrals_page(callback: types.CallbackQuery) -> None:
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("У вас нет доступа.", show_alert=True)
         return
 
-    lines = []
-    for user_id, info in referral_data.items():
-        username = info.get("username", "Неизвестно")
-        count = info.get("count", 0)
-        bot_link = info.get("bot_link", "")
-        stars = users_data.get(user_id, {}).get("stars", 0)
-        line = f"Имя: {username}, ID: {user_id}, Приглашено: {count} {get_invite_word(count)}, Звезд: {stars}, Ссылка: {bot_link}"
-        lines.append(line)
+    page = int(callback.data.split(":")[1])
+    text, markup = build_referrals_page(page)
+    await callback.message.edit_text(text, reply_markup=markup)
+    await callback.answer()
 
-    text_content = "\n".join(lines) if lines else "Статистика пуста."
 
-    with tempfile.NamedTemporaryFile(mode="w+", suffix=".txt", delete=False, encoding="utf-8") as tmp:
-        tmp.write(text_content)
-        tmp_path = tmp.name
+# Выгрузки выполняются фоновыми задачами, ссылки хранятся, чтобы задачи не удалил сборщик мусора
+_export_tasks = set()
 
-    document = FSInputFile(tmp_path)
-    await bot.send_document(
-        chat_id=callback.from_user.id,
-        document=document,
-        caption="Статистика по рефералам"
-    )
 
-    os.remove(tmp_path)
-    await callback.answer()
+async def send_export(chat_id: int, kind: str, fmt: str = "csv", columns: list[str] | None = None) -> None:
+    """
+    Формирует выгрузку (см. exports.py) и отправляет её частями, показывая прогресс
+    """
+    from exports import run_export, remove_export
 
+    captions = {"users": "Список всех пользователей", "referrals": "Статистика по рефералам"}
+    progress_message = await bot.send_message(chat_id, "⏳ Подготовка выгрузки...")
+    last_update = 0.0
 
-@router.callback_query(F.data == "download_users")
-async def callback_download_users(callback: types.CallbackQuery) -> None:
-    if callback.from_user.id not in ADMIN_IDS:
-        await callback.answer("У вас нет доступа.", show_alert=True)
+    async def progress(done: int, total: int) -> None:
+        nonlocal last_update
+        now = asyncio.get_running_loop().time()
+        # Не чаще раза в 2 секунды, чтобы не упираться в лимиты Telegram
+        if now - last_update < 2 and done < total:
+            return
+        last_update = now
+        try:
+            await progress_message.edit_text(f"⏳ Выгрузка: {done} из {total}")
+        except Exception as e:
+            logging.debug(f"Не удалось обновить прогресс выгрузки: {e}")
+
+    try:
+        directory, paths = await run_export(kind, fmt, columns, progress)
+    except Exception as e:
+        logging.exception(f"Ошибка выгрузки {kind}: {e}")
+        await progress_message.edit_text(f"❌ Ошибка выгрузки: {e}")
         return
 
-    lines = []
-    for user_id, info in users_data.items():
-        username = info.get("username", "Неизвестно")
-        status = info.get("status", "Неизвестно")
-        stars = info.get("stars", 0)
-        user_link = f"tg://user?id={user_id}"
-        line = f"Имя: {username}, Статус: {status}, Звезд: {stars}, Ссылка: {user_link}"
-        lines.append(line)
-
-    text_content = "\n".join(lines) if lines else "Список пользователей пуст."
-
-    with tempfile.NamedTemporaryFile(mode="w+", suffix=".txt", delete=False, encoding="utf-8") as tmp:
-        tmp.write(text_content)
-        tmp_path = tmp.name
-
-    document = FSInputFile(tmp_path)
-    await bot.send_document(
-        chat_id=callback.from_user.id,
-        document=document,
-        caption="Список всех пользователей"
-    )
+    try:
+        for number, path in enumerate(paths, start=1):
+            caption = captions[kind] if len(paths) == 1 else f"{captions[kind]} (часть {number}/{len(paths)})"
+            await bot.send_document(chat_id=chat_id, document=FSInputFile(path), caption=caption)
+        await progress_message.edit_text(f"✅ Выгрузка готова, файлов: {len(paths)}")
+    except Exception as e:
+        logging.exception(f"Ошибка отправки выгрузки {kind}: {e}")
+        await progress_message.edit_text(f"❌ Ошибка отправки выгрузки: {e}")
+    finally:
+        remove_export(directory)
 
-    os.remove(tmp_path)
-    await callback.answer()
 
+def start_export(chat_id: int, kind: str, fmt: str = "csv", columns: list[str] | None = None) -> None:
+    task = asyncio.create_task(send_export(chat_id, kind, fmt, columns))
+    _export_tasks.add(task)
+    task.add_done_callback(_export_tasks.discard)
 
-@router.callback_query(F.data == "change_stars_value")
-async def callback_change_stars(callback: types.CallbackQuery, state: FSMContext) -> None:
+
+@router.callback_query(F.data == "download_referrals")
+async def callback_download_referrals(callback: types.CallbackQuery) -> None:
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer("У вас нет доступа.", show_alert=True)
         return
 
-    # Загружаем текущее значение прямо из файла
-    from utils import load_json_data
-    stars_config = load_json_data("data/config.json")
-    current_value = stars_config.get("stars_per_referral", 2)
-
-    await callback.message.answer(
-        f"Текущее количество звезд за подписку на канал: <b>{current_value}</b>\n\n"
-        "Введите новое значение (целое число):"
-    )
-    await state.set_state(AdminStates.waiting_for_stars_value)
+    start_export(callback.from_user.id, "referrals")
     await callback.answer()
 
 
-@router.message(AdminStates.waiting_for_stars_value)
-async def process_stars_value(message: types.Message, state: FSMContext) -> None:
-    if message.from_user.id not in ADMIN_IDS:
+@router.callback_query(F.data == "download_users")
+async def callback_download_users(callback: types.CallbackQuery) -> None:
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
         return
 
-    try:
-        new_value = int(message.text.strip())
-        if new_value <= 0:
-            await message.answer("Значение должно быть положительным числом. Попробуйте снова:")
-            return
-
-        # Обновляем значение напрямую в файле
-        from utils import save_json_data
-        save_json_data("data/config.json", {"stars_per_referral": new_value})
-
-        # Для совместимости также обновляем глобальную переменную
-        global stars_per_referral
-        stars_per_referral = new_value
-
-        # Проверяем, что значение сохранилось
-        from utils import load_json_data
-        stars_config = load_json_data("data/config.json")
-        saved_value = stars_config.get("stars_per_referral", 0)
-
-        # Выводим сообщение об успешном изменении
-        await message.answer(f"✅ Количество звезд за подписку изменено на: <b>{saved_value}</b>")
-        await state.clear()
+    start_export(callback.from_user.id, "users")
+    await callback.answer()
 
-    except ValueError:
-        await message.answer("Введите корректное целое число:")
-    except Exception as e:
-        # Добавим подробный вывод ошибки для диагностики
-        import traceback
-        error_details = traceback.format_exc()
-        await message.answer(f"❌ Произошла ошибка при сохранении значения: {str(e)}\n\nПопробуйте снова.")
-        logging.error(f"Ошибка при изменении звезд за подписку: {error_details}")
 
+@router.message(Command("export"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_export(message: types.Message) -> None:
+    """
+    /export users|referrals [csv|jsonl] [колонки через запятую]
+    """
+    from exports import EXPORTS, FORMATS, ExportError, parse_columns
 
-@router.message(AdminStates.waiting_for_stars_value)
-async def process_stars_value(message: types.Message, state: FSMContext) -> None:
-    if message.from_user.id not in ADMIN_IDS:
+    args = message.text.split()
+    if len(args) < 2 or args[1] not in EXPORTS:
+        columns_help = "\n".join(f"{kind}: {', '.join(columns)}" for kind, (_, columns) in EXPORTS.items())
+        await message.answer(
+            "Использование: /export users|referrals [csv|jsonl] [колонки через запятую]\n\n"
+            f"Доступные колонки:\n{columns_help}"
+        )
         return
 
+    kind = args[1]
+    fmt = args[2] if len(args) > 2 else "csv"
+    if fmt not in FORMATS:
+        await message.answer(f"❌ Неизвестный формат: {fmt}. Доступны: {', '.join(FORMATS)}")
+        return
     try:
-        new_value = int(message.text.strip())
-        if new_value <= 0:
-            await message.answer("Значение должно быть положительным числом. Попробуйте снова:")
-            return
+        columns = parse_columns(kind, args[3] if len(args) > 3 else None)
+    except ExportError as e:
+        await message.answer(f"❌ {e}")
+        return
 
-        # Обновляем значение в глобальной переменной (для совместимости)
-        global stars_per_referral
-        stars_per_referral = new_value
+    start_export(message.chat.id, kind, fmt, columns)
 
-        # Сохраняем новое значение в файл конфигурации
-        save_stars_config()
 
-        # Проверяем, что значение сохранилось корректно
-        from utils import load_json_data
-        stars_config = load_json_data("data/config.json")
-        saved_value = stars_config.get("stars_per_referral", 0)
+@router.callback_query(F.data == "change_stars_value")
+async def callback_change_stars(callback: types.CallbackQuery, state: FSMContext) -> None:
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
+        return
 
-        await message.answer(f"✅ Количество звезд за подписку изменено на: <b>{saved_value}</b>")
-        await state.clear()
+    current_value = get_stars_per_referral()
 
-    except ValueError:
-        await message.answer("Введите корректное целое число:")
+    await callback.message.answer(
+        f"Текущее количество звезд за подписку на канал: <b>{current_value}</b>\n\n"
+        "Введите новое значение (целое число):"
+    )
+    await state.set_state(AdminStates.waiting_for_stars_value)
+    await callback.answer()
 
 
 @router.message(AdminStates.waiting_for_stars_value)
@@ -239,20 +248,16 @@ async def process_stars_value(message: types.Message, state: FSMContext) -> None
             await message.answer("Значение должно быть положительным числом. Попробуйте снова:")
             return
 
-        # Обновляем значение
-        global stars_per_referral
-        stars_per_referral = new_value
-        save_stars_config()
-
-        # Вызываем функцию обновления в data.py
-        from data import update_stars_per_referral
-        updated_value = update_stars_per_referral()
+        set_stars_per_referral(new_value)
 
-        await message.answer(f"✅ Количество звезд за подписку изменено на: <b>{updated_value}</b>")
+        await message.answer(f"✅ Количество звезд за подписку изменено на: <b>{new_value}</b>")
         await state.clear()
 
     except ValueError:
         await message.answer("Введите корректное целое число:")
+    except Exception as e:
+        await message.answer(f"❌ Произошла ошибка при сохранении значения: {str(e)}\n\nПопробуйте снова.")
+        logging.exception(f"Ошибка при изменении звезд за подписку: {e}")
 
 
 @router.callback_query(F.data == "create_promo")
@@ -351,7 +356,7 @@ async def process_promo_stars(message: types.Message, state: FSMContext) -> None
             promocodes[promo_code] = {
                 "stars": stars,
                 "is_single_use": True,
-                "used_by": []
+                "used_by": set()
             }
         elif promo_type == "unlimited":
             promocodes[promo_code] = {
@@ -359,10 +364,10 @@ async def process_promo_stars(message: types.Message, state: FSMContext) -> None
                 "is_single_use": False,
                 "unlimited": True,
                 "activations": 0,
-                "used_by": []
+                "used_by": set()
             }
 
-        save_promocodes()
+        save_promocodes(promo_code)
 
         promo_type_text = {
             "single": "одноразовый (для каждого пользователя)",
@@ -403,9 +408,9 @@ async def process_promo_limit(message: types.Message, state: FSMContext) -> None
             "is_single_use": False,
             "limit": limit,
             "activations": 0,
-            "used_by": []
+            "used_by": set()
         }
-        save_promocodes()
+        save_promocodes(promo_code)
 
         await message.answer(
             f"✅ Промокод <b>{promo_code}</b> успешно создан!\n"
@@ -426,14 +431,8 @@ async def callback_create_broadcast(callback: types.CallbackQuery, state: FSMCon
 
     await callback.message.answer(
         "Отправьте сообщение, которое нужно разослать всем активным пользователям.\n\n"
-        "<b>Поддерживаются:</b> \n"
-        "- <b>Текст</b> (без форматирования)\n"
-        "- <b>Фото</b> (С описанием, без форматирования)\n"
-        "- <b>Видео</b> (С описанием, без форматирования)\n"
-        "- <b>Документ</b> (С описанием, без форматирования)\n"
-        "- <b>Аудио</b> (С описанием, без форматирования)\n"
-        "- <b>Голосовое сообщение</b> (С описанием, без форматирования)\n"
-        "- <b>Видеосообщение</b>"
+        "<b>Поддерживаются:</b> текст, фото, видео, документы, аудио, голосовые сообщения, "
+        "видеосообщения и другие обычные сообщения. Форматирование и подпись сохраняются."
     )
     await state.set_state(AdminStates.waiting_for_broadcast)
     await callback.answer()
@@ -444,39 +443,139 @@ async def process_broadcast(message: types.Message, state: FSMContext) -> None:
     if message.from_user.id not in ADMIN_IDS:
         return
 
-    # Подтверждение перед рассылкой
-    inline_kb = InlineKeyboardMarkup(inline_keyboard=[
+    # Служебные сообщения (вход в чат, закрепление и т.п.) скопировать нельзя
+    if not (message.text or message.photo or message.video or message.document
+            or message.audio or message.voice or message.video_note or message.sticker or message.animation):
+        await message.answer("❌ Неподдерживаемый тип сообщения. Попробуйте снова.")
+        return
+
+    # Для рассылки запоминаем только ссылку на сообщение: получателям оно копируется
+    await state.update_data(from_chat_id=message.chat.id, message_id=message.message_id, segments=[])
+    text, inline_kb = build_broadcast_audience([])
+    await message.answer(f"📨 Сообщение получено.\n\n{text}\n\nПодтвердите отправку:", reply_markup=inline_kb)
+
+
+def build_broadcast_audience(filters: list) -> tuple[str, InlineKeyboardMarkup]:
+    """
+    Описание аудитории рассылки и клавиатура подтверждения с выбором сегментов
+    """
+    from segments import describe, select_recipients
+
+    recipients, elapsed_ms = select_recipients(filters)
+    text = (
+        f"🎯 <b>Аудитория:</b> {describe(filters)}\n"
+        f"Получателей: <b>{len(recipients)}</b> (выбрано за {elapsed_ms:.1f} мс)"
+    )
+    keyboard = [
         [InlineKeyboardButton(text="✅ Подтвердить отправку", callback_data="confirm_broadcast")],
-        [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_broadcast")]
-    ])
+        [InlineKeyboardButton(text="⏰ Запланировать", callback_data="broadcast_schedule")],
+        [InlineKeyboardButton(text="🎯 Добавить фильтр", callback_data="broadcast_segments")],
+    ]
+    if filters:
+        keyboard.append([InlineKeyboardButton(text="🧹 Сбросить фильтры", callback_data="segment_clear")])
+    keyboard.append([InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_broadcast")])
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+async def show_broadcast_audience(message: types.Message, state: FSMContext) -> None:
+    data = await state.get_data()
+    text, inline_kb = build_broadcast_audience(data.get("segments", []))
+    await message.answer(f"{text}\n\nПодтвердите отправку:", reply_markup=inline_kb)
+
+
+@router.callback_query(F.data == "broadcast_segments")
+async def callback_broadcast_segments(callback: types.CallbackQuery) -> None:
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
+        return
+
+    from segments import SEGMENTS
+
+    keyboard = [[InlineKeyboardButton(text=title, callback_data=f"segment_add:{name}")]
+                for name, (title, _, _) in SEGMENTS.items()]
+    await callback.message.answer("Выберите фильтр аудитории:", reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    await callback.answer()
 
-    # Сохраняем сообщение для рассылки в FSM
-    if message.photo:
-        await state.update_data(type="photo", file_id=message.photo[-1].file_id, caption=message.caption or "")
-        await message.answer("📸 Фото получено. Подтвердите отправку:", reply_markup=inline_kb)
-    elif message.video:
-        await state.update_data(type="video", file_id=message.video.file_id, caption=message.caption or "")
-        await message.answer("🎬 Видео получено. Подтвердите отправку:", reply_markup=inline_kb)
-    elif message.document:
-        await state.update_data(type="document", file_id=message.document.file_id, caption=message.caption or "")
-        await message.answer("📄 Документ получен. Подтвердите отправку:", reply_markup=inline_kb)
-    elif message.audio:
-        await state.update_data(type="audio", file_id=message.audio.file_id, caption=message.caption or "")
-        await message.answer("🎵 Аудио получено. Подтвердите отправку:", reply_markup=inline_kb)
-    elif message.voice:
-        await state.update_data(type="voice", file_id=message.voice.file_id, caption=message.caption or "")
-        await message.answer("🎤 Голосовое сообщение получено. Подтвердите отправку:", reply_markup=inline_kb)
-    elif message.video_note:
-        await state.update_data(type="video_note", file_id=message.video_note.file_id)
-        await message.answer("📹 Видеосообщение получено. Подтвердите отправку:", reply_markup=inline_kb)
-    elif message.text:
-        await state.update_data(type="text", text=message.text)
-        await message.answer(f"💬 Сообщение получено:\n\n{message.text}\n\nПодтвердите отправку:",
-                             reply_markup=inline_kb)
+
+@router.callback_query(F.data.startswith("segment_add:"))
+async def callback_segment_add(callback: types.CallbackQuery, state: FSMContext) -> None:
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
+        return
+
+    from segments import SEGMENTS
+
+    name = callback.data.split(":", 1)[1]
+    data = await state.get_data()
+    if name not in SEGMENTS or "message_id" not in data:
+        await callback.answer("Сначала отправьте сообщение для рассылки.", show_alert=True)
+        return
+
+    title, parse, _ = SEGMENTS[name]
+    if name == "channel":
+        if not required_channels:
+            await callback.answer("Нет обязательных каналов.", show_alert=True)
+            return
+        keyboard = [[InlineKeyboardButton(text=channel.get('name', channel['id']),
+                                          callback_data=f"segment_channel:{channel['id']}")]
+                    for channel in required_channels.checkable()]
+        await callback.message.answer("Выберите канал:", reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    elif parse:
+        await state.update_data(segment_name=name)
+        await state.set_state(AdminStates.waiting_for_segment_value)
+        await callback.message.answer(f"🎯 {title}\n\nВведите значение:")
     else:
-        await message.answer("❌ Неподдерживаемый тип сообщения. Попробуйте снова.")
+        await state.update_data(segments=data.get("segments", []) + [[name, None]])
+        await show_broadcast_audience(callback.message, state)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("segment_channel:"))
+async def callback_segment_channel(callback: types.CallbackQuery, state: FSMContext) -> None:
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
+        return
+
+    data = await state.get_data()
+    if "message_id" not in data:
+        await callback.answer("Сначала отправьте сообщение для рассылки.", show_alert=True)
+        return
+    channel_id = callback.data.split(":", 1)[1]
+    await state.update_data(segments=data.get("segments", []) + [["channel", channel_id]])
+    await show_broadcast_audience(callback.message, state)
+    await callback.answer()
+
+
+@router.message(AdminStates.waiting_for_segment_value)
+async def process_segment_value(message: types.Message, state: FSMContext) -> None:
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    from segments import parse_value, SegmentError
+
+    data = await state.get_data()
+    name = data.get("segment_name")
+    try:
+        value = parse_value(name, message.text or "")
+    except SegmentError as e:
+        await message.answer(f"❌ {e}. Попробуйте снова:")
+        return
+
+    await state.update_data(segments=data.get("segments", []) + [[name, value]])
+    await state.set_state(AdminStates.waiting_for_broadcast)
+    await show_broadcast_audience(message, state)
+
+
+@router.callback_query(F.data == "segment_clear")
+async def callback_segment_clear(callback: types.CallbackQuery, state: FSMContext) -> None:
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
         return
 
+    await state.update_data(segments=[])
+    await show_broadcast_audience(callback.message, state)
+    await callback.answer()
+
 
 @router.callback_query(F.data == "confirm_broadcast")
 async def callback_confirm_broadcast(callback: types.CallbackQuery, state: FSMContext) -> None:
@@ -484,91 +583,132 @@ async def callback_confirm_broadcast(callback: types.CallbackQuery, state: FSMCo
         await callback.answer("У вас нет доступа.", show_alert=True)
         return
 
-    data = await state.get_data()
-    message_type = data.get("type")
+    from broadcast import create_job, job_text, job_keyboard
+    from segments import select_recipients
 
-    # Счетчики для статистики
-    sent_count = 0
-    error_count = 0
+    data = await state.get_data()
+    if "message_id" not in data:
+        await callback.answer("Сообщение для рассылки не найдено.", show_alert=True)
+        return
+    await state.clear()
 
-    # Обновляем сообщение о процессе
-    progress_message = await callback.message.edit_text("⏳ Рассылка началась. Пожалуйста, подождите...")
+    # Рассылка выполняется в фоне (broadcast.run_broadcast_jobs), прогресс - в этом сообщении
+    progress_message = await callback.message.edit_text("⏳ Рассылка поставлена в очередь...")
+    recipients, _ = select_recipients(data.get("segments", []))
+    job_id = create_job(
+        data["from_chat_id"], data["message_id"], recipients,
+        chat_id=progress_message.chat.id, progress_message_id=progress_message.message_id
+    )
+    await progress_message.edit_text(job_text(job_id), reply_markup=job_keyboard(job_id))
+    await callback.answer()
 
-    total_users = sum(1 for user_id, info in users_data.items() if info.get("status") == "active")
-    processed = 0
 
-    # Отправляем сообщения всем активным пользователям
-    for user_id, info in users_data.items():
-        if info.get("status") == "active":
-            try:
-                if message_type == "photo":
-                    await bot.send_photo(
-                        chat_id=int(user_id),
-                        photo=data["file_id"],
-                        caption=data.get("caption", "")
-                    )
-                elif message_type == "video":
-                    await bot.send_video(
-                        chat_id=int(user_id),
-                        video=data["file_id"],
-                        caption=data.get("caption", "")
-                    )
-                elif message_type == "document":
-                    await bot.send_document(
-                        chat_id=int(user_id),
-                        document=data["file_id"],
-                        caption=data.get("caption", "")
-                    )
-                elif message_type == "audio":
-                    await bot.send_audio(
-                        chat_id=int(user_id),
-                        audio=data["file_id"],
-                        caption=data.get("caption", "")
-                    )
-                elif message_type == "voice":
-                    await bot.send_voice(
-                        chat_id=int(user_id),
-                        voice=data["file_id"],
-                        caption=data.get("caption", "")
-                    )
-                elif message_type == "video_note":
-                    await bot.send_video_note(
-                        chat_id=int(user_id),
-                        video_note=data["file_id"]
-                    )
-                elif message_type == "text":
-                    await bot.send_message(
-                        chat_id=int(user_id),
-                        text=data["text"]
-                    )
-                sent_count += 1
-            except Exception as e:
-                logging.error(f"Ошибка при отправке сообщения пользователю {user_id}: {e}")
-                error_count += 1
-
-            processed += 1
-            # Обновляем прогресс каждые 10 пользователей
-            if processed % 10 == 0:
-                await progress_message.edit_text(
-                    f"⏳ Отправлено {processed}/{total_users} сообщений...\n"
-                    f"✅ Успешно: {sent_count}\n"
-                    f"❌ Ошибок: {error_count}"
-                )
+@router.callback_query(F.data == "broadcast_schedule")
+async def callback_broadcast_schedule(callback: types.CallbackQuery, state: FSMContext) -> None:
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
+        return
 
-            # Делаем небольшую задержку, чтобы избежать ограничений API
-            await asyncio.sleep(0.05)
+    data = await state.get_data()
+    if "message_id" not in data:
+        await callback.answer("Сообщение для рассылки не найдено.", show_alert=True)
+        return
 
-    # Финальное сообщение с результатами
-    await progress_message.edit_text(
-        f"✅ Рассылка завершена!\n\n"
-        f"📊 <b>Статистика:</b>\n"
-        f"- Всего пользователей: {total_users}\n"
-        f"- Успешно отправлено: {sent_count}\n"
-        f"- Ошибок: {error_count}"
+    await state.set_state(AdminStates.waiting_for_schedule_time)
+    await callback.message.answer(
+        "⏰ Введите дату и время первой отправки в формате ДД.ММ.ГГГГ ЧЧ:ММ "
+        "(время сервера):"
     )
+    await callback.answer()
+
+
+@router.message(AdminStates.waiting_for_schedule_time)
+async def process_schedule_time(message: types.Message, state: FSMContext) -> None:
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    from scheduler import REPEATS
+
+    try:
+        run_at = int(datetime.strptime((message.text or "").strip(), "%d.%m.%Y %H:%M").timestamp())
+    except ValueError:
+        await message.answer("❌ Введите дату и время в формате ДД.ММ.ГГГГ ЧЧ:ММ. Попробуйте снова:")
+        return
+    if run_at <= time.time():
+        await message.answer("❌ Это время уже прошло. Введите время в будущем:")
+        return
 
+    await state.update_data(schedule_run_at=run_at)
+    keyboard = [[InlineKeyboardButton(text=title, callback_data=f"schedule_repeat:{name}")]
+                for name, (title, _) in REPEATS.items()]
+    keyboard.append([InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_broadcast")])
+    await message.answer("🔁 Как часто повторять рассылку?", reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+
+
+@router.callback_query(F.data.startswith("schedule_repeat:"))
+async def callback_schedule_repeat(callback: types.CallbackQuery, state: FSMContext) -> None:
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
+        return
+
+    from scheduler import REPEATS, add_schedule, schedule_text
+
+    name = callback.data.split(":", 1)[1]
+    data = await state.get_data()
+    if name not in REPEATS or "message_id" not in data or "schedule_run_at" not in data:
+        await callback.answer("Сообщение для рассылки не найдено.", show_alert=True)
+        return
     await state.clear()
 
+    schedule_id = add_schedule(
+        data["from_chat_id"], data["message_id"], data.get("segments", []),
+        chat_id=callback.message.chat.id, run_at=data["schedule_run_at"], interval=REPEATS[name][1]
+    )
+    await callback.message.edit_text(f"✅ Рассылка запланирована.\n\n{schedule_text(schedule_id)}")
+    await callback.answer()
+
+
+@router.callback_query(F.data == "scheduled_broadcasts")
+async def callback_scheduled_broadcasts(callback: types.CallbackQuery) -> None:
+    """
+    Список запланированных рассылок с кнопками отмены
+    """
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
+        return
+
+    from data import scheduled_broadcasts
+    from scheduler import schedule_text
+
+    schedule_ids = sorted(scheduled_broadcasts, key=lambda key: scheduled_broadcasts[key]["run_at"])
+    if not schedule_ids:
+        await callback.answer("Запланированных рассылок нет.", show_alert=True)
+        return
+
+    text = "\n\n".join(schedule_text(schedule_id) for schedule_id in schedule_ids)
+    keyboard = [[InlineKeyboardButton(text=f"❌ Отменить #{schedule_id}", callback_data=f"schedule_cancel:{schedule_id}")]
+                for schedule_id in schedule_ids]
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_admin")])
+
+    await callback.message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("schedule_cancel:"))
+async def callback_schedule_cancel(callback: types.CallbackQuery) -> None:
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
+        return
+
+    from scheduler import cancel_schedule
+
+    schedule_id = callback.data.split(":", 1)[1]
+    if not cancel_schedule(schedule_id):
+        await callback.answer("Рассылка уже запущена или отменена.", show_alert=True)
+        return
+    await callback.message.edit_text(f"❌ Запланированная рассылка #{schedule_id} отменена.")
+    await callback.answer()
+
 
 @router.callback_query(F.data == "cancel_broadcast")
 async def callback_cancel_broadcast(callback: types.CallbackQuery, state: FSMContext) -> None:
@@ -581,6 +721,64 @@ async def callback_cancel_broadcast(callback: types.CallbackQuery, state: FSMCon
     await callback.answer()
 
 
+@router.callback_query(F.data == "broadcast_jobs")
+async def callback_broadcast_jobs(callback: types.CallbackQuery) -> None:
+    """
+    Список последних рассылок с кнопками управления незавершёнными
+    """
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
+        return
+
+    from data import broadcast_jobs
+    from broadcast import job_text, JOB_QUEUED, JOB_RUNNING, JOB_PAUSED
+
+    job_ids = sorted(broadcast_jobs, key=int, reverse=True)[:10]
+    if not job_ids:
+        await callback.answer("Рассылок пока не было.", show_alert=True)
+        return
+
+    text = "\n\n".join(job_text(job_id) for job_id in job_ids)
+    keyboard = []
+    for job_id in job_ids:
+        status = broadcast_jobs[job_id]["status"]
+        if status in (JOB_QUEUED, JOB_RUNNING):
+            keyboard.append([InlineKeyboardButton(text=f"⏸ Пауза #{job_id}", callback_data=f"broadcast_pause:{job_id}")])
+        elif status == JOB_PAUSED:
+            keyboard.append([InlineKeyboardButton(text=f"▶️ Продолжить #{job_id}",
+                                                  callback_data=f"broadcast_resume:{job_id}")])
+        if status in (JOB_QUEUED, JOB_RUNNING, JOB_PAUSED):
+            keyboard.append([InlineKeyboardButton(text=f"❌ Отменить #{job_id}", callback_data=f"broadcast_stop:{job_id}")])
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_admin")])
+
+    await callback.message.answer(text, reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard))
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("broadcast_pause:") | F.data.startswith("broadcast_resume:")
+                       | F.data.startswith("broadcast_stop:"))
+async def callback_control_broadcast(callback: types.CallbackQuery) -> None:
+    if callback.from_user.id not in ADMIN_IDS:
+        await callback.answer("У вас нет доступа.", show_alert=True)
+        return
+
+    from broadcast import pause_job, resume_job, cancel_job, show_job_progress
+
+    action, job_id = callback.data.split(":", 1)
+    actions = {
+        "broadcast_pause": (pause_job, "Рассылка будет приостановлена"),
+        "broadcast_resume": (resume_job, "Рассылка продолжена"),
+        "broadcast_stop": (cancel_job, "Рассылка отменена"),
+    }
+    handler, done_text = actions[action]
+    if not handler(job_id):
+        await callback.answer("Действие недоступно для этой рассылки.", show_alert=True)
+        return
+
+    await show_job_progress(job_id)
+    await callback.answer(done_text)
+
+
 @router.message(Command("debug_referrals"), F.from_user.id.in_(ADMIN_IDS))
 async def cmd_debug_referrals(message: types.Message) -> None:
     """
@@ -633,6 +831,74 @@ async def cmd_reset_credited(message: types.Message) -> None:
     await message.answer(f"✅ Список кредитованных рефералов очищен. Было удалено {old_count} записей.")
 
 
+@router.message(Command("perf"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_perf(message: types.Message) -> None:
+    """
+    Показывает статистику производительности внутренних подсистем бота
+    """
+    from storage import get_stats
+
+    storage_stats = get_stats()
+    cache_stats = get_membership_cache_stats()
+    latency_stats = get_membership_latency_stats()
+
+    perf_text = (
+        "⚙️ <b>Производительность</b>\n\n"
+        f"<b>Сохранение данных ({storage_stats['backend']}):</b>\n"
+        f"- Сбросов: {storage_stats['flushes']}\n"
+        f"- Записано (файлов/строк): {storage_stats['items_written']}\n"
+        f"- Запрошено сохранений: {storage_stats['writes_requested']}\n"
+        f"- Объединено записей: {storage_stats['writes_coalesced']}\n"
+        f"- Ожидают записи: {storage_stats['pending_writes']}\n"
+        f"- Ошибок записи: {storage_stats['write_errors']}\n"
+        f"- Время сброса (посл./сред./макс.): {storage_stats['last_flush_ms']:.1f} / "
+        f"{storage_stats['avg_flush_ms']:.1f} / {storage_stats['max_flush_ms']:.1f} мс\n"
+        f"- Снимок в цикле событий (посл./макс.): {storage_stats['last_snapshot_ms']:.1f} / "
+        f"{storage_stats['max_snapshot_ms']:.1f} мс\n"
+    )
+    if "journal_size" in storage_stats:
+        perf_text += (
+            f"- Записей в журнале: {storage_stats['journal_records']} "
+            f"(размер {storage_stats['journal_size'] / 1024:.1f} КБ)\n"
+            f"- Применено при запуске: {storage_stats['journal_replayed']}\n"
+            f"- Компактизаций: {storage_stats['compactions']} "
+            f"(последняя {storage_stats['last_compaction_ms']:.1f} мс)\n"
+        )
+    perf_text += (
+        f"\n<b>Кэш проверок подписки:</b>\n"
+        f"- Ответов из таблицы подписок: {cache_stats['table_hits']}\n"
+        f"- Попаданий в кэш: {cache_stats['hits']}\n"
+        f"- Запросов к API: {cache_stats['misses']}\n"
+        f"- Объединено одновременных проверок: {cache_stats['coalesced']}\n"
+        f"- Пропущено (канал недоступен): {cache_stats['short_circuited']}\n"
+        f"- Записей: {cache_stats['size']} (вытеснено {cache_stats['evictions']})\n"
+        f"\n<b>Запросы get_chat_member (последние {latency_stats['samples']}):</b>\n"
+        f"- p50 / p95 / p99: {latency_stats['p50_ms']:.0f} / {latency_stats['p95_ms']:.0f} / "
+        f"{latency_stats['p99_ms']:.0f} мс\n"
+        f"- Повторных запросов: {latency_stats['hedged']} (ответили первыми {latency_stats['hedge_wins']}, "
+        f"задержка {latency_stats['hedge_delay_ms']:.0f} мс)\n"
+        f"- Таймаутов: {latency_stats['timeouts']} (ответ по последнему статусу {latency_stats['fallbacks']})\n"
+    )
+
+    await message.answer(perf_text)
+
+
+@router.message(Command("verify_stats"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_verify_stats(message: types.Message) -> None:
+    """
+    Сверяет счётчики админ-панели и индексы сегментов с полным пересчётом по данным пользователей
+    """
+    from stats import verify
+
+    mismatches = verify()
+    if not mismatches:
+        await message.answer("✅ Счётчики статистики совпадают с данными")
+        return
+
+    lines = [f"- {name}: {old} → {new}" for name, (old, new) in mismatches.items()]
+    await message.answer("⚠️ Счётчики и индексы статистики пересчитаны:\n" + "\n".join(lines))
+
+
 @router.message(Command("fix_user"), F.from_user.id.in_(ADMIN_IDS))
 async def cmd_fix_user(message: types.Message) -> None:
     """
@@ -655,8 +921,8 @@ async def cmd_fix_user(message: types.Message) -> None:
         # Отмечаем, что пользователь получил звезды за подписку
         if not users_data[user_id].get("stars_for_subscription_received", False):
             users_data[user_id]["stars_for_subscription_received"] = True
-            users_data[user_id]["stars"] = users_data[user_id].get("stars", 0) + stars_per_referral
-            save_users_data(users_data)
+            add_user_stars(user_id, get_stars_per_referral())
+            save_users_data(users_data, user_id)
             await message.answer(f"✅ Пользователю {user_id} начислены звезды за подписку")
 
         # Если указан реферер, проверяем и фиксируем реферальную связь
@@ -666,33 +932,30 @@ async def cmd_fix_user(message: types.Message) -> None:
 
             if user_id not in credited_referrals:
                 credited_referrals.add(user_id)
-                save_credited_referrals()
+                save_credited_referrals(user_id)
 
                 # Обновляем счетчик рефералов
                 if referrer_id in referral_data:
-                    referral_data[referrer_id]["count"] = referral_data[referrer_id].get("count", 0) + 1
+                    increment_count(referrer_id)
 
                     # Добавляем в список активаций, если его нет
-                    if "referral_activations" not in referral_data[referrer_id]:
-                        referral_data[referrer_id]["referral_activations"] = []
+                    add_referral_activation(referrer_id, user_id)
 
-                    if user_id not in referral_data[referrer_id]["referral_activations"]:
-                        referral_data[referrer_id]["referral_activations"].append(user_id)
-
-                    save_referral_data(referral_data)
+                    save_referral_data(referral_data, referrer_id)
                 else:
                     # Создаем новую запись для реферера
-                    referral_data[referrer_id] = {
-                        "bot_link": f"https://t.me/{(await bot.get_me()).username}?start={referrer_id}",
+                    add_referrer(referrer_id, {
+                        "bot_link": get_referral_link(referrer_id),
                         "count": 1,
                         "username": users_data[referrer_id]["username"],
-                        "referral_activations": [user_id]
-                    }
-                    save_referral_data(referral_data)
+                        "referral_activations": set()
+                    })
+                    add_referral_activation(referrer_id, user_id)
+                    save_referral_data(referral_data, referrer_id)
 
                 # Начисляем звезды рефереру
-                users_data[referrer_id]["stars"] = users_data[referrer_id].get("stars", 0) + stars_per_referral
-                save_users_data(users_data)
+                add_user_stars(referrer_id, get_stars_per_referral())
+                save_users_data(users_data, referrer_id)
 
                 await message.answer(
                     f"✅ Пользователь {user_id} добавлен как реферал для {referrer_id}, начислены звезды")
@@ -790,7 +1053,7 @@ async def process_channel_id(message: types.Message, state: FSMContext) -> None:
 
         # Проверяем права бота в канале
         try:
-            bot_member = await bot.get_chat_member(int(channel_id), (await bot.get_me()).id)
+            bot_member = await bot.get_chat_member(int(channel_id), get_bot_id())
 
             if bot_member.status not in ["administrator", "creator"]:
                 await message.answer(
@@ -865,7 +1128,7 @@ async def process_channel_id(message: types.Message, state: FSMContext) -> None:
         chat = await bot.get_chat(int(channel_id))
 
         # Проверяем, является ли бот администратором канала
-        bot_member = await bot.get_chat_member(int(channel_id), (await bot.get_me()).id)
+        bot_member = await bot.get_chat_member(int(channel_id), get_bot_id())
 
         if bot_member.status not in ["administrator", "creator"]:
             await message.answer(
@@ -983,8 +1246,11 @@ async def process_channel_name(message: types.Message, state: FSMContext) -> Non
         "name": channel_name
     }
 
-    required_channels.append(new_channel)
-    save_required_channels()
+    if not required_channels.add(new_channel):
+        await message.answer("❌ Этот канал уже есть в списке обязательных каналов.")
+        await state.clear()
+        return
+    invalidate_channel(new_channel["id"])
 
     await message.answer(
         f"✅ Канал <b>{channel_name}</b> успешно добавлен в список обязательных каналов!"
@@ -1026,7 +1292,7 @@ async def callback_edit_channel(callback: types.CallbackQuery, state: FSMContext
     for i, channel in enumerate(required_channels, 1):
         keyboard.append([InlineKeyboardButton(
             text=f"{i}. {channel.get('name', 'Без названия')}",
-            callback_data=f"edit_channel_{i - 1}"
+            callback_data=f"edit_channel_{channel.get('id')}"
         )])
 
     keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="manage_channels")])
@@ -1047,17 +1313,15 @@ async def callback_select_channel_to_edit(callback: types.CallbackQuery, state:
         await callback.answer("У вас нет доступа.", show_alert=True)
         return
 
-    # Получаем индекс выбранного канала
-    index = int(callback.data.split("_")[-1])
+    # Получаем выбранный канал по ID
+    channel = required_channels.get(callback.data.removeprefix("edit_channel_"))
 
-    if index >= len(required_channels):
+    if channel is None:
         await callback.answer("Канал не найден.", show_alert=True)
         return
 
-    channel = required_channels[index]
-
-    # Сохраняем индекс канала в состоянии
-    await state.update_data(edit_channel_index=index)
+    # Сохраняем ID канала в состоянии
+    await state.update_data(edit_channel_id=channel["id"])
 
     # Создаем клавиатуру с выбором поля для редактирования
     keyboard = [
@@ -1118,7 +1382,7 @@ async def process_edit_channel_id(message: types.Message, state: FSMContext) ->
         chat = await bot.get_chat(int(channel_id))
 
         # Проверяем, является ли бот администратором канала
-        bot_member = await bot.get_chat_member(int(channel_id), (await bot.get_me()).id)
+        bot_member = await bot.get_chat_member(int(channel_id), get_bot_id())
 
         if bot_member.status not in ["administrator", "creator"]:
             await message.answer(
@@ -1130,14 +1394,20 @@ async def process_edit_channel_id(message: types.Message, state: FSMContext) ->
             )
             return
 
-        # Получаем индекс редактируемого канала
+        # Получаем ID редактируемого канала
         data = await state.get_data()
-        index = data.get("edit_channel_index")
+        old_channel_id = data.get("edit_channel_id")
 
-        if index is not None and index < len(required_channels):
+        if channel_id != old_channel_id and channel_id in required_channels:
+            await message.answer("❌ Канал с таким ID уже есть в списке обязательных каналов.")
+            await state.clear()
+            return
+
+        if required_channels.get(old_channel_id) is not None:
             # Обновляем ID канала
-            required_channels[index]["id"] = channel_id
-            save_required_channels()
+            invalidate_channel(old_channel_id)
+            required_channels.update(old_channel_id, id=channel_id)
+            invalidate_channel(channel_id)
 
             await message.answer(
                 f"✅ ID канала успешно обновлен на: <code>{channel_id}</code> ({chat.title})"
@@ -1189,7 +1459,7 @@ async def callback_delete_channel(callback: types.CallbackQuery) -> None:
     for i, channel in enumerate(required_channels, 1):
         keyboard.append([InlineKeyboardButton(
             text=f"{i}. {channel.get('name', 'Без названия')}",
-            callback_data=f"delete_channel_{i - 1}"
+            callback_data=f"delete_channel_{channel.get('id')}"
         )])
 
     keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="manage_channels")])
@@ -1210,18 +1480,16 @@ async def callback_confirm_delete_channel(callback: types.CallbackQuery) -> None
         await callback.answer("У вас нет доступа.", show_alert=True)
         return
 
-    # Получаем индекс выбранного канала
-    index = int(callback.data.split("_")[-1])
+    # Получаем выбранный канал по ID
+    channel = required_channels.get(callback.data.removeprefix("delete_channel_"))
 
-    if index >= len(required_channels):
+    if channel is None:
         await callback.answer("Канал не найден.", show_alert=True)
         return
 
-    channel = required_channels[index]
-
     # Создаем клавиатуру для подтверждения удаления
     keyboard = [
-        [InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"confirm_delete_{index}")],
+        [InlineKeyboardButton(text="✅ Да, удалить", callback_data=f"confirm_delete_{channel['id']}")],
         [InlineKeyboardButton(text="❌ Нет, отменить", callback_data="delete_channel")]
     ]
 
@@ -1241,19 +1509,15 @@ async def callback_perform_delete_channel(callback: types.CallbackQuery) -> None
         await callback.answer("У вас нет доступа.", show_alert=True)
         return
 
-    # Получаем индекс выбранного канала
-    index = int(callback.data.split("_")[-1])
+    # Удаляем канал из списка
+    channel = required_channels.remove(callback.data.removeprefix("confirm_delete_"))
 
-    if index >= len(required_channels):
+    if channel is None:
         await callback.answer("Канал не найден.", show_alert=True)
         return
 
-    # Сохраняем имя удаляемого канала
-    channel_name = required_channels[index].get('name', 'Без названия')
-
-    # Удаляем канал из списка
-    del required_channels[index]
-    save_required_channels()
+    channel_name = channel.get('name', 'Без названия')
+    invalidate_channel(channel["id"])
 
     await callback.answer(f"Канал {channel_name} успешно удален!", show_alert=True)
 
@@ -1277,7 +1541,7 @@ async def callback_check_bot_rights(callback: types.CallbackQuery) -> None:
         "Идет проверка, пожалуйста, подождите..."
     )
 
-    bot_id = (await bot.get_me()).id
+    bot_id = get_bot_id()
     results = []
 
     for channel in required_channels:
@@ -1298,6 +1562,17 @@ async def callback_check_bot_rights(callback: types.CallbackQuery) -> None:
         except Exception as e:
             logging.error(f"Ошибка при проверке канала {channel_id}: {e}")
             results.append(f"❌ {channel_name} - ошибка проверки: {str(e)}")
+        else:
+            # Права в порядке: сразу возобновляем приостановленные проверки подписки
+            if bot_member.status in ("administrator", "creator"):
+                reset_channel_health(channel_id)
+
+        health = get_channel_health(channel_id)
+        if health is not None and health.is_open:
+            results.append(f"   ⚠️ проверки подписки приостановлены после {health.failures} ошибок подряд, "
+                           f"последняя: {health.last_error}")
+        elif health is not None and health.failures:
+            results.append(f"   ⚠️ ошибок проверки подписки подряд: {health.failures}")
 
     # Формируем отчет
     report = "🔍 <b>Результаты проверки прав бота</b>\n\n"
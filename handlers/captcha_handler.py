@@ -4,11 +4,14 @@ import logging
 from aiogram import types, F
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from bot import bot, router
+from bot import bot, router, get_referral_link
 from config import ADMIN_IDS
-from handlers.subscription import check_subscription, get_subscription_keyboard, get_not_subscribed_channels, \
-    get_channels_text
-from utils import save_users_data, get_stars_word, save_referral_data, load_json_data
+from handlers.subscription import get_subscription_keyboard, get_channels_text
+from middlewares import SubscriptionCheck
+from utils import save_users_data, get_stars_word, save_referral_data
+from runtime_config import get_stars_per_referral
+from stats import add_user_stars
+from ranking import add_referrer, increment_count
 
 # Список слов для капчи
 CAPTCHA_WORDS = [
@@ -25,19 +28,15 @@ class CaptchaStates(StatesGroup):
     waiting_for_captcha = State()
 
 
-def get_referrer_for_user(user_id: str, referral_data: dict) -> str | None:
+def get_referrer_for_user(user_id: str) -> str | None:
     """
-    Находит реферера для указанного пользователя.
+    Находит реферера для указанного пользователя по обратному индексу рефералов.
 
     :param user_id: ID пользователя
-    :param referral_data: Словарь с данными рефералов
     :return: ID реферера или None
     """
-    for potential_referrer_id, info in referral_data.items():
-        referral_activations = info.get("referral_activations", [])
-        if user_id in referral_activations:
-            return potential_referrer_id
-    return None
+    from data import get_referrer
+    return get_referrer(user_id)
 
 
 async def generate_captcha() -> tuple[str, str]:
@@ -57,7 +56,7 @@ async def generate_captcha() -> tuple[str, str]:
 
 
 @router.message(CaptchaStates.waiting_for_captcha)
-async def process_captcha(message: types.Message, state: FSMContext) -> None:
+async def process_captcha(message: types.Message, state: FSMContext, subscription: SubscriptionCheck) -> None:
     """
     Обрабатывает ответ пользователя на капчу.
     """
@@ -66,7 +65,7 @@ async def process_captcha(message: types.Message, state: FSMContext) -> None:
         referral_data, users_data,
         captcha_passed_referrals,
         save_captcha_passed_referrals, credited_referrals,
-        save_credited_referrals
+        save_credited_referrals, add_referral_activation
     )
 
     # Если это команда /admin и пользователь в списке админов, сразу пропускаем обработку капчи
@@ -111,7 +110,7 @@ async def process_captcha(message: types.Message, state: FSMContext) -> None:
 
         # Если не нашли в состоянии, пробуем найти через стандартную функцию
         if not referrer_id:
-            referrer_id = get_referrer_for_user(user_id, referral_data)
+            referrer_id = get_referrer_for_user(user_id)
             logging.info(f"Найден реферер через поиск в данных для пользователя {user_id}: {referrer_id}")
 
         # Если реферер найден и пользователь еще не был засчитан как реферал
@@ -120,49 +119,42 @@ async def process_captcha(message: types.Message, state: FSMContext) -> None:
 
             # Отмечаем, что этот пользователь прошел капчу и засчитан как реферал
             captcha_passed_referrals.add(user_id)
-            save_captcha_passed_referrals()
+            save_captcha_passed_referrals(user_id)
             logging.info(f"Пользователь {user_id} добавлен в список прошедших капчу")
 
             # Добавляем в список засчитанных рефералов
             credited_referrals.add(user_id)
-            save_credited_referrals()
+            save_credited_referrals(user_id)
             logging.info(f"Пользователь {user_id} добавлен в список засчитанных рефералов")
 
             # Обновляем счетчик рефералов
             if referrer_id in referral_data:
-                referral_data[referrer_id]["count"] = referral_data[referrer_id].get("count", 0) + 1
+                increment_count(referrer_id)
                 logging.info(
                     f"Увеличен счетчик рефералов для {referrer_id} после прохождения капчи: {referral_data[referrer_id]['count']}")
 
                 # Добавляем в список активаций, если его нет
-                if "referral_activations" not in referral_data[referrer_id]:
-                    referral_data[referrer_id]["referral_activations"] = []
-
-                if user_id not in referral_data[referrer_id]["referral_activations"]:
-                    referral_data[referrer_id]["referral_activations"].append(user_id)
+                add_referral_activation(referrer_id, user_id)
             else:
-                referral_data[referrer_id] = {
-                    "bot_link": f"https://t.me/{(await bot.get_me()).username}?start={referrer_id}",
+                add_referrer(referrer_id, {
+                    "bot_link": get_referral_link(referrer_id),
                     "count": 1,
                     "username": users_data.get(referrer_id, {}).get("username", "Неизвестно"),
-                    "referral_activations": [user_id]
-                }
+                    "referral_activations": set()
+                })
+                add_referral_activation(referrer_id, user_id)
                 logging.info(f"Создана новая запись реферала для {referrer_id}")
 
-            save_referral_data(referral_data)
+            save_referral_data(referral_data, referrer_id)
             logging.info(f"Данные рефералов сохранены")
 
             # Начисляем звезды рефереру
             if referrer_id in users_data:
-                # Прямое чтение актуального значения звезд за реферала из файла
-                stars_config = load_json_data("data/config.json")
-                current_stars_per_referral = stars_config.get("stars_per_referral",
-                                                              2)  # Используем 2 как значение по умолчанию
-                logging.info(f"Текущее значение звезд за реферала (прочитано из файла): {current_stars_per_referral}")
-
-                current_stars = users_data[referrer_id].get("stars", 0)
-                users_data[referrer_id]["stars"] = current_stars + current_stars_per_referral
-                save_users_data(users_data)
+                current_stars_per_referral = get_stars_per_referral()
+                logging.info(f"Текущее значение звезд за реферала: {current_stars_per_referral}")
+
+                add_user_stars(referrer_id, current_stars_per_referral)
+                save_users_data(users_data, referrer_id)
                 logging.info(
                     f"Начислены звезды рефереру {referrer_id}: {current_stars_per_referral}, всего: {users_data[referrer_id]['stars']}")
 
@@ -184,10 +176,10 @@ async def process_captcha(message: types.Message, state: FSMContext) -> None:
         await state.update_data(captcha_passed=True)
 
         # Проверяем подписку на обязательные каналы
-        is_subscribed = await check_subscription(message.from_user.id)
+        status = await subscription.get()
 
-        if not is_subscribed:
-            not_subscribed_channels = await get_not_subscribed_channels(message.from_user.id)
+        if not status.subscribed:
+            not_subscribed_channels = status.missing
             channels_text = get_channels_text(not_subscribed_channels)
 
             text = (
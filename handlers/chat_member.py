@@ -1,12 +1,16 @@
 # handlers/chat_member.py
 import logging
 from aiogram import types
-from bot import bot, router
-from data import users_data, referral_data, credited_referrals, save_credited_referrals, stars_per_referral, \
-    required_channels, captcha_passed_referrals
+from bot import bot, router, get_referral_link
+from data import users_data, referral_data, credited_referrals, save_credited_referrals, \
+    required_channels, captcha_passed_referrals, get_referrer, set_channel_membership
 from utils import save_users_data, save_referral_data, get_stars_word
+from stats import set_user_status, add_user_stars
+from runtime_config import get_stars_per_referral
+from ranking import add_referrer, increment_count
 from handlers.keyboard_handler import get_main_keyboard
-from handlers.subscription import check_subscription, get_not_subscribed_channels, get_channels_text
+from handlers.subscription import get_subscription_status, get_channels_text, \
+    set_cached_membership, MEMBER_STATUSES
 
 
 @router.my_chat_member()
@@ -16,27 +20,27 @@ async def on_my_chat_member(update: types.ChatMemberUpdated) -> None:
     user_id = str(update.chat.id)
     if update.new_chat_member.status in ["kicked", "left"]:
         if user_id in users_data:
-            users_data[user_id]["status"] = "removed"
-            save_users_data(users_data)
+            set_user_status(user_id, "removed", reason="blocked")
+            save_users_data(users_data, user_id)
             logging.info(f"Пользователь {user_id} удалил бота.")
 
 
 @router.chat_member()
 async def on_chat_member_update(update: types.ChatMemberUpdated) -> None:
+    # Обновления из необязательных чатов отбрасываем сразу (поиск по индексу, O(1))
+    if update.chat.id not in required_channels:
+        return
+
+    channel_id = str(update.chat.id)
     logging.info(f"=== НАЧАЛО ОБРАБОТКИ ОБНОВЛЕНИЯ ПОДПИСКИ ===")
-    logging.info(f"Обновление статуса участника: chat_id={update.chat.id}")
+    logging.info(f"Обновление статуса участника: chat_id={channel_id}")
     logging.info(f"Пользователь: {update.new_chat_member.user.id} ({update.new_chat_member.user.username})")
     logging.info(f"Старый статус: {update.old_chat_member.status}, новый статус: {update.new_chat_member.status}")
 
-    # Проверяем, относится ли обновление к одному из обязательных каналов
-    channel_id = str(update.chat.id)
-    is_required_channel = any(channel.get('id') == channel_id for channel in required_channels)
-
-    logging.info(f"Канал {channel_id} является обязательным: {is_required_channel}")
-
-    if not is_required_channel:
-        logging.info(f"Пропуск: chat_id не соответствует обязательным каналам")
-        return
+    # Запоминаем новый статус: дальнейшие проверки подписки обойдутся без запросов к API
+    is_member = update.new_chat_member.status in MEMBER_STATUSES
+    set_channel_membership(channel_id, update.new_chat_member.user.id, is_member)
+    set_cached_membership(update.new_chat_member.user.id, channel_id, is_member)
 
     # Пользователь подписался на канал
     if update.new_chat_member.status in ["member", "administrator", "creator"] and \
@@ -50,14 +54,10 @@ async def on_chat_member_update(update: types.ChatMemberUpdated) -> None:
             logging.info(f"Пользователь {user_id} найден в данных бота")
 
             # Проверяем все подписки пользователя на обязательные каналы
-            is_subscribed_to_all = await check_subscription(int(user_id))
+            status = await get_subscription_status(int(user_id))
+            is_subscribed_to_all = status.subscribed
             logging.info(f"Проверка всех подписок для {user_id}: {is_subscribed_to_all}")
 
-            # Логируем данные о рефералах перед обработкой
-            logging.info("=== ДАННЫЕ О РЕФЕРАЛАХ ===")
-            for ref_id, ref_data in referral_data.items():
-                logging.info(f"Реферер {ref_id}: {ref_data}")
-
             # Если подписан на все обязательные каналы
             if is_subscribed_to_all:
                 # Проверяем, получал ли пользователь уже звезды за подписку
@@ -67,7 +67,7 @@ async def on_chat_member_update(update: types.ChatMemberUpdated) -> None:
                 # Если еще не получал, начисляем звезды только за подписку (не за реферала)
                 if not stars_for_subscription_received:
                     users_data[user_id]["stars_for_subscription_received"] = True
-                    save_users_data(users_data)
+                    save_users_data(users_data, user_id)
                     logging.info(f"Отмечено, что пользователь {user_id} получил звезды за подписку")
 
                     # Ищем пользователя в активированных по реферальной ссылке
@@ -80,15 +80,8 @@ async def on_chat_member_update(update: types.ChatMemberUpdated) -> None:
                         logging.info(
                             f"Пользователь {user_id} не засчитан как реферал ранее, проверка в дополнение к капче")
 
-                        for potential_referrer_id, info in referral_data.items():
-                            referral_activations = info.get("referral_activations", [])
-                            logging.info(
-                                f"Проверяем реферрера {potential_referrer_id}, активации: {referral_activations}")
-
-                            if user_id in referral_activations:
-                                referrer_id = potential_referrer_id
-                                logging.info(f"Найден реферер {referrer_id} для пользователя {user_id}")
-                                break
+                        # Реферер определяется по обратному индексу активаций
+                        referrer_id = get_referrer(user_id)
 
                         if referrer_id:
                             logging.info(
@@ -96,37 +89,34 @@ async def on_chat_member_update(update: types.ChatMemberUpdated) -> None:
 
                             # Добавляем в список засчитанных рефералов
                             credited_referrals.add(user_id)
-                            save_credited_referrals()
+                            save_credited_referrals(user_id)
                             logging.info(f"Пользователь {user_id} добавлен в список засчитанных рефералов (подписка)")
 
                             # Обновляем статистику рефералов
                             if referrer_id in referral_data:
-                                referral_data[referrer_id]["count"] = referral_data[referrer_id].get("count", 0) + 1
+                                increment_count(referrer_id)
                                 logging.info(
                                     f"Увеличен счетчик рефералов для {referrer_id}: {referral_data[referrer_id]['count']}")
                             else:
-                                referral_data[referrer_id] = {
-                                    "bot_link": f"https://t.me/{(await bot.get_me()).username}?start={referrer_id}",
+                                add_referrer(referrer_id, {
+                                    "bot_link": get_referral_link(referrer_id),
                                     "count": 1,
                                     "username": users_data.get(referrer_id, {}).get("username", "Неизвестно"),
-                                    "referral_activations": []
-                                }
+                                    "referral_activations": set()
+                                })
                                 logging.info(f"Создана новая запись реферала для {referrer_id}")
 
-                            save_referral_data(referral_data)
+                            save_referral_data(referral_data, referrer_id)
                             logging.info(f"Данные рефералов сохранены")
 
-                            # Обновляем количество звезд за реферала из config.json
-                            from data import update_stars_per_referral
-                            current_stars_per_referral = update_stars_per_referral()
+                            current_stars_per_referral = get_stars_per_referral()
                             logging.info(
                                 f"Текущее значение звезд за реферала в chat_member: {current_stars_per_referral}")
 
                             # Начисляем звезды рефереру
                             if referrer_id in users_data:
-                                current_stars = users_data[referrer_id].get("stars", 0)
-                                users_data[referrer_id]["stars"] = current_stars + current_stars_per_referral
-                                save_users_data(users_data)
+                                add_user_stars(referrer_id, current_stars_per_referral)
+                                save_users_data(users_data, referrer_id)
                                 logging.info(
                                     f"Начислены звезды рефереру {referrer_id}: {current_stars_per_referral}, всего: {users_data[referrer_id]['stars']}")
 
@@ -163,7 +153,7 @@ async def on_chat_member_update(update: types.ChatMemberUpdated) -> None:
                     logging.info(f"Пользователь {user_id} уже получал звезды за подписку")
             else:
                 # Если не подписан на все каналы, сообщаем о необходимости подписаться на остальные
-                not_subscribed_channels = await get_not_subscribed_channels(int(user_id))
+                not_subscribed_channels = status.missing
 
                 if not_subscribed_channels:
                     channels_text = get_channels_text(not_subscribed_channels)
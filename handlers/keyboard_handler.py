@@ -1,72 +1,19 @@
 # handlers/keyboard_handler.py
-import logging
 from aiogram import types, F
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from bot import router, bot
-from config import ADMIN_IDS
-from data import users_data, referral_data, promocodes, save_promocodes, required_channels
-from utils import get_stars_word, get_invite_word, save_users_data, save_referral_data
-from handlers.subscription import check_subscription, get_subscription_keyboard, get_not_subscribed_channels, \
-    get_channels_text
+from bot import router
+from data import users_data, referral_data, promocodes, save_promocodes, add_promo_activation, required_channels
+from utils import get_stars_word, get_invite_word, save_users_data
+from stats import add_user_stars
+from ranking import rank_of, total as ranking_total
 
 
 class PromoStates(StatesGroup):
     waiting_for_promo = State()
 
 
-async def ensure_user_registered(user: types.User) -> None:
-    """
-    Проверяет наличие пользователя в базе данных и регистрирует его,
-    если он не зарегистрирован. Гарантирует наличие пользователя в базе.
-    """
-    user_id = str(user.id)
-
-    logging.info(f"=== РЕГИСТРАЦИЯ ПОЛЬЗОВАТЕЛЯ {user_id} ===")
-
-    # Проверка данных перед регистрацией
-    if user_id not in referral_data:
-        logging.info(f"Создание данных реферала для {user_id}")
-        bot_info = await bot.get_me()
-        referral_data[user_id] = {
-            "bot_link": f"https://t.me/{bot_info.username}?start={user_id}",
-            "count": 0,
-            "username": user.username or user.full_name,
-            "referral_activations": []
-        }
-        save_referral_data(referral_data)
-
-    if user_id not in users_data:
-        logging.info(f"Регистрация нового пользователя через keyboard_handler: {user_id}")
-        users_data[user_id] = {
-            "username": user.username or user.full_name,
-            "status": "active",
-            "stars": 0,
-            "stars_for_subscription_received": False
-        }
-        save_users_data(users_data)
-
-        # Отправляем сообщение админам о регистрации нового пользователя
-        message_text = (
-            f"Зарегистрирован новый пользователь: "
-            f"<a href='tg://user?id={user.id}'>{user.username or user.full_name}</a>"
-        )
-        for admin_id in ADMIN_IDS:
-            try:
-                await bot.send_message(admin_id, message_text)
-            except Exception as e:
-                logging.error(f"Ошибка при отправке сообщения админу {admin_id}: {e}")
-    elif users_data[user_id].get("status") == "removed":
-        users_data[user_id]["status"] = "active"
-        save_users_data(users_data)
-
-    # Добавляем флаг stars_for_subscription_received, если его нет
-    if "stars_for_subscription_received" not in users_data[user_id]:
-        users_data[user_id]["stars_for_subscription_received"] = False
-        save_users_data(users_data)
-
-
 # Создаем основную клавиатуру
 def get_main_keyboard() -> types.ReplyKeyboardMarkup:
     """
@@ -80,32 +27,17 @@ def get_main_keyboard() -> types.ReplyKeyboardMarkup:
     return types.ReplyKeyboardMarkup(keyboard=keyboard, resize_keyboard=True)
 
 
-@router.message(F.text == "👤 Профиль")
+@router.message(F.text == "👤 Профиль", flags={"register_user": True, "subscription_required": "Для доступа к профилю"})
 async def show_profile(message: types.Message, state: FSMContext) -> None:
     """
     Показывает профиль пользователя: имя, ID, количество звезд и рефералов.
     """
-    # Регистрируем пользователя, если его нет в системе
-    await ensure_user_registered(message.from_user)
-
     # Сначала проверяем, находится ли пользователь в каком-то состоянии
     current_state = await state.get_state()
     if current_state:
         # Если пользователь в каком-то состоянии, сначала очищаем его
         await state.clear()
 
-    # Проверяем подписку на все обязательные каналы
-    is_subscribed = await check_subscription(message.from_user.id)
-    if not is_subscribed:
-        not_subscribed_channels = await get_not_subscribed_channels(message.from_user.id)
-        channels_text = get_channels_text(not_subscribed_channels)
-
-        await message.answer(
-            f"❗ Для доступа к профилю необходимо подписаться на все обязательные каналы.\n\n{channels_text}",
-            reply_markup=get_subscription_keyboard()
-        )
-        return
-
     user_id = str(message.from_user.id)
     username = message.from_user.username or message.from_user.full_name
 
@@ -115,6 +47,8 @@ async def show_profile(message: types.Message, state: FSMContext) -> None:
 
     # Получаем количество рефералов
     ref_count = referral_data.get(user_id, {}).get("count", 0)
+    rank = rank_of(user_id)
+    rank_text = f"{rank} из {ranking_total()}" if rank else "—"
 
     profile_text = (
         f"👤 <b>Ваш профиль</b>\n\n"
@@ -122,6 +56,7 @@ async def show_profile(message: types.Message, state: FSMContext) -> None:
         f"🆔 ID: <code>{user_id}</code>\n"
         f"💫 Звезды: {stars} {get_stars_word(stars)}\n"
         f"👥 Приглашено: {ref_count} {get_invite_word(ref_count)}\n"
+        f"🏆 Место в рейтинге: {rank_text}\n"
     )
 
     # Создаем инлайн-клавиатуру с кнопкой вывода звезд
@@ -132,36 +67,17 @@ async def show_profile(message: types.Message, state: FSMContext) -> None:
     await message.answer(profile_text, reply_markup=inline_kb)
 
 
-# Остальные методы (show_reviews, promo_code_request, process_promo_code, show_ref_link, show_channel, callback_cancel_withdraw)
-# остаются без изменений, но также рекомендуется добавить ensure_user_registered в начало каждого метода
-
-
-@router.message(F.text == "⭐ Отзывы")
+@router.message(F.text == "⭐ Отзывы", flags={"register_user": True, "subscription_required": "Для доступа к отзывам"})
 async def show_reviews(message: types.Message, state: FSMContext) -> None:
     """
     Отправляет ссылку на канал с отзывами.
     """
-    # Регистрируем пользователя, если его нет в системе
-    await ensure_user_registered(message.from_user)
-
     # Сначала проверяем, находится ли пользователь в каком-то состоянии
     current_state = await state.get_state()
     if current_state:
         # Если пользователь в каком-то состоянии, сначала очищаем его
         await state.clear()
 
-    # Проверяем подписку на все обязательные каналы
-    is_subscribed = await check_subscription(message.from_user.id)
-    if not is_subscribed:
-        not_subscribed_channels = await get_not_subscribed_channels(message.from_user.id)
-        channels_text = get_channels_text(not_subscribed_channels)
-
-        await message.answer(
-            f"❗ Для доступа к отзывам необходимо подписаться на все обязательные каналы.\n\n{channels_text}",
-            reply_markup=get_subscription_keyboard()
-        )
-        return
-
     await message.answer(
         "⭐ <b>Отзывы наших пользователей</b>\n\n"
         "Перейдите по ссылке ниже, чтобы прочитать отзывы о нашем сервисе и оставить свой:\n"
@@ -169,32 +85,17 @@ async def show_reviews(message: types.Message, state: FSMContext) -> None:
     )
 
 
-@router.message(F.text == "🎟 Промокод")
+@router.message(F.text == "🎟 Промокод", flags={"register_user": True, "subscription_required": "Для активации промокода"})
 async def promo_code_request(message: types.Message, state: FSMContext) -> None:
     """
     Обрабатывает запрос на ввод промокода.
     """
-    # Регистрируем пользователя, если его нет в системе
-    await ensure_user_registered(message.from_user)
-
     # Сначала проверяем, находится ли пользователь в каком-то состоянии
     current_state = await state.get_state()
     if current_state:
         # Если пользователь уже в каком-то состоянии, сначала очищаем его
         await state.clear()
 
-    # Проверяем подписку на все обязательные каналы
-    is_subscribed = await check_subscription(message.from_user.id)
-    if not is_subscribed:
-        not_subscribed_channels = await get_not_subscribed_channels(message.from_user.id)
-        channels_text = get_channels_text(not_subscribed_channels)
-
-        await message.answer(
-            f"❗ Для активации промокода необходимо подписаться на все обязательные каналы.\n\n{channels_text}",
-            reply_markup=get_subscription_keyboard()
-        )
-        return
-
     await message.answer(
         "🎟 <b>Введите промокод</b>\n\n"
         "Для получения звезд введите действующий промокод."
@@ -202,38 +103,19 @@ async def promo_code_request(message: types.Message, state: FSMContext) -> None:
     await state.set_state(PromoStates.waiting_for_promo)
 
 
-@router.message(PromoStates.waiting_for_promo)
+@router.message(PromoStates.waiting_for_promo, flags={"register_user": True, "subscription_required": "Для активации промокода"})
 async def process_promo_code(message: types.Message, state: FSMContext) -> None:
     """
     Обрабатывает введенный промокод.
     """
-    # Регистрируем пользователя, если его нет в системе
-    await ensure_user_registered(message.from_user)
-
-    # Проверяем подписку на все обязательные каналы
-    is_subscribed = await check_subscription(message.from_user.id)
-    if not is_subscribed:
-        not_subscribed_channels = await get_not_subscribed_channels(message.from_user.id)
-        channels_text = get_channels_text(not_subscribed_channels)
-
-        await message.answer(
-            f"❗ Для активации промокода необходимо подписаться на все обязательные каналы.\n\n{channels_text}",
-            reply_markup=get_subscription_keyboard()
-        )
-        await state.clear()
-        return
-
     promo_code = message.text.strip().upper()
     user_id = str(message.from_user.id)
 
-    # Используем промокоды из глобальных данных
-    from data import promocodes, save_promocodes
-
     if promo_code in promocodes:
         promo_data = promocodes[promo_code]
 
         # Проверка на однократное использование
-        if promo_data.get("is_single_use", False) and user_id in promo_data.get("used_by", []):
+        if promo_data.get("is_single_use", False) and user_id in promo_data.get("used_by", ()):
             await message.answer("❌ Вы уже использовали этот промокод.")
             await state.clear()
             return
@@ -248,21 +130,19 @@ async def process_promo_code(message: types.Message, state: FSMContext) -> None:
         stars_amount = promo_data.get("stars", 0)
         if stars_amount > 0:
             if user_id in users_data:
-                users_data[user_id]["stars"] = users_data[user_id].get("stars", 0) + stars_amount
-                save_users_data(users_data)
+                add_user_stars(user_id, stars_amount)
+                save_users_data(users_data, user_id)
 
                 # Обновляем данные промокода
                 if promo_data.get("is_single_use", False):
                     # Добавляем пользователя в список использовавших
-                    if "used_by" not in promo_data:
-                        promo_data["used_by"] = []
-                    promo_data["used_by"].append(user_id)
+                    add_promo_activation(promo_code, user_id)
 
                 # Увеличиваем счетчик активаций
                 promo_data["activations"] = promo_data.get("activations", 0) + 1
 
                 # Сохраняем обновленные данные промокода
-                save_promocodes()
+                save_promocodes(promo_code)
 
                 await message.answer(
                     f"✅ <b>Промокод активирован!</b>\n\n"
@@ -278,83 +158,43 @@ async def process_promo_code(message: types.Message, state: FSMContext) -> None:
 
     await state.clear()
 
-@router.message(F.text == "📢 Канал")
+@router.message(F.text == "📢 Канал", flags={"register_user": True, "subscription_required": "Для доступа к каналу"})
 async def show_channel(message: types.Message, state: FSMContext) -> None:
     """
     Отправляет ссылку на основной канал.
     """
-    # Регистрируем пользователя, если его нет в системе
-    await ensure_user_registered(message.from_user)
-
     # Сначала проверяем, находится ли пользователь в каком-то состоянии
     current_state = await state.get_state()
     if current_state:
         # Если пользователь в каком-то состоянии, сначала очищаем его
         await state.clear()
 
-    # Проверяем подписку на все обязательные каналы
-    is_subscribed = await check_subscription(message.from_user.id)
-    if not is_subscribed:
-        not_subscribed_channels = await get_not_subscribed_channels(message.from_user.id)
-        channels_text = get_channels_text(not_subscribed_channels)
-
-        await message.answer(
-            f"❗ Для доступа к каналу необходимо подписаться на все обязательные каналы.\n\n{channels_text}",
-            reply_markup=get_subscription_keyboard()
-        )
-        return
-
     await message.answer(
         "📢 <b>Наш официальный канал</b>\n\n"
         "Перейдите по ссылке, чтобы быть в курсе всех новостей и обновлений:\n"
         "https://t.me/ScroogeMagnat_Info"
     )
 
-@router.message(F.text == "🔗 Реферальная ссылка")
+@router.message(F.text == "🔗 Реферальная ссылка", flags={"register_user": True, "subscription_required": "Для получения реферальной ссылки"})
 async def show_ref_link(message: types.Message, state: FSMContext) -> None:
     """
     Показывает реферальную ссылку пользователя.
     """
-    # Регистрируем пользователя, если его нет в системе
-    await ensure_user_registered(message.from_user)
-
     # Сначала проверяем, находится ли пользователь в каком-то состоянии
     current_state = await state.get_state()
     if current_state:
         # Если пользователь в каком-то состоянии, сначала очищаем его
         await state.clear()
 
-    # Проверяем подписку на все обязательные каналы
-    is_subscribed = await check_subscription(message.from_user.id)
-    if not is_subscribed:
-        not_subscribed_channels = await get_not_subscribed_channels(message.from_user.id)
-        channels_text = get_channels_text(not_subscribed_channels)
-
-        await message.answer(
-            f"❗ Для получения реферальной ссылки необходимо подписаться на все обязательные каналы.\n\n{channels_text}",
-            reply_markup=get_subscription_keyboard()
-        )
-        return
-
     from handlers.start import process_subscriber
     await process_subscriber(message.chat, message.from_user)
 
 
-@router.callback_query(F.data == "cancel_withdraw")
+@router.callback_query(F.data == "cancel_withdraw", flags={"register_user": True, "subscription_required": "Для доступа к этой функции"})
 async def callback_cancel_withdraw(callback: types.CallbackQuery) -> None:
     """
     Обработчик отмены вывода звезд, возвращает к отображению профиля
     """
-    # Регистрируем пользователя, если его нет в системе
-    await ensure_user_registered(callback.from_user)
-
-    # Проверяем подписку на все обязательные каналы
-    is_subscribed = await check_subscription(callback.from_user.id)
-    if not is_subscribed:
-        await callback.answer("Для доступа к этой функции необходимо подписаться на все обязательные каналы.",
-                              show_alert=True)
-        return
-
     user_id = str(callback.from_user.id)
     username = callback.from_user.username or callback.from_user.full_name
 
@@ -364,6 +204,8 @@ async def callback_cancel_withdraw(callback: types.CallbackQuery) -> None:
 
     # Получаем количество рефералов
     ref_count = referral_data.get(user_id, {}).get("count", 0)
+    rank = rank_of(user_id)
+    rank_text = f"{rank} из {ranking_total()}" if rank else "—"
 
     profile_text = (
         f"👤 <b>Ваш профиль</b>\n\n"
@@ -371,6 +213,7 @@ async def callback_cancel_withdraw(callback: types.CallbackQuery) -> None:
         f"🆔 ID: <code>{user_id}</code>\n"
         f"💫 Звезды: {stars} {get_stars_word(stars)}\n"
         f"👥 Приглашено: {ref_count} {get_invite_word(ref_count)}\n"
+        f"🏆 Место в рейтинге: {rank_text}\n"
     )
 
     # Создаем инлайн-клавиатуру с кнопкой вывода звезд
@@ -1,48 +1,409 @@
 from aiogram import types, F
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+import time
+import asyncio
+from collections import OrderedDict, deque
 from bot import bot, router
-from config import ADMIN_IDS
-from data import required_channels
+from config import ADMIN_IDS, MEMBERSHIP_CACHE_TTL, MEMBERSHIP_CACHE_NEGATIVE_TTL, MEMBERSHIP_CACHE_SIZE
+from config import MEMBERSHIP_CHECK_CONCURRENCY, CHANNEL_MEMBERS_MAX_AGE
+from config import CHANNEL_FAILURE_THRESHOLD, CHANNEL_RETRY_INTERVAL, CHANNEL_FAILURE_POLICY
+from config import MEMBERSHIP_CHECK_TIMEOUT, MEMBERSHIP_HEDGE_ENABLED, MEMBERSHIP_HEDGE_MIN_DELAY
+from config import MEMBERSHIP_LATENCY_SAMPLES
+from data import required_channels, get_channel_membership, set_channel_membership, forget_channel_members
 import logging
 
+MEMBER_STATUSES = ("member", "administrator", "creator")
 
-async def check_subscription(user_id: int) -> bool:
-    """Проверяет, подписан ли пользователь на все обязательные каналы."""
-    if not required_channels:
-        # Если нет обязательных каналов, считаем, что пользователь подписан
-        logging.info(f"Проверка подписки для пользователя {user_id}: нет обязательных каналов")
+# Кэш результатов get_chat_member: (user_id, channel_id) -> (подписан, время истечения).
+# Порядок OrderedDict - порядок последнего использования, при переполнении
+# удаляются самые старые записи. Отказ хранится меньше (MEMBERSHIP_CACHE_NEGATIVE_TTL),
+# чтобы пользователь, только что подписавшийся на канал, не ждал истечения кэша.
+_membership_cache = OrderedDict()
+_cache_stats = {"table_hits": 0, "hits": 0, "misses": 0, "coalesced": 0, "short_circuited": 0, "evictions": 0}
+
+# Запросы get_chat_member, которые выполняются сейчас: (user_id, channel_id) -> задача.
+# Одновременные проверки одной пары (двойное нажатие, несколько обработчиков)
+# ждут одну и ту же задачу вместо отдельного запроса к API.
+_inflight: dict[tuple[int, str], asyncio.Task] = {}
+
+# Ограничение одновременных запросов get_chat_member по всему боту,
+# чтобы всплеск нажатий не упирался в лимиты Telegram
+_api_semaphore = asyncio.Semaphore(MEMBERSHIP_CHECK_CONCURRENCY)
+
+
+# Время ответа get_chat_member (секунды) по последним MEMBERSHIP_LATENCY_SAMPLES запросам.
+# Запросы, прерванные по таймауту, сюда не попадают - они учитываются в timeouts.
+_latencies = deque(maxlen=MEMBERSHIP_LATENCY_SAMPLES)
+_latency_stats = {"timeouts": 0, "fallbacks": 0, "hedged": 0, "hedge_wins": 0}
+# Задержка повторного запроса (p95) пересчитывается раз в _HEDGE_DELAY_REFRESH ответов
+_HEDGE_DELAY_REFRESH = 50
+_hedge_delay = {"value": MEMBERSHIP_HEDGE_MIN_DELAY, "samples": 0}
+
+
+def _percentile(values: list[float], percent: float) -> float:
+    """
+    Перцентиль отсортированного списка (ближайший ранг)
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def _record_latency(seconds: float) -> None:
+    _latencies.append(seconds)
+    _hedge_delay["samples"] += 1
+    if _hedge_delay["samples"] >= _HEDGE_DELAY_REFRESH:
+        _hedge_delay["samples"] = 0
+        _hedge_delay["value"] = max(MEMBERSHIP_HEDGE_MIN_DELAY, _percentile(sorted(_latencies), 95))
+
+
+def get_membership_latency_stats() -> dict:
+    values = sorted(_latencies)
+    stats = dict(_latency_stats)
+    stats.update(
+        samples=len(values),
+        p50_ms=_percentile(values, 50) * 1000,
+        p95_ms=_percentile(values, 95) * 1000,
+        p99_ms=_percentile(values, 99) * 1000,
+        hedge_delay_ms=_hedge_delay["value"] * 1000,
+    )
+    return stats
+
+
+class ChannelUnavailable(Exception):
+    """
+    Проверки канала приостановлены после серии ошибок API
+    """
+
+
+class ChannelHealth:
+    """
+    Состояние канала для get_chat_member (автоматический выключатель).
+    После CHANNEL_FAILURE_THRESHOLD ошибок подряд канал считается недоступным
+    и запросы к нему не выполняются. Раз в CHANNEL_RETRY_INTERVAL секунд
+    пропускается один пробный запрос: успех возвращает канал в работу,
+    ошибка откладывает следующую пробу.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.last_error = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        if not self.is_open:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < CHANNEL_RETRY_INTERVAL:
+            return False
+        self.probing = True
         return True
 
-    is_subscribed_to_all = True
+    def record_success(self, channel_id: str) -> None:
+        if self.is_open:
+            logging.info(f"Канал {channel_id} снова доступен, проверки подписки возобновлены")
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.last_error = None
 
-    for channel in required_channels:
-        channel_id = channel.get('id')
-        try:
-            if not channel_id:
-                continue
+    def release_probe(self) -> None:
+        """
+        Снимает отметку пробного запроса, завершившегося без результата (например,
+        отменённого), чтобы следующая проверка могла выполнить новую пробу
+        """
+        self.probing = False
+
+    def record_failure(self, channel_id: str, error: Exception) -> None:
+        self.failures += 1
+        self.last_error = str(error)
+        if self.probing:
+            self.probing = False
+            self.opened_at = time.monotonic()
+        elif not self.is_open and self.failures >= CHANNEL_FAILURE_THRESHOLD:
+            self.opened_at = time.monotonic()
+            logging.warning(f"Канал {channel_id}: {self.failures} ошибок подряд, проверки подписки "
+                            f"приостановлены (повтор через {CHANNEL_RETRY_INTERVAL} с): {error}")
+
+
+# channel_id -> ChannelHealth
+_channel_health: dict[str, ChannelHealth] = {}
+
+
+def _health(channel_id: str) -> ChannelHealth:
+    health = _channel_health.get(channel_id)
+    if health is None:
+        health = _channel_health[channel_id] = ChannelHealth()
+    return health
+
+
+def get_channel_health(channel_id: str) -> ChannelHealth | None:
+    return _channel_health.get(str(channel_id))
+
+
+def reset_channel_health(channel_id: str) -> None:
+    """
+    Возвращает канал в работу (например, после проверки прав бота админом)
+    """
+    _channel_health.pop(str(channel_id), None)
 
-            member = await bot.get_chat_member(int(channel_id), user_id)
-            is_member = member.status in ["member", "administrator", "creator"]
 
-            logging.info(f"Проверка подписки для пользователя {user_id} на канал {channel_id}: "
-                         f"статус {member.status}, результат {is_member}")
+def set_cached_membership(user_id: int, channel_id: str, is_member: bool) -> None:
+    """
+    Запоминает статус подписки (вызывается и при обновлениях chat_member)
+    """
+    key = (int(user_id), str(channel_id))
+    ttl = MEMBERSHIP_CACHE_TTL if is_member else MEMBERSHIP_CACHE_NEGATIVE_TTL
+    _membership_cache[key] = (is_member, time.monotonic() + ttl)
+    _membership_cache.move_to_end(key)
+    while len(_membership_cache) > MEMBERSHIP_CACHE_SIZE:
+        _membership_cache.popitem(last=False)
+        _cache_stats["evictions"] += 1
 
-            if not is_member:
-                is_subscribed_to_all = False
-                break
 
+def invalidate_channel(channel_id: str) -> None:
+    """
+    Удаляет из кэша и таблицы подписок все записи канала
+    (при изменении списка обязательных каналов)
+    """
+    channel_id = str(channel_id)
+    for key in [key for key in _membership_cache if key[1] == channel_id]:
+        del _membership_cache[key]
+    forget_channel_members(channel_id)
+    reset_channel_health(channel_id)
+
+
+def get_table_membership(user_id: int, channel_id: str) -> bool | None:
+    """
+    Статус подписки из таблицы channel_members или None, если он неизвестен.
+    Доверяем свежим записям, кроме отказов, полученных опросом API: если бот
+    не получит обновление о подписке, такой отказ мешал бы пользователю.
+    """
+    record = get_channel_membership(channel_id, user_id)
+    if not record or time.time() - record.get("updated_at", 0) > CHANNEL_MEMBERS_MAX_AGE:
+        return None
+    if not record.get("member") and record.get("source") != "event":
+        return None
+    return bool(record.get("member"))
+
+
+def get_membership_cache_stats() -> dict:
+    stats = dict(_cache_stats)
+    stats["size"] = len(_membership_cache)
+    return stats
+
+
+async def is_channel_member(user_id: int, channel_id: str) -> bool:
+    """
+    Проверяет подписку пользователя на канал: сначала по таблице подписок,
+    затем по кэшу и только после этого запросом к API (одним на все
+    одновременные проверки той же пары пользователь-канал).
+    Ошибки API не кэшируются и передаются вызывающему коду. Если проверки
+    канала приостановлены, запрос не выполняется (ChannelUnavailable).
+    """
+    is_member = get_table_membership(user_id, channel_id)
+    if is_member is not None:
+        _cache_stats["table_hits"] += 1
+        return is_member
+
+    key = (int(user_id), str(channel_id))
+    cached = _membership_cache.get(key)
+    if cached is not None and cached[1] > time.monotonic():
+        _membership_cache.move_to_end(key)
+        _cache_stats["hits"] += 1
+        return cached[0]
+
+    task = _inflight.get(key)
+    if task is not None:
+        _cache_stats["coalesced"] += 1
+    else:
+        if not _health(key[1]).allow():
+            _cache_stats["short_circuited"] += 1
+            raise ChannelUnavailable(channel_id)
+        _cache_stats["misses"] += 1
+        task = asyncio.ensure_future(_fetch_membership(user_id, channel_id))
+        _inflight[key] = task
+        task.add_done_callback(lambda done: _inflight_done(key, done))
+    # shield: отмена одного ожидающего не должна отменять запрос для остальных
+    return await asyncio.shield(task)
+
+
+def _inflight_done(key: tuple[int, str], task: asyncio.Task) -> None:
+    if _inflight.get(key) is task:
+        del _inflight[key]
+    # Ошибку получают ожидающие; если их не осталось, забираем её здесь,
+    # чтобы asyncio не писал в лог "exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+async def _get_chat_member(user_id: int, channel_id: str):
+    started = time.monotonic()
+    member = await bot.get_chat_member(int(channel_id), user_id)
+    _record_latency(time.monotonic() - started)
+    return member
+
+
+async def _hedged_get_chat_member(user_id: int, channel_id: str):
+    """
+    Запрашивает get_chat_member. Если ответа нет дольше обычного (p95),
+    отправляет второй такой же запрос и берёт первый успешный ответ.
+    Вызывается с уже занятым местом в _api_semaphore. Второй запрос отправляется,
+    только если свободное место есть сразу: при очереди он лишь удлинит её.
+    """
+    tasks = [asyncio.ensure_future(_get_chat_member(user_id, channel_id))]
+    try:
+        if MEMBERSHIP_HEDGE_ENABLED:
+            done, _ = await asyncio.wait(tasks, timeout=_hedge_delay["value"])
+            if not done and not _api_semaphore.locked():
+                await _api_semaphore.acquire()
+                _latency_stats["hedged"] += 1
+                hedge = asyncio.ensure_future(_get_chat_member(user_id, channel_id))
+                # Место освобождается и при отмене ещё не начавшейся задачи
+                hedge.add_done_callback(lambda _: _api_semaphore.release())
+                tasks.append(hedge)
+
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not tasks[0]:
+                        _latency_stats["hedge_wins"] += 1
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+def _last_known_membership(user_id: int, channel_id: str) -> bool | None:
+    """
+    Последний известный статус подписки, даже устаревший (для ответа при таймауте)
+    """
+    cached = _membership_cache.get((int(user_id), str(channel_id)))
+    if cached is not None:
+        return cached[0]
+    record = get_channel_membership(channel_id, user_id)
+    if record:
+        return bool(record.get("member"))
+    return None
+
+
+async def _fetch_membership(user_id: int, channel_id: str) -> bool:
+    health = _health(str(channel_id))
+    # Запрос пробный, если канал приостановлен и allow() только что отметил пробу
+    probe = health.probing
+    try:
+        # Таймаут и задержка повторного запроса отсчитываются после получения места:
+        # ожидание в очереди - локальная перегрузка, а не ошибка канала
+        async with _api_semaphore:
+            member = await asyncio.wait_for(_hedged_get_chat_member(user_id, channel_id), MEMBERSHIP_CHECK_TIMEOUT)
+    except asyncio.TimeoutError as e:
+        _latency_stats["timeouts"] += 1
+        health.record_failure(str(channel_id), e)
+        is_member = _last_known_membership(user_id, channel_id)
+        if is_member is None:
+            raise
+        _latency_stats["fallbacks"] += 1
+        logging.warning(f"Таймаут проверки подписки пользователя {user_id} на канал {channel_id}, "
+                        f"используем последний известный статус: {is_member}")
+        return is_member
+    except Exception as e:
+        health.record_failure(str(channel_id), e)
+        raise
+    finally:
+        # Отменённая проба (CancelledError) не учитывается ни успехом, ни ошибкой:
+        # без сброса канал остался бы приостановленным навсегда
+        if probe and health.probing:
+            health.release_probe()
+    health.record_success(str(channel_id))
+    is_member = member.status in MEMBER_STATUSES
+    logging.info(f"Проверка подписки для пользователя {user_id} на канал {channel_id}: "
+                 f"статус {member.status}, результат {is_member}")
+    set_cached_membership(user_id, channel_id, is_member)
+    set_channel_membership(channel_id, user_id, is_member, source="api")
+    return is_member
+
+
+# Состояния подписки на отдельный канал
+STATUS_MEMBER = "member"
+STATUS_NOT_MEMBER = "not_member"
+STATUS_UNKNOWN = "unknown"  # Проверка не удалась (ошибка API)
+STATUS_SKIPPED = "skipped"  # Канал недоступен и не учитывается (CHANNEL_FAILURE_POLICY = "skip")
+
+_SATISFIED = (STATUS_MEMBER, STATUS_SKIPPED)
+
+
+class SubscriptionStatus:
+    """
+    Результат проверки подписки пользователя на все обязательные каналы
+    """
+
+    def __init__(self, channels: list[tuple[dict, str]]):
+        # Список (канал, состояние) в порядке required_channels
+        self.channels = channels
+
+    @property
+    def subscribed(self) -> bool:
+        return all(state in _SATISFIED for _, state in self.channels)
+
+    @property
+    def missing(self) -> list[dict]:
+        """
+        Каналы, подписку на которые нужно оформить (включая непроверенные)
+        """
+        return [channel for channel, state in self.channels if state not in _SATISFIED]
+
+    @property
+    def unknown(self) -> list[dict]:
+        return [channel for channel, state in self.channels if state == STATUS_UNKNOWN]
+
+
+async def get_subscription_status(user_id: int) -> SubscriptionStatus:
+    """
+    Проверяет подписку на все обязательные каналы одновременно, за один проход.
+    Если проверка канала не удалась, он считается неподписанным (STATUS_UNKNOWN).
+    Каналы с приостановленными проверками обрабатываются по CHANNEL_FAILURE_POLICY.
+    """
+    channels = required_channels.checkable()
+
+    async def check(channel: dict) -> str:
+        try:
+            is_member = await is_channel_member(user_id, channel['id'])
+        except ChannelUnavailable:
+            return STATUS_SKIPPED if CHANNEL_FAILURE_POLICY == "skip" else STATUS_UNKNOWN
         except Exception as e:
-            logging.error(f"Ошибка при проверке подписки пользователя {user_id} на канал {channel_id}: {e}")
-            # Если произошла ошибка, считаем что пользователь не подписан на данный канал
-            is_subscribed_to_all = False
-            break
+            logging.error(f"Ошибка при проверке подписки пользователя {user_id} на канал {channel['id']}: {e}")
+            return STATUS_UNKNOWN
+        return STATUS_MEMBER if is_member else STATUS_NOT_MEMBER
+
+    states = await asyncio.gather(*(check(channel) for channel in channels))
+    return SubscriptionStatus(list(zip(channels, states)))
+
+
+async def check_subscription(user_id: int) -> bool:
+    """Проверяет, подписан ли пользователь на все обязательные каналы."""
+    return (await get_subscription_status(user_id)).subscribed
 
-    return is_subscribed_to_all
+
+# Клавиатура подписки собирается заново только после изменения списка каналов
+_keyboard_cache = {"version": None, "markup": None}
 
 
 def get_subscription_keyboard() -> InlineKeyboardMarkup:
     """Возвращает клавиатуру с кнопками для подписки на обязательные каналы и проверки."""
+    if _keyboard_cache["version"] == required_channels.version:
+        return _keyboard_cache["markup"]
+
     keyboard = []
 
     # Добавляем кнопки для всех обязательных каналов
@@ -62,34 +423,14 @@ def get_subscription_keyboard() -> InlineKeyboardMarkup:
         callback_data="check_subscription"
     )])
 
-    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+    markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+    _keyboard_cache.update(version=required_channels.version, markup=markup)
+    return markup
 
 
 async def get_not_subscribed_channels(user_id: int) -> list:
     """Возвращает список каналов, на которые пользователь не подписан."""
-    if not required_channels:
-        return []
-
-    not_subscribed = []
-
-    for channel in required_channels:
-        channel_id = channel.get('id')
-        try:
-            if not channel_id:
-                continue
-
-            member = await bot.get_chat_member(int(channel_id), user_id)
-            is_member = member.status in ["member", "administrator", "creator"]
-
-            if not is_member:
-                not_subscribed.append(channel)
-
-        except Exception as e:
-            logging.error(f"Ошибка при проверке подписки пользователя {user_id} на канал {channel_id}: {e}")
-            # Если произошла ошибка, добавляем канал в список не подписанных
-            not_subscribed.append(channel)
-
-    return not_subscribed
+    return (await get_subscription_status(user_id)).missing
 
 
 def get_channels_text(channels_list: list) -> str:
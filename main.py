@@ -3,38 +3,44 @@ import asyncio
 import logging
 import os
 from aiogram.fsm.storage.memory import MemoryStorage
-from bot import bot
+from bot import bot, load_bot_identity, get_referral_link
 from data import referral_data, users_data
 from utils import save_referral_data, save_users_data
+from storage import run_flusher, shutdown
+from stats import add_user
+from ranking import add_referrer
 
 # Проверка и восстановление поврежденных данных рефералов
 def validate_referral_data():
+    repaired = []
     for user_id, data in list(referral_data.items()):
         if not isinstance(data, dict):
-            referral_data[user_id] = {
-                "bot_link": f"https://t.me/ScroogeMagnat_bot?start={user_id}",
+            add_referrer(user_id, {
+                "bot_link": get_referral_link(user_id),
                 "count": 0,
                 "username": users_data.get(user_id, {}).get("username", "Неизвестно"),
-                "referral_activations": []
-            }
-    save_referral_data(referral_data)
+                "referral_activations": set()
+            })
+            repaired.append(user_id)
+    # Сохраняем только исправленные записи
+    if repaired:
+        save_referral_data(referral_data, *repaired)
 
 def validate_users_data():
+    repaired = []
     for user_id, data in list(users_data.items()):
         if not isinstance(data, dict):
-            users_data[user_id] = {
+            add_user(user_id, {
                 "username": "Неизвестно",
                 "status": "active",
                 "stars": 0,
                 "stars_for_subscription_received": False
-            }
-    save_users_data(users_data)
+            })
+            repaired.append(user_id)
+    if repaired:
+        save_users_data(users_data, *repaired)
 
 async def main() -> None:
-    # Проверка и восстановление данных перед запуском бота
-    validate_referral_data()
-    validate_users_data()
-
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -77,6 +83,10 @@ async def main() -> None:
     from bot import router
     dp.include_router(router)
 
+    # Регистрация пользователя и проверка подписки для всех сообщений и колбэков
+    from middlewares import setup_middlewares
+    setup_middlewares(router)
+
     # Импорт административных обработчиков первым - это важно для приоритета
     from handlers import admin
 
@@ -89,14 +99,50 @@ async def main() -> None:
         start  # Импортируем start последним, так как в нем есть catch-all обработчик
     )
 
-    logging.info("Бот запущен")
+    # Данные бота запрашиваются один раз, обработчики используют сохранённые значения
     while True:
         try:
-            await dp.start_polling(bot)
+            await load_bot_identity()
+            break
         except Exception as e:
-            logging.exception(f"Ошибка в polling: {e}. Перезапуск через 5 секунд...")
+            logging.exception(f"Не удалось получить данные бота: {e}. Повтор через 5 секунд...")
             await asyncio.sleep(5)
 
+    # Проверка и восстановление данных перед запуском бота
+    validate_referral_data()
+    validate_users_data()
+
+    # Запускаем фоновую запись изменённых данных на диск
+    flusher_task = asyncio.create_task(run_flusher())
+
+    # Фоновое выполнение рассылок; прерванные при прошлой остановке продолжаются
+    from broadcast import run_broadcast_jobs
+    broadcast_task = asyncio.create_task(run_broadcast_jobs())
+
+    # Запуск запланированных рассылок; пропущенные во время простоя запускаются сразу
+    from scheduler import run_scheduler
+    scheduler_task = asyncio.create_task(run_scheduler())
+
+    logging.info("Бот запущен")
+    try:
+        while True:
+            try:
+                await dp.start_polling(bot)
+                # Polling завершился штатно (например, по сигналу остановки)
+                break
+            except Exception as e:
+                logging.exception(f"Ошибка в polling: {e}. Перезапуск через 5 секунд...")
+                await asyncio.sleep(5)
+    finally:
+        scheduler_task.cancel()
+        broadcast_task.cancel()
+        # Дожидаемся остановки рассылки: при отмене она снимает отметки с неотправленных
+        # сообщений пачки, и эти изменения должны попасть в сохранение ниже
+        await asyncio.gather(broadcast_task, scheduler_task, return_exceptions=True)
+        flusher_task.cancel()
+        # Принудительно сохраняем все несохранённые изменения перед остановкой
+        await shutdown()
+
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,152 @@
+# middlewares.py
+# Регистрация пользователя и проверка подписки - один раз на обновление.
+#
+# UserMiddleware (внешний, для сообщений и колбэков) передаёт обработчикам:
+# - user_record - запись пользователя из users_data или None;
+# - subscription - SubscriptionCheck, проверка подписки выполняется при первом
+#   обращении и запоминается до конца обработки обновления.
+#
+# RegistrationMiddleware (внутренний) регистрирует пользователя, а удалившего бота
+# снова делает активным, только для обработчиков с флагом register_user
+# (пользовательские команды и меню) и только в личных сообщениях:
+#     @router.message(Command("start"), flags={"register_user": True})
+# Администраторы пользователями бота не регистрируются.
+#
+# SubscriptionGateMiddleware (внутренний) не пускает к обработчику пользователей
+# без подписки. Обработчик помечается флагом:
+#     @router.message(F.text == "...", flags={"subscription_required": "Для доступа к профилю"})
+# Значение флага - начало фразы, которую увидит неподписанный пользователь.
+# Обработчики без флага проверяют подписку сами (через subscription), если нужно.
+import time
+import logging
+from aiogram import BaseMiddleware, types
+from aiogram.dispatcher.flags import get_flag
+from bot import bot, get_referral_link
+from config import ADMIN_IDS
+from data import users_data, referral_data
+from utils import save_users_data, save_referral_data
+from stats import add_user, set_user_status
+from ranking import add_referrer
+from handlers.subscription import get_subscription_status, get_subscription_keyboard, get_channels_text
+
+
+async def ensure_user_registered(user: types.User) -> dict:
+    """
+    Регистрирует пользователя (и его реферальную запись), если его ещё нет,
+    и возвращает запись пользователя из users_data.
+    """
+    user_id = str(user.id)
+
+    if user_id not in referral_data:
+        logging.info(f"Создание данных реферала для {user_id}")
+        add_referrer(user_id, {
+            "bot_link": get_referral_link(user_id),
+            "count": 0,
+            "username": user.username or user.full_name,
+            "referral_activations": set()
+        })
+        save_referral_data(referral_data, user_id)
+
+    if user_id not in users_data:
+        logging.info(f"Регистрация нового пользователя: {user_id}")
+        add_user(user_id, {
+            "username": user.username or user.full_name,
+            "status": "active",
+            "stars": 0,
+            "stars_for_subscription_received": False,
+            "registered_at": int(time.time())
+        })
+        save_users_data(users_data, user_id)
+
+        # Отправляем сообщение админам о регистрации нового пользователя
+        message_text = (
+            f"Зарегистрирован новый пользователь: "
+            f"<a href='tg://user?id={user.id}'>{user.username or user.full_name}</a>"
+        )
+        for admin_id in ADMIN_IDS:
+            try:
+                await bot.send_message(admin_id, message_text)
+            except Exception as e:
+                logging.error(f"Ошибка при отправке сообщения админу {admin_id}: {e}")
+    elif users_data[user_id].get("status") == "removed":
+        set_user_status(user_id, "active")
+        save_users_data(users_data, user_id)
+
+    # Добавляем флаг stars_for_subscription_received, если его нет
+    if "stars_for_subscription_received" not in users_data[user_id]:
+        users_data[user_id]["stars_for_subscription_received"] = False
+        save_users_data(users_data, user_id)
+
+    return users_data[user_id]
+
+
+class SubscriptionCheck:
+    """
+    Проверка подписки пользователя, выполняемая не больше одного раза за обновление
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._status = None
+
+    async def get(self):
+        if self._status is None:
+            self._status = await get_subscription_status(self.user_id)
+        return self._status
+
+
+class UserMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is None or user.is_bot:
+            return await handler(event, data)
+
+        data["user_record"] = users_data.get(str(user.id))
+        data["subscription"] = SubscriptionCheck(user.id)
+        return await handler(event, data)
+
+
+class RegistrationMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if not get_flag(data, "register_user") or user is None or user.is_bot or user.id in ADMIN_IDS:
+            return await handler(event, data)
+
+        # Регистрируем только собеседников бота в личных сообщениях
+        chat = data.get("event_chat")
+        if chat is None or chat.type == "private":
+            data["user_record"] = await ensure_user_registered(user)
+        return await handler(event, data)
+
+
+class SubscriptionGateMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        purpose = get_flag(data, "subscription_required")
+        if not purpose or "subscription" not in data:
+            return await handler(event, data)
+
+        status = await data["subscription"].get()
+        if status.subscribed:
+            return await handler(event, data)
+
+        state = data.get("state")
+        if state is not None:
+            await state.clear()
+
+        if isinstance(event, types.CallbackQuery):
+            await event.answer(f"{purpose} необходимо подписаться на все обязательные каналы.", show_alert=True)
+        else:
+            channels_text = get_channels_text(status.missing)
+            await event.answer(
+                f"❗ {purpose} необходимо подписаться на все обязательные каналы.\n\n{channels_text}",
+                reply_markup=get_subscription_keyboard()
+            )
+        return None
+
+
+def setup_middlewares(router) -> None:
+    for observer in (router.message, router.callback_query):
+        observer.outer_middleware(UserMiddleware())
+        # Внутренние middleware выполняются в порядке подключения: регистрация до проверки подписки
+        observer.middleware(RegistrationMiddleware())
+        observer.middleware(SubscriptionGateMiddleware())
@@ -0,0 +1,170 @@
+# ranking.py
+# Рейтинг рефереров по количеству приглашённых (поле count в referral_data).
+#
+# Пользователи хранятся по корзинам: count -> пользователи с таким количеством
+# (в порядке добавления). Отдельно поддерживаются отсортированный список
+# непустых значений count и дерево Фенвика с размерами корзин, поэтому:
+# - топ-N выдаётся без сортировки всех рефереров;
+# - место пользователя в рейтинге вычисляется за O(log n).
+#
+# Все изменения count и новые записи referral_data должны проходить через
+# add_referrer и increment_count, иначе рейтинг разойдётся с данными.
+import logging
+from bisect import bisect_left, bisect_right, insort
+from data import referral_data
+
+# count -> {user_id: None}, словарь сохраняет порядок добавления
+_buckets: dict[int, dict[str, None]] = {}
+# Непустые значения count по возрастанию
+_counts: list[int] = []
+# user_id -> count
+_user_counts: dict[str, int] = {}
+# Дерево Фенвика: количество пользователей по значениям count (индекс count + 1)
+_tree: list[int] = [0]
+
+
+def _tree_add(count: int, delta: int) -> None:
+    index = count + 1
+    if index >= len(_tree):
+        _grow_tree(index)
+    while index < len(_tree):
+        _tree[index] += delta
+        index += index & -index
+
+
+def _tree_prefix(count: int) -> int:
+    """
+    Количество пользователей с count <= заданного
+    """
+    index = min(count + 1, len(_tree) - 1)
+    total = 0
+    while index > 0:
+        total += _tree[index]
+        index -= index & -index
+    return total
+
+
+def _grow_tree(min_index: int) -> None:
+    """
+    Увеличивает дерево (с запасом в два раза) и заполняет его заново по корзинам
+    """
+    size = max(min_index + 1, 2 * len(_tree))
+    _tree[:] = [0] * size
+    for count, users in _buckets.items():
+        index = count + 1
+        while index < size:
+            _tree[index] += len(users)
+            index += index & -index
+
+
+def _place(user_id: str, count: int) -> None:
+    # Отрицательный count (испорченные данные) дал бы индекс дерева 0, на котором
+    # обход _tree_add не продвигается и зацикливается; в рейтинге такой реферер - с нулём
+    if count < 0:
+        logging.warning(f"Отрицательный count у реферера {user_id}: {count}, учитывается как 0")
+        count = 0
+    # Дерево обновляется до корзин: при расширении оно заполняется по корзинам заново
+    _tree_add(count, 1)
+    bucket = _buckets.get(count)
+    if bucket is None:
+        bucket = _buckets[count] = {}
+        insort(_counts, count)
+    bucket[user_id] = None
+    _user_counts[user_id] = count
+
+
+def _remove(user_id: str) -> None:
+    count = _user_counts.pop(user_id, None)
+    if count is None:
+        return
+    bucket = _buckets[count]
+    del bucket[user_id]
+    if not bucket:
+        del _buckets[count]
+        del _counts[bisect_left(_counts, count)]
+    _tree_add(count, -1)
+
+
+def _count_of(record) -> int:
+    return record.get("count", 0) if isinstance(record, dict) else 0
+
+
+def rebuild() -> None:
+    """
+    Перестраивает рейтинг по данным referral_data
+    """
+    _buckets.clear()
+    _counts.clear()
+    _user_counts.clear()
+    _tree[:] = [0]
+    for user_id, record in referral_data.items():
+        _place(user_id, _count_of(record))
+
+
+def add_referrer(user_id: str, record: dict) -> None:
+    """
+    Добавляет (или заменяет) запись реферера в referral_data
+    """
+    referral_data[user_id] = record
+    _remove(user_id)
+    _place(user_id, _count_of(record))
+
+
+def increment_count(user_id: str, delta: int = 1) -> int:
+    """
+    Увеличивает счётчик приглашённых у реферера. Возвращает новое значение.
+    """
+    record = referral_data[user_id]
+    record["count"] = record.get("count", 0) + delta
+    _remove(user_id)
+    _place(user_id, record["count"])
+    return record["count"]
+
+
+def total() -> int:
+    return len(_user_counts)
+
+
+def top(limit: int, offset: int = 0) -> list[tuple[str, int]]:
+    """
+    Возвращает limit рефереров начиная с позиции offset (по убыванию count)
+    в виде списка (user_id, count)
+    """
+    result = []
+    for count in reversed(_counts):
+        bucket = _buckets[count]
+        if offset >= len(bucket):
+            offset -= len(bucket)
+            continue
+        for user_id in bucket:
+            if offset:
+                offset -= 1
+                continue
+            result.append((user_id, count))
+            if len(result) >= limit:
+                return result
+    return result
+
+
+def users_with_count_above(count: int) -> set[str]:
+    """
+    Рефереры, пригласившие больше count пользователей
+    """
+    result = set()
+    for value in _counts[bisect_right(_counts, count):]:
+        result.update(_buckets[value])
+    return result
+
+
+def rank_of(user_id: str) -> int | None:
+    """
+    Место пользователя в рейтинге (1 + число рефереров с большим count).
+    Пользователи с одинаковым count делят место. None, если записи нет.
+    """
+    count = _user_counts.get(user_id)
+    if count is None:
+        return None
+    return total() - _tree_prefix(count) + 1
+
+
+rebuild()
@@ -0,0 +1,87 @@
+# runtime_config.py
+# Настройки, изменяемые во время работы бота (data/config.json).
+#
+# Значения хранятся в памяти, поэтому чтение не обращается к диску. Изменения
+# из админ-панели проходят через set() и сразу записываются в файл. Правки файла
+# вручную подхватываются по времени изменения (mtime), которое проверяется
+# не чаще раза в RUNTIME_CONFIG_CHECK_INTERVAL секунд.
+import os
+import time
+import logging
+from config import STARS_PER_REFERRAL, RUNTIME_CONFIG_FILE, RUNTIME_CONFIG_CHECK_INTERVAL
+from utils import load_json_data, save_json_data
+
+
+class RuntimeConfig:
+    def __init__(self, filename: str, defaults: dict):
+        self.filename = filename
+        self.defaults = defaults
+        self.values = dict(defaults)
+        self.mtime = None
+        self.checked_at = 0.0
+        self.subscribers = []
+        self.reload()
+
+    def _file_mtime(self) -> float | None:
+        try:
+            return os.stat(self.filename).st_mtime
+        except OSError:
+            return None
+
+    def reload(self) -> None:
+        """
+        Перечитывает файл и оповещает подписчиков об изменившихся значениях
+        """
+        self.mtime = self._file_mtime()
+        values = dict(self.defaults)
+        values.update(load_json_data(self.filename))
+        changed = [key for key in values if values[key] != self.values.get(key)]
+        self.values = values
+        for key in changed:
+            logging.info(f"Настройка {key} изменена в файле {self.filename}: {values[key]}")
+            self._notify(key, values[key])
+
+    def _check_file(self) -> None:
+        now = time.monotonic()
+        if now - self.checked_at < RUNTIME_CONFIG_CHECK_INTERVAL:
+            return
+        self.checked_at = now
+        if self._file_mtime() != self.mtime:
+            self.reload()
+
+    def get(self, key: str):
+        self._check_file()
+        return self.values.get(key)
+
+    def set(self, key: str, value) -> None:
+        """
+        Изменяет значение и сохраняет все настройки в файл
+        """
+        self.values[key] = value
+        save_json_data(self.filename, self.values)
+        self.mtime = self._file_mtime()
+        self._notify(key, value)
+
+    def subscribe(self, callback) -> None:
+        """
+        Регистрирует функцию callback(key, value), вызываемую при изменении настройки
+        """
+        self.subscribers.append(callback)
+
+    def _notify(self, key: str, value) -> None:
+        for callback in self.subscribers:
+            try:
+                callback(key, value)
+            except Exception as e:
+                logging.error(f"Ошибка в обработчике изменения настройки {key}: {e}")
+
+
+runtime_config = RuntimeConfig(RUNTIME_CONFIG_FILE, {"stars_per_referral": STARS_PER_REFERRAL})
+
+
+def get_stars_per_referral() -> int:
+    return runtime_config.get("stars_per_referral")
+
+
+def set_stars_per_referral(value: int) -> None:
+    runtime_config.set("stars_per_referral", value)
@@ -0,0 +1,126 @@
+# scheduler.py
+# Отложенные и повторяющиеся рассылки.
+#
+# Запланированная рассылка (scheduled_broadcasts) хранит ссылку на сообщение,
+# фильтры аудитории (см. segments.py), время запуска run_at и интервал повтора
+# interval (None - однократно). Фоновая задача run_scheduler спит до ближайшего
+# запуска; в срок она выбирает получателей и создаёт задание рассылки
+# (broadcast.create_job), дальше рассылка идёт как обычно.
+#
+# Если бот был выключен в момент запуска, однократная рассылка отправляется
+# сразу после старта, а повторяющаяся - один раз, после чего переносится
+# на ближайшее время в будущем.
+import time
+import asyncio
+import logging
+from datetime import datetime
+from bot import bot
+from config import SCHEDULED_BROADCASTS_FILE
+from data import scheduled_broadcasts
+from storage import schedule_save
+
+# Варианты повтора: имя -> (название, интервал в секундах)
+REPEATS = {
+    "once": ("Однократно", None),
+    "daily": ("Каждый день", 24 * 3600),
+    "weekly": ("Каждую неделю", 7 * 24 * 3600),
+}
+
+# Будит планировщик, когда расписание изменилось
+_schedule_changed = asyncio.Event()
+
+
+def _save(schedule_id: str) -> None:
+    schedule_save(SCHEDULED_BROADCASTS_FILE, keys=(schedule_id,))
+
+
+def add_schedule(from_chat_id: int, message_id: int, segments: list, chat_id: int,
+                 run_at: int, interval: int | None = None) -> str:
+    """
+    Планирует рассылку на run_at (Unix-время). interval - период повтора в секундах.
+    """
+    schedule_id = str(max((int(key) for key in scheduled_broadcasts), default=0) + 1)
+    scheduled_broadcasts[schedule_id] = {
+        "from_chat_id": from_chat_id,
+        "message_id": message_id,
+        "segments": segments,
+        "chat_id": chat_id,
+        "run_at": int(run_at),
+        "interval": interval,
+        "created_at": int(time.time()),
+    }
+    _save(schedule_id)
+    _schedule_changed.set()
+    return schedule_id
+
+
+def cancel_schedule(schedule_id: str) -> bool:
+    if scheduled_broadcasts.pop(schedule_id, None) is None:
+        return False
+    _save(schedule_id)
+    _schedule_changed.set()
+    return True
+
+
+def schedule_text(schedule_id: str) -> str:
+    from segments import describe
+
+    entry = scheduled_broadcasts[schedule_id]
+    repeat = next((title for title, interval in REPEATS.values() if interval == entry["interval"]),
+                  f"каждые {entry['interval']} с")
+    return (
+        f"⏰ <b>#{schedule_id}</b>: {datetime.fromtimestamp(entry['run_at']):%d.%m.%Y %H:%M}, {repeat.lower()}\n"
+        f"Аудитория: {describe(entry['segments'])}"
+    )
+
+
+async def _fire(schedule_id: str) -> None:
+    """
+    Запускает запланированную рассылку и переносит или удаляет запись расписания
+    """
+    from broadcast import create_job, show_job_progress
+    from segments import select_recipients
+
+    entry = scheduled_broadcasts[schedule_id]
+    # Сначала обновляем расписание: ошибка запуска не должна повторяться в цикле
+    if entry["interval"]:
+        now = time.time()
+        while entry["run_at"] <= now:
+            entry["run_at"] += entry["interval"]
+        _save(schedule_id)
+    else:
+        cancel_schedule(schedule_id)
+
+    recipients, _ = select_recipients(entry["segments"])
+    try:
+        progress_message = await bot.send_message(entry["chat_id"], f"⏰ Запланированная рассылка #{schedule_id} запущена")
+        progress_message_id = progress_message.message_id
+    except Exception as e:
+        logging.error(f"Не удалось уведомить о запланированной рассылке #{schedule_id}: {e}")
+        progress_message_id = None
+    job_id = create_job(entry["from_chat_id"], entry["message_id"], recipients,
+                        chat_id=entry["chat_id"], progress_message_id=progress_message_id)
+    logging.info(f"Запланированная рассылка #{schedule_id} запущена как рассылка #{job_id}, получателей {len(recipients)}")
+    await show_job_progress(job_id)
+
+
+async def run_scheduler() -> None:
+    """
+    Фоновая задача: запускает запланированные рассылки в срок
+    """
+    while True:
+        _schedule_changed.clear()
+        now = time.time()
+        due = [schedule_id for schedule_id, entry in scheduled_broadcasts.items() if entry["run_at"] <= now]
+        for schedule_id in sorted(due, key=int):
+            try:
+                await _fire(schedule_id)
+            except Exception as e:
+                logging.exception(f"Ошибка запуска запланированной рассылки #{schedule_id}: {e}")
+
+        next_run = min((entry["run_at"] for entry in scheduled_broadcasts.values()), default=None)
+        timeout = None if next_run is None else max(next_run - time.time(), 0)
+        try:
+            await asyncio.wait_for(_schedule_changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
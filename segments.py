@@ -0,0 +1,96 @@
+# segments.py
+# Выбор аудитории рассылки по фильтрам (сегментам).
+#
+# Фильтры не перебирают users_data и referral_data: каждый сегмент берёт готовое
+# множество ID из поддерживаемых индексов (stats, ranking, таблица подписок,
+# список прошедших капчу), а получатели - пересечение этих множеств
+# с множеством активных пользователей.
+#
+# Фильтр хранится как пара [имя сегмента, значение] (значение None у сегментов
+# без параметра), чтобы его можно было держать в данных FSM.
+import time
+from datetime import datetime
+import ranking
+from stats import active_users, users_with_stars_above, users_registered_after
+from data import captcha_passed_referrals, get_channel_members, required_channels
+
+
+class SegmentError(ValueError):
+    pass
+
+
+def _parse_date(text: str) -> int:
+    try:
+        return int(datetime.strptime(text.strip(), "%d.%m.%Y").timestamp())
+    except ValueError:
+        raise SegmentError("Введите дату в формате ДД.ММ.ГГГГ")
+
+
+def _parse_number(text: str) -> int:
+    try:
+        return int(text.strip())
+    except ValueError:
+        raise SegmentError("Введите целое число")
+
+
+def _never_referred(_) -> set[str]:
+    return active_users - ranking.users_with_count_above(0)
+
+
+# имя -> (название, разбор значения из текста или None, функция значение -> множество ID)
+SEGMENTS = {
+    "registered_after": ("Зарегистрированы после даты", _parse_date, users_registered_after),
+    "stars_above": ("Звёзд больше N", _parse_number, users_with_stars_above),
+    "referrals_above": ("Пригласили больше N", _parse_number, ranking.users_with_count_above),
+    "channel": ("Подписаны на канал", None, get_channel_members),
+    "captcha": ("Прошли капчу по реферальной ссылке", None, lambda _: captcha_passed_referrals),
+    "no_referrals": ("Никого не пригласили", None, _never_referred),
+}
+
+
+def parse_value(name: str, text: str):
+    """
+    Разбирает значение сегмента, введённое администратором
+    """
+    parse = SEGMENTS[name][1]
+    return parse(text) if parse else None
+
+
+def describe(filters: list) -> str:
+    """
+    Текстовое описание фильтров для админ-панели
+    """
+    if not filters:
+        return "все активные пользователи"
+    parts = []
+    for name, value in filters:
+        title = SEGMENTS[name][0]
+        if name == "registered_after":
+            title = f"{title} {datetime.fromtimestamp(value):%d.%m.%Y}"
+        elif name == "channel":
+            channel = required_channels.get(value)
+            title = f"{title} {channel.get('name', value) if channel else value}"
+        elif value is not None:
+            title = title.replace("N", str(value))
+        parts.append(title)
+    return "; ".join(parts)
+
+
+def select_recipients(filters: list) -> tuple[list[str], float]:
+    """
+    Выбирает активных пользователей, подходящих под все фильтры.
+    Возвращает (список ID, время выбора в мс).
+    """
+    start = time.perf_counter()
+    sets = [SEGMENTS[name][2](value) for name, value in filters]
+    if not sets:
+        result = set(active_users)
+    else:
+        # Пересечение начинаем с самого маленького множества
+        sets.sort(key=len)
+        result = sets[0] & active_users
+        for segment in sets[1:]:
+            if not result:
+                break
+            result &= segment
+    return list(result), (time.perf_counter() - start) * 1000
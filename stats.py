@@ -0,0 +1,234 @@
+# stats.py
+# Агрегаты для админ-панели: количество пользователей, активных, удаливших бота
+# и сумма звёзд. Значения поддерживаются приращениями при каждом изменении
+# статуса или баланса, поэтому /admin не перебирает всех пользователей.
+#
+# Все изменения status и stars в users_data должны проходить через функции
+# этого модуля (add_user, set_user_status, add_user_stars), иначе счётчики
+# и индексы разойдутся с данными. verify() находит и исправляет такие расхождения.
+#
+# Здесь же поддерживаются индексы для выбора аудитории рассылок (см. segments.py):
+# множество активных пользователей, пользователи по балансу звёзд и по дате регистрации.
+import logging
+from bisect import bisect_left, bisect_right, insort
+from data import users_data
+
+counters = {
+    "total_users": 0,
+    "active_users": 0,
+    "removed_users": 0,
+    "total_stars": 0,
+}
+
+# Активные пользователи (status "active")
+active_users: set[str] = set()
+# Баланс звёзд -> пользователи с таким балансом; непустые значения баланса по возрастанию
+_stars_buckets: dict[int, set[str]] = {}
+_stars_values: list[int] = []
+# (registered_at, user_id) по возрастанию; у пользователей без даты регистрации - 0
+_registered: list[tuple[int, str]] = []
+
+
+def _count_record(record, sign: int) -> None:
+    """
+    Учитывает запись пользователя в счётчиках (sign=1) или убирает её (sign=-1)
+    """
+    if not isinstance(record, dict):
+        return
+    status = record.get("status")
+    if status == "active":
+        counters["active_users"] += sign
+    elif status == "removed":
+        counters["removed_users"] += sign
+    counters["total_stars"] += sign * record.get("stars", 0)
+
+
+def _index_record(user_id: str, record, sign: int) -> None:
+    """
+    Добавляет запись пользователя в индексы (sign=1) или убирает её (sign=-1)
+    """
+    if not isinstance(record, dict):
+        return
+    stars = record.get("stars", 0)
+    bucket = _stars_buckets.get(stars)
+    if sign > 0:
+        if record.get("status") == "active":
+            active_users.add(user_id)
+        if bucket is None:
+            bucket = _stars_buckets[stars] = set()
+            insort(_stars_values, stars)
+        bucket.add(user_id)
+    else:
+        active_users.discard(user_id)
+        if bucket is not None:
+            bucket.discard(user_id)
+            if not bucket:
+                del _stars_buckets[stars]
+                del _stars_values[bisect_left(_stars_values, stars)]
+
+
+def _registered_key(user_id: str, record) -> tuple[int, str]:
+    registered_at = record.get("registered_at", 0) if isinstance(record, dict) else 0
+    return registered_at, user_id
+
+
+def _calculate() -> dict:
+    """
+    Считает агрегаты полным проходом по users_data
+    """
+    result = dict.fromkeys(counters, 0)
+    result["total_users"] = len(users_data)
+    for record in users_data.values():
+        if not isinstance(record, dict):
+            continue
+        status = record.get("status")
+        if status == "active":
+            result["active_users"] += 1
+        elif status == "removed":
+            result["removed_users"] += 1
+        result["total_stars"] += record.get("stars", 0)
+    return result
+
+
+def _build_indexes() -> tuple[set[str], dict[int, set[str]], list[tuple[int, str]]]:
+    """
+    Строит индексы полным проходом по users_data:
+    (активные пользователи, корзины баланса звёзд, список регистраций)
+    """
+    active = set()
+    buckets = {}
+    for user_id, record in users_data.items():
+        if not isinstance(record, dict):
+            continue
+        if record.get("status") == "active":
+            active.add(user_id)
+        buckets.setdefault(record.get("stars", 0), set()).add(user_id)
+    registered = sorted(_registered_key(user_id, record) for user_id, record in users_data.items())
+    return active, buckets, registered
+
+
+def _set_indexes(active: set[str], buckets: dict[int, set[str]], registered: list[tuple[int, str]]) -> None:
+    # Изменяем объекты на месте: segments импортирует active_users напрямую
+    active_users.clear()
+    active_users.update(active)
+    _stars_buckets.clear()
+    _stars_buckets.update(buckets)
+    _stars_values[:] = sorted(buckets)
+    _registered[:] = registered
+
+
+def _star_pairs(values: list[int], buckets: dict[int, set[str]]) -> set[tuple[int, str]]:
+    # Пары (баланс, user_id) в том виде, в котором их видит users_with_stars_above
+    return {(stars, user_id) for stars in values for user_id in buckets.get(stars, ())}
+
+
+def rebuild() -> None:
+    """
+    Пересчитывает все счётчики и индексы по данным users_data
+    """
+    counters.update(_calculate())
+    _set_indexes(*_build_indexes())
+
+
+def verify() -> dict:
+    """
+    Сверяет счётчики и индексы сегментов с полным пересчётом. Возвращает расхождения
+    в виде {имя: (было, стало)} и исправляет их.
+    """
+    actual = _calculate()
+    mismatches = {name: (counters[name], value) for name, value in actual.items() if counters[name] != value}
+    if mismatches:
+        logging.warning(f"Счётчики статистики разошлись с данными, пересчитываем: {mismatches}")
+        counters.update(actual)
+
+    # Индексы сравниваем по содержимому; для них "было/стало" - размеры и число расхождений
+    active, buckets, registered = _build_indexes()
+    indexes = {
+        "index:active_users": (active_users, active),
+        "index:stars": (_star_pairs(_stars_values, _stars_buckets), _star_pairs(sorted(buckets), buckets)),
+        "index:registered_at": (set(_registered), set(registered)),
+    }
+    index_mismatches = {}
+    for name, (old, new) in indexes.items():
+        differences = len(old ^ new)
+        if differences:
+            index_mismatches[name] = (len(old), f"{len(new)} (расхождений: {differences})")
+    if index_mismatches:
+        logging.warning(f"Индексы сегментов разошлись с данными, перестраиваем: {index_mismatches}")
+        _set_indexes(active, buckets, registered)
+        mismatches.update(index_mismatches)
+    return mismatches
+
+
+def get_counters() -> dict:
+    return dict(counters)
+
+
+def add_user(user_id: str, record: dict) -> None:
+    """
+    Добавляет (или заменяет) запись пользователя в users_data
+    """
+    if user_id in users_data:
+        old = users_data[user_id]
+        _count_record(old, -1)
+        _index_record(user_id, old, -1)
+        index = bisect_left(_registered, _registered_key(user_id, old))
+        if index < len(_registered) and _registered[index][1] == user_id:
+            del _registered[index]
+    else:
+        counters["total_users"] += 1
+    users_data[user_id] = record
+    _count_record(record, 1)
+    _index_record(user_id, record, 1)
+    insort(_registered, _registered_key(user_id, record))
+
+
+def set_user_status(user_id: str, status: str, reason: str | None = None) -> None:
+    """
+    Меняет статус пользователя ("active" / "removed").
+    reason - причина отключения (removed_reason), например "blocked" или "deactivated".
+    """
+    record = users_data[user_id]
+    _count_record(record, -1)
+    _index_record(user_id, record, -1)
+    record["status"] = status
+    if reason:
+        record["removed_reason"] = reason
+    else:
+        record.pop("removed_reason", None)
+    _count_record(record, 1)
+    _index_record(user_id, record, 1)
+
+
+def add_user_stars(user_id: str, amount: int) -> int:
+    """
+    Начисляет пользователю звёзды (amount может быть отрицательным).
+    Возвращает новый баланс.
+    """
+    record = users_data[user_id]
+    _index_record(user_id, record, -1)
+    record["stars"] = record.get("stars", 0) + amount
+    counters["total_stars"] += amount
+    _index_record(user_id, record, 1)
+    return record["stars"]
+
+
+def users_with_stars_above(amount: int) -> set[str]:
+    """
+    Пользователи, у которых звёзд больше amount
+    """
+    result = set()
+    for stars in _stars_values[bisect_right(_stars_values, amount):]:
+        result |= _stars_buckets[stars]
+    return result
+
+
+def users_registered_after(timestamp: int) -> set[str]:
+    """
+    Пользователи, зарегистрированные позже timestamp (Unix-время)
+    """
+    start = bisect_right(_registered, (timestamp, "\uffff"))
+    return {user_id for _, user_id in _registered[start:]}
+
+
+rebuild()
@@ -0,0 +1,766 @@
+# storage.py
+# Слой сохранения данных с отложенной записью (write-behind).
+# Обработчики только помечают хранилище (или отдельные его записи) как изменённые,
+# а запись выполняется пачкой: по таймеру или при накоплении заданного числа изменений.
+#
+# Запись не блокирует цикл событий: в цикле снимается согласованный снимок данных,
+# а сериализация и запись на диск выполняются в пуле потоков. Для каждого хранилища
+# одновременно выполняется не больше одной записи, изменения, пришедшие во время записи,
+# попадут в следующий снимок.
+#
+# Поддерживаются три способа хранения (STORAGE_BACKEND в config.py):
+# - "json"   - каждый набор данных целиком хранится в своём JSON-файле;
+# - "sqlite" - данные хранятся в базе SQLite (режим WAL), изменения записываются построчно;
+# - "journal" - каждое изменение сразу дописывается компактной записью в журнал,
+#               а JSON-файлы периодически пересобираются из памяти (компактизация).
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import logging
+import threading
+from config import SAVE_FLUSH_INTERVAL, SAVE_MAX_PENDING_WRITES, STORAGE_BACKEND, SQLITE_DB_FILE
+from config import JOURNAL_FILE, JOURNAL_COMPACT_SIZE, JOURNAL_FSYNC
+from utils import load_json_data, write_json_file, json_default
+
+
+def copy_tree(value):
+    """
+    Копирует вложенные словари, списки и множества, чтобы снимок данных
+    не менялся, пока он сериализуется в другом потоке.
+    """
+    if isinstance(value, dict):
+        return {key: copy_tree(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [copy_tree(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        # Элементы множеств неизменяемы, достаточно поверхностной копии
+        return set(value)
+    return value
+
+
+class Store:
+    """
+    Описание одного сохраняемого набора данных.
+
+    layout определяет, как данные раскладываются по таблицам SQLite:
+    - "rows"     - словарь записей {ключ: dict}, каждая запись хранится отдельной строкой;
+    - "set"      - множество идентификаторов, каждый хранится отдельной строкой;
+    - "document" - произвольный документ, хранится целиком.
+    """
+
+    def __init__(self, name: str, filename: str, data, layout: str = "document", encode=None,
+                 columns: tuple = (), member_field: str | None = None, member_table: str | None = None):
+        self.name = name
+        self.filename = filename
+        self.data = data
+        self.layout = layout
+        # Функция преобразования данных в формат JSON-файла (например, множество -> список)
+        self.encode = encode
+        # Поля записи, которые выносятся в отдельные индексируемые колонки
+        self.columns = columns
+        # Поле-коллекция записи, которое хранится в отдельной таблице (одна строка на элемент)
+        self.member_field = member_field
+        self.member_table = member_table
+        self.full_dirty = False
+        self.dirty_keys: set = set()
+        # Изменения элементов поля-коллекции: ключ -> {элемент: True (добавлен) / False (удалён)}
+        self.member_changes: dict[str, dict[str, bool]] = {}
+        # Коллекции записей, сохранённые целиком последними: если у записи появился
+        # новый объект коллекции, при следующей записи она сохраняется полностью
+        self.saved_members: dict[str, set] = {}
+        # Сколько раз хранилище помечалось изменённым с последней записи
+        self.pending_writes = 0
+        # Выполняющаяся запись этого хранилища (не больше одной одновременно)
+        self.write_task: asyncio.Task | None = None
+
+    @property
+    def dirty(self) -> bool:
+        return self.full_dirty or bool(self.dirty_keys) or bool(self.member_changes)
+
+    @property
+    def writing(self) -> bool:
+        return self.write_task is not None and not self.write_task.done()
+
+    def snapshot(self):
+        return self.encode(self.data) if self.encode else self.data
+
+    def track_members(self) -> None:
+        """
+        Запоминает коллекции всех записей как сохранённые целиком
+        """
+        if self.member_field and self.layout == "rows":
+            self.saved_members = {
+                key: row.get(self.member_field) for key, row in self.data.items() if isinstance(row, dict)
+            }
+
+    def row_copy(self, key: str):
+        """
+        Копия записи для сохранения. Поле-коллекция включается в копию, только если
+        коллекция заменена целиком с последней записи; изменения отдельных элементов
+        сохраняются через schedule_member_save.
+        """
+        row = self.data.get(key)
+        if not self.member_field or not isinstance(row, dict):
+            self.saved_members.pop(key, None)
+            return copy_tree(row)
+        members = row.get(self.member_field)
+        copy = {field: copy_tree(value) for field, value in row.items() if field != self.member_field}
+        if members is not self.saved_members.get(key):
+            copy[self.member_field] = set(members or ())
+            self.saved_members[key] = members
+        return copy
+
+
+class JsonBackend:
+    """
+    Хранение в JSON-файлах: при любом изменении файл перезаписывается целиком.
+    """
+
+    def load(self, store: Store, decode=None):
+        raw = load_json_data(store.filename)
+        return decode(raw) if decode else raw
+
+    def prepare(self, store: Store):
+        """
+        Снимает снимок данных (выполняется в цикле событий).
+        """
+        return store.filename, copy_tree(store.snapshot())
+
+    def execute(self, job) -> int:
+        """
+        Сериализует и записывает снимок (выполняется в пуле потоков).
+        """
+        filename, payload = job
+        write_json_file(filename, payload)
+        return 1
+
+
+class SqliteBackend:
+    """
+    Хранение в базе SQLite: записываются только изменённые строки.
+    """
+
+    def __init__(self, db_file: str):
+        os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS store_meta (name TEXT PRIMARY KEY, migrated_at REAL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS documents (name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.conn.commit()
+        # Соединение одно на все хранилища, транзакции из разных потоков выполняются по очереди
+        self.lock = threading.Lock()
+
+    def _create_tables(self, store: Store) -> None:
+        if store.layout == "rows":
+            columns = "".join(f", {column}" for column in store.columns)
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {store.name} (key TEXT PRIMARY KEY{columns}, data TEXT NOT NULL)")
+            for column in store.columns:
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{store.name}_{column} ON {store.name} ({column})")
+            if store.member_table:
+                self.conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {store.member_table} "
+                    f"(key TEXT NOT NULL, member TEXT NOT NULL, PRIMARY KEY (key, member))"
+                )
+                self.conn.execute(
+                    f"CREATE INDEX IF NOT EXISTS idx_{store.member_table}_member ON {store.member_table} (member)"
+                )
+        elif store.layout == "set":
+            self.conn.execute(f"CREATE TABLE IF NOT EXISTS {store.name} (member TEXT PRIMARY KEY)")
+        self.conn.commit()
+
+    def load(self, store: Store, decode=None):
+        self._create_tables(store)
+
+        migrated = self.conn.execute("SELECT 1 FROM store_meta WHERE name = ?", (store.name,)).fetchone()
+        if not migrated:
+            # Первый запуск в режиме SQLite: переносим данные из JSON-файла
+            raw = load_json_data(store.filename)
+            store.data = decode(raw) if decode else raw
+            self.execute((store, None, store.snapshot() if store.layout == "document" else store.data, None))
+            self.conn.execute("INSERT INTO store_meta (name, migrated_at) VALUES (?, ?)", (store.name, time.time()))
+            self.conn.commit()
+            logging.info(f"Данные {store.filename} перенесены в SQLite (таблица {store.name})")
+            return store.data
+
+        if store.layout == "rows":
+            data = {key: json.loads(row) for key, row in self.conn.execute(f"SELECT key, data FROM {store.name}")}
+            if store.member_table:
+                for row in data.values():
+                    if isinstance(row, dict):
+                        row[store.member_field] = set()
+                for key, member in self.conn.execute(f"SELECT key, member FROM {store.member_table}"):
+                    if isinstance(data.get(key), dict):
+                        data[key][store.member_field].add(member)
+            return data
+        if store.layout == "set":
+            return {member for (member,) in self.conn.execute(f"SELECT member FROM {store.name}")}
+
+        row = self.conn.execute("SELECT data FROM documents WHERE name = ?", (store.name,)).fetchone()
+        raw = json.loads(row[0]) if row else {}
+        return decode(raw) if decode else raw
+
+    def prepare(self, store: Store):
+        """
+        Снимает снимок изменённых данных (выполняется в цикле событий).
+        Возвращает (store, keys, snapshot, member_changes): keys равен None при полной перезаписи.
+        """
+        if store.layout == "document":
+            return store, None, copy_tree(store.snapshot()), None
+        if store.full_dirty:
+            store.track_members()
+            return store, None, copy_tree(store.data), None
+        if store.layout == "rows":
+            return (store, set(store.dirty_keys), {key: store.row_copy(key) for key in store.dirty_keys},
+                    {key: dict(changes) for key, changes in store.member_changes.items()})
+        return store, set(store.dirty_keys), {key: key in store.data for key in store.dirty_keys}, None
+
+    def _row_values(self, store: Store, key: str, row) -> tuple:
+        if not isinstance(row, dict):
+            return (key, *(None for _ in store.columns), json.dumps(row, ensure_ascii=False, default=json_default))
+        stored = {field: value for field, value in row.items() if field != store.member_field}
+        return (key, *(row.get(column) for column in store.columns),
+                json.dumps(stored, ensure_ascii=False, default=json_default))
+
+    def _members(self, store: Store, key: str, row) -> list:
+        if not isinstance(row, dict):
+            return []
+        return [(key, member) for member in row.get(store.member_field) or ()]
+
+    def _upsert_sql(self, store: Store) -> str:
+        columns = ", ".join(("key", *store.columns, "data"))
+        placeholders = ", ".join("?" for _ in range(len(store.columns) + 2))
+        return f"INSERT OR REPLACE INTO {store.name} ({columns}) VALUES ({placeholders})"
+
+    def _write_all(self, store: Store, data) -> int:
+        """
+        Полностью перезаписывает таблицы хранилища снимком данных.
+        """
+        if store.layout == "rows":
+            self.conn.execute(f"DELETE FROM {store.name}")
+            self.conn.executemany(
+                self._upsert_sql(store),
+                (self._row_values(store, key, row) for key, row in data.items())
+            )
+            if store.member_table:
+                self.conn.execute(f"DELETE FROM {store.member_table}")
+                for key, row in data.items():
+                    self.conn.executemany(
+                        f"INSERT OR IGNORE INTO {store.member_table} (key, member) VALUES (?, ?)",
+                        self._members(store, key, row)
+                    )
+            return len(data)
+        if store.layout == "set":
+            self.conn.execute(f"DELETE FROM {store.name}")
+            self.conn.executemany(f"INSERT INTO {store.name} (member) VALUES (?)", ((member,) for member in data))
+            return len(data)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO documents (name, data) VALUES (?, ?)",
+            (store.name, json.dumps(data, ensure_ascii=False, default=json_default))
+        )
+        return 1
+
+    def _write_keys(self, store: Store, keys: set, snapshot: dict, member_changes: dict | None) -> int:
+        """
+        Записывает только изменённые строки хранилища и изменённые элементы коллекций.
+        """
+        if store.layout == "rows":
+            upsert_sql = self._upsert_sql(store)
+            member_sql = f"INSERT OR IGNORE INTO {store.member_table} (key, member) VALUES (?, ?)"
+            for key in keys:
+                row = snapshot[key]
+                if row is None:
+                    self.conn.execute(f"DELETE FROM {store.name} WHERE key = ?", (key,))
+                else:
+                    self.conn.execute(upsert_sql, self._row_values(store, key, row))
+                # Элементы перезаписываются целиком, только если запись удалена
+                # или её коллекция заменена (тогда она есть в снимке, см. Store.row_copy)
+                if store.member_table and (not isinstance(row, dict) or store.member_field in row):
+                    self.conn.execute(f"DELETE FROM {store.member_table} WHERE key = ?", (key,))
+                    self.conn.executemany(member_sql, self._members(store, key, row))
+            if not store.member_table or not member_changes:
+                return len(keys)
+            changes = [(key, member, present) for key, members in member_changes.items()
+                       if snapshot.get(key, True) is not None for member, present in members.items()]
+            self.conn.executemany(member_sql, ((key, member) for key, member, present in changes if present))
+            self.conn.executemany(
+                f"DELETE FROM {store.member_table} WHERE key = ? AND member = ?",
+                ((key, member) for key, member, present in changes if not present)
+            )
+            return len(keys) + len(changes)
+        else:
+            for key in keys:
+                if snapshot[key]:
+                    self.conn.execute(f"INSERT OR IGNORE INTO {store.name} (member) VALUES (?)", (key,))
+                else:
+                    self.conn.execute(f"DELETE FROM {store.name} WHERE member = ?", (key,))
+        return len(keys)
+
+    def execute(self, job) -> int:
+        """
+        Записывает снимок в базу одной транзакцией (выполняется в пуле потоков).
+        """
+        store, keys, snapshot, member_changes = job
+        with self.lock, self.conn:
+            if keys is None:
+                return self._write_all(store, snapshot)
+            return self._write_keys(store, keys, snapshot, member_changes)
+
+
+class JournalBackend(JsonBackend):
+    """
+    Хранение в JSON-файлах с журналом изменений.
+
+    Каждое изменение сразу дописывается в конец журнала одной строкой:
+    {"s": хранилище, "k": ключ, "v": новое значение записи},
+    {"s": хранилище, "k": ключ, "m": элемент, "a": 1/0} - элемент поля-коллекции
+    добавлен/удалён, или {"s": хранилище, "all": содержимое целиком}. Поле-коллекция
+    (например, referral_activations) попадает в значение записи, только если
+    коллекция заменена целиком, иначе её изменения пишутся отдельными элементами.
+    Стоимость изменения зависит только от размера изменения, а не от размера
+    записи или всех данных.
+
+    JSON-файлы (снимки) пересобираются при компактизации: журнал переименовывается
+    в JOURNAL_FILE.1, снимается снимок всех хранилищ, файлы атомарно перезаписываются,
+    после чего старый журнал удаляется. При запуске журналы применяются поверх снимков.
+    """
+
+    def __init__(self, journal_file: str):
+        self.journal_file = journal_file
+        self.rotated_file = journal_file + ".1"
+        os.makedirs(os.path.dirname(journal_file), exist_ok=True)
+        # Записи журнала, ещё не применённые к загружаемым хранилищам
+        self.replay: dict[str, list] = {}
+        self.replayed = 0
+        for path in (self.rotated_file, self.journal_file):
+            self._read_journal(path)
+        self.handle = open(self.journal_file, "a", encoding="utf-8")
+        self.size = os.path.getsize(self.journal_file)
+        if self.size and not self._ends_with_newline():
+            # Обрываем недописанную строку, чтобы новые записи не склеились с ней
+            self.handle.write("\n")
+            self.handle.flush()
+            self.size += 1
+        if os.path.exists(self.rotated_file):
+            self.size += os.path.getsize(self.rotated_file)
+        self.compacting = False
+
+    def _read_journal(self, path: str) -> None:
+        if not os.path.exists(path):
+            return
+        with open(path, "r", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Недописанная последняя строка после аварийной остановки
+                    logging.error(f"Повреждённая запись журнала {path}, строка {line_number}, пропускаем")
+                    continue
+                self.replay.setdefault(record["s"], []).append(record)
+
+    def _ends_with_newline(self) -> bool:
+        with open(self.journal_file, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            return f.read(1) == b"\n"
+
+    def load(self, store: Store, decode=None):
+        data = super().load(store, decode)
+        records = self.replay.pop(store.name, [])
+        for record in records:
+            data = self._apply(store, data, record, decode)
+        if records:
+            self.replayed += len(records)
+            logging.info(f"Применено записей журнала для {store.filename}: {len(records)}")
+        return data
+
+    def _apply(self, store: Store, data, record: dict, decode):
+        if "all" in record:
+            return decode(record["all"]) if decode else record["all"]
+        if "m" in record:
+            row = data.get(record["k"])
+            if isinstance(row, dict):
+                members = row.setdefault(store.member_field, set())
+                if record["a"]:
+                    members.add(record["m"])
+                else:
+                    members.discard(record["m"])
+            return data
+        key, value = record["k"], record["v"]
+        if store.layout == "set":
+            if value:
+                data.add(key)
+            else:
+                data.discard(key)
+        elif value is None:
+            data.pop(key, None)
+        else:
+            if store.member_field and isinstance(value, dict):
+                if store.member_field in value:
+                    value[store.member_field] = set(value[store.member_field] or ())
+                else:
+                    # Коллекция не менялась целиком: сохраняем накопленную из журнала и снимка
+                    old = data.get(key)
+                    value[store.member_field] = old.get(store.member_field, set()) if isinstance(old, dict) else set()
+            data[key] = value
+        return data
+
+    def record(self, store: Store, keys) -> int:
+        """
+        Дописывает изменения в журнал. Возвращает количество записей.
+        """
+        if keys and store.layout in ("rows", "set"):
+            if store.layout == "rows":
+                records = [{"s": store.name, "k": key, "v": store.row_copy(key)} for key in keys]
+            else:
+                records = [{"s": store.name, "k": key, "v": key in store.data} for key in keys]
+        else:
+            records = [{"s": store.name, "all": store.snapshot()}]
+            store.track_members()
+        return self._append(records)
+
+    def record_member(self, store: Store, key: str, member: str, present: bool) -> int:
+        """
+        Дописывает в журнал добавление или удаление одного элемента поля-коллекции
+        """
+        return self._append([{"s": store.name, "k": key, "m": member, "a": 1 if present else 0}])
+
+    def _append(self, records: list) -> int:
+        lines = "".join(
+            json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=json_default) + "\n"
+            for record in records
+        )
+        self.handle.write(lines)
+        self.handle.flush()
+        if JOURNAL_FSYNC:
+            os.fsync(self.handle.fileno())
+        self.size += len(lines.encode("utf-8"))
+        return len(records)
+
+    def rotate(self) -> None:
+        """
+        Начинает новый журнал. Записи старого журнала войдут в снимок,
+        который снимается сразу после ротации.
+        """
+        self.handle.close()
+        if os.path.exists(self.rotated_file):
+            # Предыдущая компактизация не завершилась: дописываем текущий журнал к старому
+            with open(self.journal_file, "r", encoding="utf-8") as src, \
+                    open(self.rotated_file, "a", encoding="utf-8") as dst:
+                dst.write(src.read())
+            os.remove(self.journal_file)
+        else:
+            os.replace(self.journal_file, self.rotated_file)
+        self.handle = open(self.journal_file, "a", encoding="utf-8")
+        self.size = 0
+
+    def finish_compaction(self) -> None:
+        if os.path.exists(self.rotated_file):
+            os.remove(self.rotated_file)
+
+
+if STORAGE_BACKEND == "sqlite":
+    _backend = SqliteBackend(SQLITE_DB_FILE)
+elif STORAGE_BACKEND == "journal":
+    _backend = JournalBackend(JOURNAL_FILE)
+else:
+    _backend = JsonBackend()
+
+_stores: dict[str, Store] = {}
+_pending_total = 0
+# Событие для внеочередного сброса при достижении порога изменений
+_flush_requested = asyncio.Event()
+
+_stats = {
+    "flushes": 0,
+    "items_written": 0,
+    "writes_requested": 0,
+    "writes_coalesced": 0,
+    "write_errors": 0,
+    "last_flush_ms": 0.0,
+    "max_flush_ms": 0.0,
+    "total_flush_ms": 0.0,
+    "last_snapshot_ms": 0.0,
+    "max_snapshot_ms": 0.0,
+    "journal_records": 0,
+    "compactions": 0,
+    "last_compaction_ms": 0.0,
+}
+
+
+def open_store(name: str, filename: str, layout: str = "document", decode=None, encode=None,
+               columns: tuple = (), member_field: str | None = None, member_table: str | None = None):
+    """
+    Регистрирует набор данных и загружает его из выбранного хранилища.
+
+    :param name: Имя набора данных (имя таблицы в SQLite)
+    :param filename: JSON-файл набора данных
+    :param decode: Преобразование содержимого JSON-файла в данные в памяти
+    :param encode: Обратное преобразование данных в памяти в содержимое JSON-файла
+    :return: Загруженные данные
+    """
+    store = Store(name, filename, None, layout, encode, columns, member_field, member_table)
+    store.data = _backend.load(store, decode)
+    store.track_members()
+    _stores[filename] = store
+    return store.data
+
+
+def schedule_save(filename: str, data=None, keys=None) -> None:
+    """
+    Помечает хранилище как изменённое. Фактическая запись произойдёт
+    при ближайшем сбросе (по таймеру, по порогу или при остановке бота).
+
+    Если переданы keys, изменёнными считаются только эти записи
+    (в режиме SQLite будут перезаписаны только соответствующие строки).
+    """
+    store = _stores.get(filename)
+    if store is None:
+        if data is None:
+            logging.error(f"Попытка сохранить незарегистрированное хранилище {filename}")
+            return
+        store = Store(os.path.splitext(os.path.basename(filename))[0], filename, data)
+        _stores[filename] = store
+    elif data is not None:
+        store.data = data
+
+    _stats["writes_requested"] += 1
+
+    if isinstance(_backend, JournalBackend):
+        # В режиме журнала изменение сохраняется сразу, файлы пересоберёт компактизация
+        try:
+            _stats["journal_records"] += _backend.record(store, [str(key) for key in keys or ()])
+        except Exception as e:
+            logging.error(f"Ошибка записи в журнал для {filename}: {e}")
+        if _backend.size >= JOURNAL_COMPACT_SIZE:
+            _flush_requested.set()
+        return
+
+    if keys:
+        store.dirty_keys.update(str(key) for key in keys)
+    else:
+        store.full_dirty = True
+    _count_pending(store)
+
+
+def schedule_member_save(filename: str, key, member, present: bool = True) -> None:
+    """
+    Помечает добавление (present=True) или удаление одного элемента поля-коллекции
+    записи key (member_field хранилища). В режиме SQLite записывается одна строка
+    таблицы элементов, а не вся коллекция. Остальные поля записи сохраняются
+    через schedule_save.
+    """
+    store = _stores.get(filename)
+    if store is None or not store.member_field:
+        logging.error(f"Хранилище {filename} не содержит полей-коллекций")
+        return
+
+    _stats["writes_requested"] += 1
+
+    if isinstance(_backend, JournalBackend):
+        try:
+            _stats["journal_records"] += _backend.record_member(store, str(key), str(member), present)
+        except Exception as e:
+            logging.error(f"Ошибка записи в журнал для {filename}: {e}")
+        if _backend.size >= JOURNAL_COMPACT_SIZE:
+            _flush_requested.set()
+        return
+
+    store.member_changes.setdefault(str(key), {})[str(member)] = present
+    _count_pending(store)
+
+
+def _count_pending(store: Store) -> None:
+    global _pending_total
+
+    store.pending_writes += 1
+    _pending_total += 1
+
+    # Если изменений накопилось слишком много, не ждем таймера
+    if _pending_total >= SAVE_MAX_PENDING_WRITES:
+        _flush_requested.set()
+
+
+async def _write(store: Store, job, pending_writes: int) -> int:
+    """
+    Выполняет запись снимка в пуле потоков и учитывает статистику.
+    """
+    try:
+        items = await asyncio.to_thread(_backend.execute, job)
+    except Exception as e:
+        logging.error(f"Ошибка записи данных {store.filename}: {e}")
+        _stats["write_errors"] += 1
+        # Не теряем изменения: хранилище будет записано целиком при следующем сбросе
+        store.full_dirty = True
+        store.pending_writes += pending_writes
+        return 0
+    _stats["items_written"] += items
+    _stats["writes_coalesced"] += max(pending_writes - items, 0)
+    return items
+
+
+def _start_write(store: Store) -> asyncio.Task:
+    """
+    Снимает снимок хранилища и запускает его запись
+    """
+    job = _backend.prepare(store)
+    pending_writes = store.pending_writes
+    store.full_dirty = False
+    store.dirty_keys = set()
+    store.member_changes = {}
+    store.pending_writes = 0
+    store.write_task = asyncio.create_task(_write(store, job, pending_writes))
+    return store.write_task
+
+
+async def save_now(*filenames: str) -> bool:
+    """
+    Записывает изменения указанных хранилищ, не дожидаясь таймера, и ждёт
+    окончания записи. Нужна для контрольных точек, которые должны оказаться
+    на диске до продолжения работы. Возвращает False, если запись не удалась.
+    """
+    global _pending_total
+
+    if isinstance(_backend, JournalBackend):
+        # Изменения уже записаны в журнал в schedule_save
+        return True
+
+    tasks = []
+    for filename in filenames:
+        store = _stores.get(filename)
+        if store is None:
+            continue
+        # Дожидаемся текущей записи: новый снимок не должен обогнать старый
+        while store.writing:
+            await asyncio.wait([store.write_task])
+        if store.dirty:
+            tasks.append(_start_write(store))
+    _pending_total = sum(store.pending_writes for store in _stores.values())
+    if not tasks:
+        return True
+
+    await asyncio.wait(tasks)
+    return all(task.result() > 0 for task in tasks)
+
+
+async def flush(reason: str = "таймер") -> int:
+    """
+    Записывает все изменения в хранилище.
+    Хранилища, запись которых ещё не завершилась, будут записаны при следующем сбросе.
+    Возвращает количество записанных файлов или строк.
+    """
+    global _pending_total
+
+    dirty_stores = [store for store in _stores.values() if store.dirty and not store.writing]
+    if not dirty_stores:
+        return 0
+
+    start = time.perf_counter()
+    tasks = [_start_write(store) for store in dirty_stores]
+    _pending_total = sum(store.pending_writes for store in _stores.values())
+    snapshot_ms = (time.perf_counter() - start) * 1000
+
+    # asyncio.wait не отменяет запись, если сам сброс будет отменён
+    await asyncio.wait(tasks)
+    written = sum(task.result() for task in tasks)
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    _stats["flushes"] += 1
+    _stats["last_flush_ms"] = elapsed_ms
+    _stats["max_flush_ms"] = max(_stats["max_flush_ms"], elapsed_ms)
+    _stats["total_flush_ms"] += elapsed_ms
+    _stats["last_snapshot_ms"] = snapshot_ms
+    _stats["max_snapshot_ms"] = max(_stats["max_snapshot_ms"], snapshot_ms)
+
+    logging.info(
+        f"Сброс данных ({reason}): записано {written}, время {elapsed_ms:.1f} мс "
+        f"(снимок в цикле событий {snapshot_ms:.1f} мс)"
+    )
+    return written
+
+
+async def compact(reason: str = "размер журнала") -> None:
+    """
+    Пересобирает JSON-файлы из памяти и очищает журнал (только в режиме "journal").
+    """
+    if not isinstance(_backend, JournalBackend) or _backend.compacting:
+        return
+
+    _backend.compacting = True
+    start = time.perf_counter()
+    try:
+        # Ротация и снимок выполняются без переключения задач, поэтому снимок
+        # содержит ровно все изменения из старого журнала
+        _backend.rotate()
+        jobs = [_backend.prepare(store) for store in _stores.values()]
+        await asyncio.to_thread(lambda: [_backend.execute(job) for job in jobs])
+        _backend.finish_compaction()
+    except Exception as e:
+        logging.exception(f"Ошибка компактизации журнала: {e}")
+        return
+    finally:
+        _backend.compacting = False
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    _stats["compactions"] += 1
+    _stats["last_compaction_ms"] = elapsed_ms
+    logging.info(f"Компактизация журнала ({reason}): записано файлов {len(jobs)}, время {elapsed_ms:.1f} мс")
+
+
+async def run_flusher() -> None:
+    """
+    Фоновая задача: периодически сбрасывает изменённые данные в хранилище.
+    """
+    while True:
+        try:
+            await asyncio.wait_for(_flush_requested.wait(), timeout=SAVE_FLUSH_INTERVAL)
+            reason = "порог изменений"
+        except asyncio.TimeoutError:
+            reason = "таймер"
+        _flush_requested.clear()
+        try:
+            if isinstance(_backend, JournalBackend):
+                if _backend.size >= JOURNAL_COMPACT_SIZE:
+                    await compact()
+            else:
+                await flush(reason)
+        except Exception as e:
+            logging.exception(f"Ошибка при сбросе данных: {e}")
+
+
+async def shutdown() -> None:
+    """
+    Дожидается незавершённых записей и сохраняет все оставшиеся изменения.
+    Вызывается при остановке бота.
+    """
+    if isinstance(_backend, JournalBackend):
+        # Все изменения уже в журнале, компактизация лишь ускорит следующий запуск
+        await compact(reason="остановка бота")
+        return
+
+    # Несколько попыток на случай, если запись завершилась ошибкой и данные снова помечены изменёнными
+    for _ in range(3):
+        in_flight = [store.write_task for store in _stores.values() if store.writing]
+        if in_flight:
+            await asyncio.wait(in_flight)
+        if not any(store.dirty for store in _stores.values()):
+            return
+        await flush(reason="остановка бота")
+    logging.error("Не удалось сохранить все изменения при остановке бота")
+
+
+def get_stats() -> dict:
+    """
+    Возвращает статистику работы слоя сохранения.
+    """
+    stats = dict(_stats)
+    stats["backend"] = STORAGE_BACKEND
+    stats["pending_writes"] = _pending_total
+    if isinstance(_backend, JournalBackend):
+        stats["journal_size"] = _backend.size
+        stats["journal_replayed"] = _backend.replayed
+    stats["avg_flush_ms"] = stats["total_flush_ms"] / stats["flushes"] if stats["flushes"] else 0.0
+    return stats
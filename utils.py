@@ -11,30 +11,61 @@ def load_json_data(filename: str) -> dict:
                 data = json.load(f)
         except Exception as e:
             logging.error(f"Ошибка чтения файла {filename}: {e}")
+            # Сохраняем повреждённый файл, чтобы следующая запись его не затёрла
+            try:
+                os.replace(filename, f"{filename}.corrupt")
+                logging.error(f"Повреждённый файл сохранён как {filename}.corrupt")
+            except OSError:
+                pass
             data = {}
     else:
         data = {}
     return data
 
-def save_json_data(filename: str, data: dict) -> None:
+def json_default(value):
+    """
+    Сериализует значения, которые json не умеет сохранять сам:
+    множества записываются как списки.
+    """
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def write_json_file(filename: str, data: dict) -> None:
+    """
+    Атомарно записывает JSON-файл: данные пишутся во временный файл, сбрасываются
+    на диск и только затем подменяют старый файл. При сбое на диске остаётся
+    либо старая, либо новая версия целиком. Ошибки не перехватываются.
+    """
     os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=4, ensure_ascii=False, default=json_default)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+def save_json_data(filename: str, data: dict) -> None:
     try:
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        write_json_file(filename, data)
     except Exception as e:
         logging.error(f"Ошибка записи в файл {filename}: {e}")
 
 def load_referral_data() -> dict:
     return load_json_data(REFERRALS_FILE)
 
-def save_referral_data(data: dict) -> None:
-    save_json_data(REFERRALS_FILE, data)
+def save_referral_data(data: dict, *user_ids) -> None:
+    # Запись откладывается и объединяется с другими изменениями (см. storage.py).
+    # Если переданы user_ids, сохраняются только записи этих пользователей.
+    from storage import schedule_save
+    schedule_save(REFERRALS_FILE, data, user_ids)
 
 def load_users_data() -> dict:
     return load_json_data(USERS_FILE)
 
-def save_users_data(data: dict) -> None:
-    save_json_data(USERS_FILE, data)
+def save_users_data(data: dict, *user_ids) -> None:
+    from storage import schedule_save
+    schedule_save(USERS_FILE, data, user_ids)
 
 def get_invite_word(count: int) -> str:
     return "приглашенный" if count == 1 else "приглашенных"